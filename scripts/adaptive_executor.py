@@ -0,0 +1,192 @@
+"""
+A thread pool executor whose concurrency adapts at runtime, in the manner of AIMD congestion control.
+
+The right number of concurrent tasks depends on where they run: uploads over the SSH tunnel to MinIO are throttled
+well below 128 concurrent requests, while symbolic link and directory scans on the local filesystem may benefit from
+more. Instead of a fixed thread count, the executor keeps a concurrency limit and adjusts it after every window of
+completed tasks:
+- slow start: the limit doubles each window until the first sign of congestion
+- additive increase: afterwards the limit grows by INCREASE_STEP per window while latency stays close to the
+  best latency seen
+- multiplicative decrease: the limit is halved when tasks are throttled or time out, and cut by LATENCY_DECREASE
+  when latency grows past LATENCY_TOLERANCE times the best latency without a matching gain in throughput
+
+Tasks failing with a retryable error (throttling, timeouts, connection errors) are retried with full jitter
+exponential backoff, up to max_attempts. Items are pulled lazily from the input iterable and at most the current
+limit of tasks is in flight, so no future is created per item up front.
+"""
+import concurrent.futures
+import random
+import statistics
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator
+
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, ReadTimeoutError
+
+from scripts.metrics import NULL_METRICS, Metrics
+
+MIN_WORKERS = 1
+INITIAL_WORKERS = 8
+MAX_WORKERS = 256
+MAX_ATTEMPTS = 5
+# minimum number of completed tasks between adjustments of the concurrency limit
+MIN_WINDOW = 8
+INCREASE_STEP = 2
+THROTTLE_DECREASE = 0.5
+LATENCY_DECREASE = 0.75
+LATENCY_TOLERANCE = 2.0
+# full jitter backoff, the delay before attempt n + 1 is uniform in [0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (n - 1))]
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+THROTTLE_ERROR_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests',
+                        'TooManyRequestsException', 'RequestTimeout', 'RequestTimeoutException', 'ServiceUnavailable',
+                        'InternalError', '500', '502', '503', '504'}
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Check whether the error signals throttling or a transient failure, i.e. a retry may succeed."""
+    # managed transfers wrap the error of the failed request, e.g. upload_file raises an S3UploadFailedError
+    if isinstance(error, S3UploadFailedError) and (error.__cause__ or error.__context__):
+        return is_retryable(error.__cause__ or error.__context__)
+    if isinstance(error, ClientError):
+        return str(error.response.get('Error', {}).get('Code')) in THROTTLE_ERROR_CODES
+    return isinstance(error, (BotocoreConnectionError, ReadTimeoutError, TimeoutError, ConnectionError))
+
+
+class _AimdController:
+    """Adjusts the concurrency limit from the latency and throttling of the tasks completed in each window."""
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self._lock = threading.Lock()
+        self._slow_start = True
+        self._latencies = list()
+        self._throttled = 0
+        self._window_start = time.perf_counter()
+        self._best_latency = None
+        self._last_throughput = None
+
+    def record(self, latency: float | None, throttled: bool = False):
+        """Record a finished attempt: its latency if it succeeded, or whether it was throttled."""
+        with self._lock:
+            if throttled:
+                self._throttled += 1
+            elif latency is not None:
+                self._latencies.append(latency)
+            if len(self._latencies) + self._throttled >= max(MIN_WINDOW, self.limit):
+                self._adjust()
+
+    def _adjust(self):
+        now = time.perf_counter()
+        throughput = len(self._latencies) / max(now - self._window_start, 1e-9)
+        if self._throttled:
+            self._slow_start = False
+            self.limit = int(self.limit * THROTTLE_DECREASE)
+        else:
+            latency = statistics.median(self._latencies)
+            self._best_latency = latency if self._best_latency is None else min(self._best_latency, latency)
+            congested = (latency > LATENCY_TOLERANCE * self._best_latency
+                         and self._last_throughput is not None and throughput <= self._last_throughput)
+            if congested:
+                self._slow_start = False
+                self.limit = int(self.limit * LATENCY_DECREASE)
+            elif self._slow_start:
+                self.limit *= 2
+            else:
+                self.limit += INCREASE_STEP
+        self.limit = max(self.minimum, min(self.limit, self.maximum))
+        self._latencies, self._throttled = list(), 0
+        self._window_start, self._last_throughput = now, throughput
+
+
+class AdaptiveExecutor:
+    """Runs a function over items in a thread pool with an adaptive concurrency limit and retries."""
+
+    def __init__(
+            self,
+            max_workers: int = MAX_WORKERS,
+            min_workers: int = MIN_WORKERS,
+            initial_workers: int = INITIAL_WORKERS,
+            max_attempts: int = MAX_ATTEMPTS,
+            retryable: Callable[[BaseException], bool] = is_retryable,
+            metrics: Metrics | None = None,
+            name: str = 'tasks'):
+        """
+        :param max_workers: upper bound of the concurrency limit, and of the number of threads
+        :param min_workers: lower bound of the concurrency limit
+        :param initial_workers: concurrency limit to start from
+        :param max_attempts: maximum number of attempts of a task failing with a retryable error
+        :param retryable: predicate of the errors which are retried and signal congestion
+        :param metrics: metrics of the run, records the concurrency limit, in-flight tasks, retries and throttling
+        :param name: name of the tasks in the metrics
+        """
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self._retryable = retryable
+        self._controller = _AimdController(initial_workers, min_workers, max_workers)
+        self._metrics = metrics or NULL_METRICS
+        self._name = name
+
+    @property
+    def limit(self) -> int:
+        """Current concurrency limit."""
+        return self._controller.limit
+
+    def _call(self, func: Callable[[Any], Any], item: Any) -> Any:
+        """Call the function with the item, retrying retryable errors with jittered exponential backoff."""
+        for attempt in range(1, self.max_attempts + 1):
+            start_time = time.perf_counter()
+            try:
+                result = func(item)
+            except Exception as e:
+                if not self._retryable(e):
+                    raise
+                self._controller.record(None, throttled=True)
+                self._metrics.count(f'{self._name}.throttled')
+                if attempt == self.max_attempts:
+                    raise
+                self._metrics.count(f'{self._name}.retries')
+                time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1))))
+                continue
+            self._controller.record(time.perf_counter() - start_time)
+            return result
+
+    def run(self, func: Callable[[Any], Any], items: Iterable) -> Iterator[tuple[Any, Any, Exception | None]]:
+        """
+        Run the function over the items, pulling items lazily so that at most the current concurrency limit of
+        tasks is in flight.
+
+        :param func: function called with each item
+        :param items: iterable of items, e.g. a generator discovering them
+
+        :return: iterator of (item, result, error) in completion order, error is None for tasks which succeeded and
+            result is None for tasks which failed
+        """
+        items = iter(items)
+        pending = dict()
+        exhausted = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                   thread_name_prefix=self._name) as executor:
+            while True:
+                while not exhausted and len(pending) < self._controller.limit:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[executor.submit(self._call, func, item)] = item
+                if not pending:
+                    return
+
+                self._metrics.gauge(f'{self._name}.concurrency', self._controller.limit)
+                self._metrics.gauge(f'{self._name}.in_flight', len(pending))
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    error = future.exception()
+                    yield item, None if error else future.result(), error
@@ -0,0 +1,198 @@
+"""
+This script builds a compact, memory-mappable store of pairwise genome ANI from the output of
+norm_results.normalize_fastani_results, and provides fast queries against it.
+
+Genome IDs are interned to integer indices and the pairs are kept as NumPy arrays sorted by query genome, with a
+CSR style offsets array so the pairs of a genome are a contiguous slice. A second permutation groups the pairs by
+reference genome so both directions of the FastANI output can be queried without scanning.
+
+Store layout:
+    genome_ids.txt  genome ID of each index, one per line
+    offsets.npy     int64, start of the pairs of query genome i is offsets[i], end is offsets[i + 1]
+    reference.npy   int32, reference genome index of each pair, sorted within each query genome
+    ani.npy         float32 ANI of each pair
+    overlap.npy     int32 count of bidirectional fragment mappings of each pair
+    total.npy       int32 total query fragments of each pair
+    rev_offsets.npy int64, CSR offsets of the pairs grouped by reference genome
+    rev_pairs.npy   int64, pair positions grouped by reference genome
+    rev_query.npy   int32, query genome index of each pair in rev_pairs order
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from scripts.metrics import Metrics
+
+PROCESSED_FASTANI_RESULTS = Path('processed_fastani_results.csv')
+STORE_DIR = Path('fastani_ani_store')
+READ_CHUNK_SIZE = 1_000_000
+# ANI is stored as float32, round results to the precision FastANI reports
+ANI_DECIMALS = 4
+
+_ARRAYS = ('offsets', 'reference', 'ani', 'overlap', 'total', 'rev_offsets', 'rev_pairs', 'rev_query')
+
+
+def _read_processed_chunks(processed_results: Path):
+    """Read the processed FastANI results, a CSV file or a Parquet dataset directory, in chunks of rows."""
+    columns = ['G1', 'G2', 'ANI', 'Overlap', 'Total']
+    if processed_results.is_dir():
+        for batch in ds.dataset(processed_results, format='parquet', partitioning='hive').to_batches(
+                columns=columns, batch_size=READ_CHUNK_SIZE):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(processed_results, usecols=columns, chunksize=READ_CHUNK_SIZE,
+                               dtype={'G1': str, 'G2': str, 'ANI': 'float32', 'Overlap': 'int32',
+                                      'Total': 'int32'})
+
+
+def build_ani_store(
+        processed_results: Path = PROCESSED_FASTANI_RESULTS,
+        store_dir: Path = STORE_DIR):
+    """
+    Build the ANI store from the processed FastANI results.
+
+    :param processed_results: processed FastANI results, either processed_fastani_results.csv or the Parquet
+        dataset directory written by normalize_fastani_results
+    :param store_dir: directory to write the store to
+    """
+    genome_index = dict()
+    queries, references, anis, overlaps, totals = list(), list(), list(), list(), list()
+    for df in _read_processed_chunks(Path(processed_results)):
+        for col, out in (('G1', queries), ('G2', references)):
+            # intern the genome IDs of the chunk, only the distinct IDs go through the dictionary
+            codes, uniques = pd.factorize(df[col])
+            index = np.array([genome_index.setdefault(genome_id, len(genome_index)) for genome_id in uniques],
+                             dtype=np.int32)
+            out.append(index[codes])
+        anis.append(df['ANI'].to_numpy(dtype=np.float32))
+        overlaps.append(df['Overlap'].to_numpy(dtype=np.int32))
+        totals.append(df['Total'].to_numpy(dtype=np.int32))
+
+    num_genomes = len(genome_index)
+    query = np.concatenate(queries) if queries else np.empty(0, dtype=np.int32)
+    reference = np.concatenate(references) if references else np.empty(0, dtype=np.int32)
+
+    order = np.lexsort((reference, query))
+    query, reference = query[order], reference[order]
+    offsets = np.zeros(num_genomes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(query, minlength=num_genomes), out=offsets[1:])
+
+    rev_pairs = np.lexsort((query, reference)).astype(np.int64)
+    rev_offsets = np.zeros(num_genomes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(reference, minlength=num_genomes), out=rev_offsets[1:])
+
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    arrays = {
+        'offsets': offsets,
+        'reference': reference,
+        'ani': np.concatenate(anis)[order] if anis else np.empty(0, dtype=np.float32),
+        'overlap': np.concatenate(overlaps)[order] if overlaps else np.empty(0, dtype=np.int32),
+        'total': np.concatenate(totals)[order] if totals else np.empty(0, dtype=np.int32),
+        'rev_offsets': rev_offsets,
+        'rev_pairs': rev_pairs,
+        'rev_query': query[rev_pairs],
+    }
+    for name, array in arrays.items():
+        np.save(store_dir / f'{name}.npy', array)
+    with open(store_dir / 'genome_ids.txt', 'w') as file:
+        file.writelines(f'{genome_id}\n' for genome_id in genome_index)
+
+    print(f'Built ANI store of {len(query)} pairs between {num_genomes} genomes in {store_dir}')
+
+
+class AniStore:
+    """
+    Read-only access to an ANI store built by build_ani_store. The arrays are memory-mapped, so opening a store is
+    cheap and only the pages touched by queries are read from disk.
+    """
+
+    def __init__(self, store_dir: Path = STORE_DIR):
+        """
+        :param store_dir: directory of the store
+        """
+        store_dir = Path(store_dir)
+        with open(store_dir / 'genome_ids.txt', 'r') as file:
+            self.genome_ids = [line.rstrip('\n') for line in file]
+        self._index = {genome_id: i for i, genome_id in enumerate(self.genome_ids)}
+        for name in _ARRAYS:
+            setattr(self, f'_{name}', np.load(store_dir / f'{name}.npy', mmap_mode='r'))
+
+    def _genome_index(self, genome_id: str) -> int:
+        try:
+            return self._index[genome_id]
+        except KeyError:
+            raise ValueError(f'Genome {genome_id} not found in the ANI store') from None
+
+    def _pair_position(self, query: int, reference: int) -> int | None:
+        start, end = self._offsets[query], self._offsets[query + 1]
+        pos = start + np.searchsorted(self._reference[start:end], reference)
+        if pos < end and self._reference[pos] == reference:
+            return int(pos)
+        return None
+
+    def pair(self, genome1: str, genome2: str) -> tuple[float, int, int] | None:
+        """
+        Get the FastANI result of a genome pair. The result with genome1 as query is returned if present,
+        otherwise the result with genome2 as query.
+
+        :return: tuple of (ANI, overlap, total), or None if the pair was not compared or did not reach the
+            FastANI reporting threshold
+        """
+        query, reference = self._genome_index(genome1), self._genome_index(genome2)
+        pos = self._pair_position(query, reference)
+        if pos is None:
+            pos = self._pair_position(reference, query)
+        if pos is None:
+            return None
+        return round(float(self._ani[pos]), ANI_DECIMALS), int(self._overlap[pos]), int(self._total[pos])
+
+    def ani(self, genome1: str, genome2: str) -> float | None:
+        """Get the ANI between two genomes, see pair()."""
+        result = self.pair(genome1, genome2)
+        return result[0] if result else None
+
+    def neighbours(self, genome_id: str, min_ani: float = 95.0) -> list[tuple[str, float]]:
+        """
+        Get all genomes within the ANI threshold of the genome, in either direction of the FastANI comparison.
+
+        :param genome_id: genome ID
+        :param min_ani: minimum ANI (in percent)
+
+        :return: list of (genome ID, ANI) sorted by decreasing ANI, using the higher ANI when both directions exist
+        """
+        i = self._genome_index(genome_id)
+
+        start, end = self._offsets[i], self._offsets[i + 1]
+        fwd_genomes, fwd_ani = self._reference[start:end], self._ani[start:end]
+
+        rev_start, rev_end = self._rev_offsets[i], self._rev_offsets[i + 1]
+        rev_genomes = self._rev_query[rev_start:rev_end]
+        rev_ani = self._ani[self._rev_pairs[rev_start:rev_end]]
+
+        genomes = np.concatenate([fwd_genomes, rev_genomes])
+        anis = np.concatenate([fwd_ani, rev_ani])
+        keep = (anis >= min_ani) & (genomes != i)
+        genomes, anis = genomes[keep], anis[keep]
+
+        # keep the highest ANI of each genome
+        order = np.lexsort((-anis, genomes))
+        genomes, anis = genomes[order], anis[order]
+        first = np.ones(len(genomes), dtype=bool)
+        first[1:] = genomes[1:] != genomes[:-1]
+        genomes, anis = genomes[first], anis[first]
+
+        order = np.argsort(-anis, kind='stable')
+        return [(self.genome_ids[g], round(float(a), ANI_DECIMALS)) for g, a in zip(genomes[order], anis[order])]
+
+
+def main():
+    with Metrics('ani_store') as metrics:
+        with metrics.stage('build'):
+            build_ani_store()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+"""
+This script avoids re-annotating identical proteins with eggNOG by keeping a local cache of earlier emapper results
+keyed on the hash of the protein sequence.
+
+The collections we annotate overlap: NCBI genomes selected by create_custom_collection, IMG submissions from
+download_IMG_files and lineage loads sharing genomes, and many proteins are byte-identical across genomes. eggNOG costs
+roughly 0.6-1 node minute per genome (see miscellaneous/eggnog_performance.md). The script runs in three stages
+around the eggNOG run, selected with STAGE:
+
+1. 'prepare' streams the protein FASTA files of the genomes and hashes every sequence. Sequences not in the cache are
+   written once, named by their hash, to a reduced FASTA file to run eggNOG on, and the protein to hash mapping of
+   every genome is saved. The cache hit rate and the estimated compute saved are reported.
+2. eggNOG is run on the reduced FASTA file, writing REDUCED_ANNOTATION_FILE.
+3. 'ingest' adds the emapper rows of the reduced run to the cache. If the run completed, i.e. the annotation file ends
+   with the emapper footer, the other sequences of the reduced FASTA file are cached as having no annotation too, so
+   they are not run again: those without a seed ortholog, and those whose seed ortholog emapper did not annotate,
+   which are counted separately. The rest of a run cut short (e.g. by the wall time limit) is left out of the cache,
+   and written to the reduced FASTA file again by the next prepare stage.
+4. 'rebuild' writes the full emapper.annotations table of every genome from the cache, in the layout
+   norm_results.normalize_eggnog_results reads.
+
+The cache records the emapper version and columns of its results, results of another emapper version are rejected.
+"""
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from scripts.create_custom_collection import COLLECTION, SOURCE_VER, TARGET_EXT
+from scripts.download_IMG_files import SOURCE_DIR as IMG_SOURCE_DIR
+from scripts.fasta_index import read_fasta
+from scripts.file_catalog import FileCatalog
+from scripts.metrics import NULL_METRICS, Metrics
+
+COLL_ROOT = Path('/global/cfs/cdirs/kbase/collections')
+CACHE_FILE = COLL_ROOT / 'collectionsdata' / 'NONE' / 'CDM' / 'eggnog_annotation_cache.sqlite'
+# directory of the protein FASTA files of each source, the genome ID is the top-level directory of a file
+SOURCE_DIRS = {COLL_ROOT / 'collectionssource' / 'NONE' / COLLECTION / SOURCE_VER: tuple(TARGET_EXT),
+               IMG_SOURCE_DIR: ('.faa',)}
+WORK_DIR = Path(os.environ.get('SCRATCH', '/tmp')) / 'cdm_eggnog_cache'
+REDUCED_FASTA_FILE = WORK_DIR / 'reduced.faa'
+REDUCED_ANNOTATION_FILE = WORK_DIR / 'reduced.emapper.annotations'
+REDUCED_SEED_ORTHOLOGS_FILE = WORK_DIR / 'reduced.emapper.seed_orthologs'
+PROTEIN_HASHES_FILE = WORK_DIR / 'protein_hashes.tsv.gz'
+PREPARE_STATS_FILE = WORK_DIR / 'prepare_stats.json'
+OUTPUT_DIR = WORK_DIR / 'annotations'
+
+STAGES = ('prepare', 'ingest', 'rebuild')
+STAGE = 'prepare'
+
+# best average node minutes per genome measured in miscellaneous/eggnog_performance.md
+NODE_MINUTES_PER_GENOME = 0.62
+# number of hashes per cache lookup query, below the SQLite limit of host parameters
+LOOKUP_BATCH_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    seq_hash    TEXT PRIMARY KEY,
+    annotation  TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key         TEXT PRIMARY KEY,
+    value       TEXT NOT NULL
+)
+"""
+
+
+def sequence_hash(sequence: bytes) -> str:
+    """Hash a protein sequence, ignoring case, line breaks and the trailing stop codon (*)."""
+    return hashlib.sha256(b''.join(sequence.split()).upper().rstrip(b'*')).hexdigest()
+
+
+class AnnotationCache:
+    """
+    Cache of emapper annotation rows keyed on the protein sequence hash, backed by a SQLite database.
+
+    A cached annotation of None records a sequence without an emapper hit. The cache is not safe for concurrent
+    writers.
+    """
+
+    def __init__(self, cache_file: Path = CACHE_FILE):
+        """
+        :param cache_file: path of the SQLite database, created if it does not exist
+        """
+        self.cache_file = Path(cache_file)
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.cache_file)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def meta(self, key: str) -> str | None:
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+        self._conn.commit()
+
+    def get(self, seq_hashes: list[str]) -> dict[str, str | None]:
+        """
+        Look up sequence hashes.
+
+        :return: mapping of the cached hashes to their annotation, hashes not in the cache are left out
+        """
+        found = dict()
+        for start in range(0, len(seq_hashes), LOOKUP_BATCH_SIZE):
+            batch = seq_hashes[start:start + LOOKUP_BATCH_SIZE]
+            found.update(self._conn.execute(
+                f'SELECT seq_hash, annotation FROM annotations WHERE seq_hash IN ({",".join("?" * len(batch))})',
+                batch))
+        return found
+
+    def add(self, annotations: list[tuple[str, str | None]]):
+        """Add (sequence hash, annotation) pairs to the cache, replacing cached annotations of the same hashes."""
+        self._conn.executemany('INSERT OR REPLACE INTO annotations (seq_hash, annotation) VALUES (?, ?)',
+                               annotations)
+        self._conn.commit()
+
+    def size(self) -> int:
+        return self._conn.execute('SELECT COUNT(*) FROM annotations').fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def find_protein_files(source_dirs: dict[Path, tuple[str, ...]] = SOURCE_DIRS) -> dict[str, Path]:
+    """
+    Find the protein FASTA files of the genomes in the source directories.
+
+    :return: mapping of genome ID to protein FASTA file, the first source directory wins for genomes in several
+    """
+    protein_files = dict()
+    for source_dir, suffixes in source_dirs.items():
+        if not source_dir.is_dir():
+            print(f'No source files found at {source_dir}')
+            continue
+        catalog = FileCatalog(source_dir, suffixes)
+        catalog.refresh()
+        for path, _, _ in catalog.files(suffixes):
+            protein_files.setdefault(path.relative_to(source_dir).parts[0], path)
+    return protein_files
+
+
+def prepare_reduced_fasta(
+        protein_files: dict[str, Path],
+        cache: AnnotationCache,
+        reduced_fasta_file: Path = REDUCED_FASTA_FILE,
+        protein_hashes_file: Path = PROTEIN_HASHES_FILE,
+        metrics: Metrics | None = None) -> dict[str, int | float]:
+    """
+    Hash the proteins of the genomes and write the sequences missing from the cache to a reduced FASTA file, each
+    distinct sequence once with its hash as the ID.
+
+    :param protein_files: mapping of genome ID to protein FASTA file
+    :param cache: annotation cache
+    :param reduced_fasta_file: reduced FASTA file to write
+    :param protein_hashes_file: file to save the (genome ID, protein ID, sequence hash) of every protein to
+    :param metrics: metrics of the run, records the time to hash each genome and counts proteins and cache hits
+
+    :return: statistics of the genomes, the cache hits and the estimated node minutes saved
+    """
+    metrics = metrics or NULL_METRICS
+    reduced_fasta_file.parent.mkdir(parents=True, exist_ok=True)
+    reduced_hashes = set()
+    num_proteins, num_cached = 0, 0
+    with open(reduced_fasta_file, 'wb') as reduced, gzip.open(protein_hashes_file, 'wt') as hashes:
+        for genome_id, faa_file in protein_files.items():
+            with metrics.stage('hash genome'):
+                proteins = [(protein_id, sequence_hash(sequence), sequence)
+                            for protein_id, sequence in read_fasta(faa_file)]
+            cached = cache.get(list({seq_hash for _, seq_hash, _ in proteins}))
+            for protein_id, seq_hash, sequence in proteins:
+                hashes.write(f'{genome_id}\t{protein_id}\t{seq_hash}\n')
+                if seq_hash in cached:
+                    num_cached += 1
+                elif seq_hash not in reduced_hashes:
+                    reduced_hashes.add(seq_hash)
+                    reduced.write(b'>' + seq_hash.encode() + b'\n' + sequence + b'\n')
+            num_proteins += len(proteins)
+            metrics.count('proteins', len(proteins))
+            metrics.count('bytes_read', faa_file.stat().st_size)
+
+    skipped = num_proteins - len(reduced_hashes)
+    hit_rate = skipped / num_proteins if num_proteins else 0.0
+    stats = {'genomes': len(protein_files),
+             'proteins': num_proteins,
+             'cached_proteins': num_cached,
+             'reduced_sequences': len(reduced_hashes),
+             'hit_rate': round(hit_rate, 4),
+             'node_minutes_saved': round(hit_rate * len(protein_files) * NODE_MINUTES_PER_GENOME, 2)}
+    metrics.count('cached_proteins', num_cached)
+    metrics.count('reduced_sequences', len(reduced_hashes))
+    print(f'{num_proteins} proteins of {len(protein_files)} genomes: {num_cached} in the cache, '
+          f'{len(reduced_hashes)} distinct new sequences written to {reduced_fasta_file}')
+    print(f'Skipping {hit_rate:.1%} of the proteins saves about {stats["node_minutes_saved"]} node minutes of eggNOG')
+    return stats
+
+
+def _read_emapper_annotations(annotation_file: Path) -> tuple[str | None, list[str], dict[str, str], bool]:
+    """
+    Read an emapper.annotations file.
+
+    :return: tuple of (emapper version from the ## metadata lines or None, column names without the leading #,
+        mapping of each query to the rest of its row, whether the file ends with the footer emapper writes once the
+        run completed)
+    """
+    version, columns, rows, complete = None, None, dict(), False
+    with open(annotation_file, 'r') as file:
+        for line in file:
+            if line.startswith('##'):
+                if version is None and line.startswith('## emapper-'):
+                    version = line[3:].strip()
+                elif columns is not None and (line.startswith('## Total time') or 'queries scanned' in line):
+                    complete = True
+            elif columns is None and line.startswith('#'):
+                columns = line[1:].rstrip('\n').split('\t')
+            elif columns is not None and line.strip():
+                query, _, rest = line.rstrip('\n').partition('\t')
+                rows[query] = rest
+    if columns is None:
+        raise ValueError(f'No header line found in {annotation_file}')
+    return version, columns, rows, complete
+
+
+def _read_seed_queries(seed_orthologs_file: Path) -> set[str]:
+    """Get the queries with a seed ortholog from an emapper.seed_orthologs file."""
+    with open(seed_orthologs_file, 'r') as file:
+        return {line.split('\t', 1)[0] for line in file if line.strip() and not line.startswith('#')}
+
+
+def ingest_annotations(
+        cache: AnnotationCache,
+        annotation_file: Path = REDUCED_ANNOTATION_FILE,
+        reduced_fasta_file: Path = REDUCED_FASTA_FILE,
+        seed_orthologs_file: Path = REDUCED_SEED_ORTHOLOGS_FILE) -> int:
+    """
+    Add the results of the eggNOG run on the reduced FASTA file to the cache.
+
+    :param cache: annotation cache
+    :param annotation_file: emapper.annotations file of the run, the queries are sequence hashes
+    :param reduced_fasta_file: the reduced FASTA file the run was made on. If the run completed, its sequences
+        without an annotation row are cached without annotation.
+    :param seed_orthologs_file: emapper.seed_orthologs file of the run, if present the sequences with a seed
+        ortholog but no annotation row are counted and reported
+
+    :return: number of sequences added to the cache
+    """
+    version, columns, annotations, complete = _read_emapper_annotations(annotation_file)
+    cached_version, cached_columns = cache.meta('emapper_version'), cache.meta('columns')
+    if cached_version is not None and version != cached_version:
+        raise ValueError(f'{annotation_file} is from {version}, the cache holds results of {cached_version}')
+    if cached_columns is not None and json.loads(cached_columns) != columns:
+        raise ValueError(f'Columns of {annotation_file} do not match the cached results')
+    if version is not None:
+        cache.set_meta('emapper_version', version)
+    cache.set_meta('columns', json.dumps(columns))
+
+    no_hit, num_seeded = list(), 0
+    if complete:
+        # a completed run annotated every sequence it could, including those with a seed ortholog but no row, which
+        # would otherwise be written to the reduced FASTA file again by every prepare stage
+        no_hit = [seq_hash for seq_hash, _ in read_fasta(reduced_fasta_file) if seq_hash not in annotations]
+        if seed_orthologs_file.exists():
+            seed_queries = _read_seed_queries(seed_orthologs_file)
+            num_seeded = sum(seq_hash in seed_queries for seq_hash in no_hit)
+    else:
+        print(f'{annotation_file} has no emapper completion footer, the run may have been cut short. Only the '
+              f'annotated sequences are cached, run the prepare stage and eggNOG again for the rest.')
+    cache.add(list(annotations.items()) + [(seq_hash, None) for seq_hash in no_hit])
+    print(f'Cached {len(annotations)} annotated and {len(no_hit)} unannotated sequences '
+          f'({num_seeded} with a seed ortholog but no annotation), {cache.size()} sequences in the cache')
+    return len(annotations) + len(no_hit)
+
+
+def _read_genome_hashes(protein_hashes_file: Path):
+    """Read the saved protein hashes, grouped by genome, as a generator of (genome ID, [(protein ID, hash)])."""
+    genome_id, proteins = None, list()
+    with gzip.open(protein_hashes_file, 'rt') as file:
+        for line in file:
+            row_genome_id, protein_id, seq_hash = line.rstrip('\n').split('\t')
+            if row_genome_id != genome_id:
+                if genome_id is not None:
+                    yield genome_id, proteins
+                genome_id, proteins = row_genome_id, list()
+            proteins.append((protein_id, seq_hash))
+    if genome_id is not None:
+        yield genome_id, proteins
+
+
+def rebuild_genome_annotations(
+        cache: AnnotationCache,
+        protein_hashes_file: Path = PROTEIN_HASHES_FILE,
+        output_dir: Path = OUTPUT_DIR,
+        metrics: Metrics | None = None) -> list[Path]:
+    """
+    Write the emapper.annotations table of every genome of the prepare stage from the cache, to
+    <output_dir>/<genome_id>/<genome_id>.emapper.annotations.
+
+    :param cache: annotation cache
+    :param protein_hashes_file: protein hashes saved by the prepare stage
+    :param output_dir: output directory
+    :param metrics: metrics of the run, records the time to write each genome
+
+    :return: the written annotation files
+    """
+    metrics = metrics or NULL_METRICS
+    if cache.meta('columns') is None:
+        raise ValueError(f'No annotations ingested into the cache at {cache.cache_file}')
+    columns = json.loads(cache.meta('columns'))
+    header = [f'## {cache.meta("emapper_version") or "emapper"}',
+              f'## rebuilt from the annotation cache {cache.cache_file}',
+              '#' + '\t'.join(columns)]
+
+    annotation_files, incomplete = list(), list()
+    for genome_id, proteins in _read_genome_hashes(protein_hashes_file):
+        with metrics.stage('rebuild genome'):
+            annotations = cache.get(list({seq_hash for _, seq_hash in proteins}))
+            if len(annotations) < len({seq_hash for _, seq_hash in proteins}):
+                incomplete.append(genome_id)
+                continue
+            annotation_file = output_dir / genome_id / f'{genome_id}.emapper.annotations'
+            annotation_file.parent.mkdir(parents=True, exist_ok=True)
+            num_rows = 0
+            with open(annotation_file, 'w') as file:
+                file.writelines(f'{line}\n' for line in header)
+                for protein_id, seq_hash in proteins:
+                    if annotations[seq_hash] is not None:
+                        file.write(f'{protein_id}\t{annotations[seq_hash]}\n')
+                        num_rows += 1
+                file.write(f'## {num_rows} queries annotated\n')
+        annotation_files.append(annotation_file)
+        metrics.count('genomes_rebuilt')
+
+    print(f'Rebuilt the annotations of {len(annotation_files)} genomes in {output_dir}')
+    if incomplete:
+        raise ValueError(f'{len(incomplete)} genomes have proteins missing from the cache, '
+                         f'ingest the eggNOG results of the reduced FASTA file first: {incomplete[:10]}')
+    return annotation_files
+
+
+def _run_stage(metrics: Metrics):
+    if STAGE not in STAGES:
+        raise ValueError(f'Invalid stage {STAGE}, must be one of {STAGES}')
+    start_time = time.perf_counter()
+    with AnnotationCache(CACHE_FILE) as cache:
+        if STAGE == 'prepare':
+            with metrics.stage('find protein files'):
+                protein_files = find_protein_files()
+            stats = prepare_reduced_fasta(protein_files, cache, metrics=metrics)
+            with open(PREPARE_STATS_FILE, 'w') as file:
+                json.dump(stats, file, indent=2)
+            print(f'Run eggNOG on {REDUCED_FASTA_FILE}, writing {REDUCED_ANNOTATION_FILE}, then the ingest stage')
+        elif STAGE == 'ingest':
+            with metrics.stage('ingest'):
+                ingest_annotations(cache)
+        else:
+            rebuild_genome_annotations(cache, metrics=metrics)
+            if PREPARE_STATS_FILE.exists():
+                with open(PREPARE_STATS_FILE, 'r') as file:
+                    stats = json.load(file)
+                print(f'Cache hit rate {stats["hit_rate"]:.1%} of {stats["proteins"]} proteins, '
+                      f'about {stats["node_minutes_saved"]} node minutes of eggNOG saved')
+    print(f'{STAGE} stage done in {time.perf_counter() - start_time:.2f}s')
+
+
+def main():
+    with Metrics('annotation_cache') as metrics:
+        _run_stage(metrics)
+
+
+if __name__ == '__main__':
+    main()
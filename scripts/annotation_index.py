@@ -0,0 +1,529 @@
+"""
+This script builds an inverted index of the annotation terms of the processed eggNOG results, and provides fast
+queries against it, e.g. the genomes carrying a KEGG KO or the KO presence/absence matrix of a clade, without loading
+the per-genome results.
+
+The index is built from the outputs of norm_results.normalize_eggnog_results (processed_*.csv, genome_id column) and
+parse_eggnog_result (*.emapper.annotations.processed.csv, img_submission_id column), or from their Parquet datasets.
+The terms are the values of the INDEXED_FIELDS columns: KEGG KOs (without the ko: prefix), COG categories (one term
+per letter), PFAMs, GO terms and EC numbers.
+
+The index is a directory of immutable segments. Adding genomes writes a new segment and never rewrites the existing
+ones, compact_annotation_index merges the segments into one when their number starts to slow the queries down.
+Genome IDs are interned to integer indices across the index, protein IDs within each segment. Each term of a segment
+has two posting lists, the sorted genome indices and the sorted protein indices carrying the term. Posting lists are
+delta encoded and stored as LEB128 varints, most deltas fit in a single byte.
+
+Index layout:
+    index.json                      names of the segments, in order, and the genomes left incomplete by a run
+                                    which wrote a segment before it read all their rows and did not finish
+    genome_ids.txt                  genome ID of each genome index, one per line
+    <segment>/terms.txt             '<field>\t<value>' of each term index of the segment, sorted
+    <segment>/genome_offsets.npy    int64, the genome posting list of term i is
+                                    genome_postings[genome_offsets[i]:genome_offsets[i + 1]]
+    <segment>/genome_postings.npy   uint8, delta and varint encoded genome indices
+    <segment>/protein_offsets.npy   int64, offsets of the protein posting lists
+    <segment>/protein_postings.npy  uint8, delta and varint encoded protein indices of the segment
+    <segment>/protein_ids.txt       protein ID of each protein index of the segment, one per line
+    <segment>/protein_genomes.npy   int32, genome index of each protein index of the segment
+"""
+import bisect
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from scripts.metrics import NULL_METRICS, Metrics
+
+RESULT_DIR = Path('/global/cfs/cdirs/kbase/collections/collectionsdata/NONE/CDM/IMG/eggnog')
+INDEX_DIR = Path('eggnog_annotation_index')
+PROCESSED_CSV_PATTERNS = ('processed_*.csv', '*.emapper.annotations.processed.csv')
+PROCESSED_PARQUET_DIR_NAME = 'processed_parquet'
+
+INDEXED_FIELDS = ('KEGG_ko', 'COG_category', 'PFAMs', 'GOs', 'EC')
+# genome and protein ID columns of the processed results, in order of preference
+GENOME_COLUMNS = ('genome_id', 'img_submission_id')
+PROTEIN_COLUMNS = ('#query', 'query')
+READ_CHUNK_SIZE = 500_000
+# a new segment is started once a segment holds this many proteins, bounding the memory used while adding genomes
+SEGMENT_PROTEINS = 20_000_000
+
+_SEGMENT_PREFIX = 'segment_'
+
+
+def _encode_postings(term_codes: np.ndarray, values: np.ndarray, num_terms: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Delta and varint encode posting lists.
+
+    :param term_codes: term index of each posting, sorted
+    :param values: value of each posting, sorted within each term
+    :param num_terms: number of terms
+
+    :return: tuple of (int64 byte offsets of the posting list of each term, uint8 encoded posting lists)
+    """
+    first = np.ones(len(values), dtype=bool)
+    first[1:] = term_codes[1:] != term_codes[:-1]
+    deltas = values.astype(np.uint64)
+    deltas[1:] -= np.where(first[1:], 0, values[:-1]).astype(np.uint64)
+
+    num_bytes = np.ones(len(deltas), dtype=np.int64)
+    rest = deltas >> np.uint64(7)
+    while rest.any():
+        num_bytes += rest > 0
+        rest >>= np.uint64(7)
+
+    starts = np.cumsum(num_bytes) - num_bytes
+    encoded = np.zeros(int(num_bytes.sum()), dtype=np.uint8)
+    for k in range(int(num_bytes.max(initial=0))):
+        present = num_bytes > k
+        byte = (deltas[present] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        byte |= np.where(num_bytes[present] > k + 1, 0x80, 0).astype(np.uint64)
+        encoded[starts[present] + k] = byte
+
+    offsets = np.zeros(num_terms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_codes, weights=num_bytes, minlength=num_terms).astype(np.int64), out=offsets[1:])
+    return offsets, encoded
+
+
+def _decode_postings(postings: np.ndarray, offsets: np.ndarray, start: int, end: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Decode the posting lists of the terms start to end - 1, in a single vectorized pass.
+
+    :return: tuple of (decoded values of the terms concatenated, int64 offsets of the values of each term)
+    """
+    data = np.asarray(postings[offsets[start]:offsets[end]])
+    last = data < 0x80
+    value_counts = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum(last, out=value_counts[1:])
+    value_offsets = value_counts[offsets[start:end + 1] - offsets[start]]
+    if not len(data):
+        return np.empty(0, dtype=np.int64), value_offsets
+
+    value_starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    shifts = 7 * (np.arange(len(data)) - np.repeat(value_starts, np.diff(np.append(value_starts, len(data)))))
+    deltas = np.add.reduceat((data & 0x7f).astype(np.int64) << shifts, value_starts)
+
+    # undo the delta encoding, restarting the running sum at the first value of each term
+    sums = np.cumsum(deltas)
+    before = np.concatenate(([0], sums))[value_offsets[:-1]]
+    return sums - np.repeat(before, np.diff(value_offsets)), value_offsets
+
+
+def _split_terms(values: pd.Series, field: str) -> pd.Series:
+    """Split the annotation values of the field into terms, indexed by the row position of each term."""
+    values = values.reset_index(drop=True).astype('string')
+    if field == 'COG_category':
+        terms = values.str.findall(r'[A-Z]').explode()
+    else:
+        terms = values.str.split(',').explode().str.strip()
+    terms = terms[terms.notna() & (terms != '-') & (terms != '')]
+    if field == 'KEGG_ko':
+        terms = terms.str.removeprefix('ko:')
+    return terms
+
+
+def _read_processed_chunks(processed_results: Path):
+    """
+    Read the processed eggNOG results, a CSV file or a Parquet dataset directory, in chunks of rows with the genome
+    and protein ID columns renamed to genome_id and protein_id.
+    """
+    if processed_results.is_dir():
+        dataset = ds.dataset(processed_results, format='parquet', partitioning='hive')
+        columns = dataset.schema.names
+        batches = (batch.to_pandas() for batch in dataset.to_batches(
+            columns=[c for c in columns if c in GENOME_COLUMNS + PROTEIN_COLUMNS + INDEXED_FIELDS],
+            batch_size=READ_CHUNK_SIZE))
+    else:
+        columns = list(pd.read_csv(processed_results, nrows=0).columns)
+        batches = pd.read_csv(processed_results,
+                              usecols=lambda c: c in GENOME_COLUMNS + PROTEIN_COLUMNS + INDEXED_FIELDS,
+                              dtype=str, chunksize=READ_CHUNK_SIZE)
+
+    genome_col = next((c for c in GENOME_COLUMNS if c in columns), None)
+    protein_col = next((c for c in PROTEIN_COLUMNS if c in columns), None)
+    if genome_col is None or protein_col is None:
+        raise ValueError(f'{processed_results} has no genome ID column {GENOME_COLUMNS} '
+                         f'or no protein ID column {PROTEIN_COLUMNS}')
+
+    for df in batches:
+        df = df.rename(columns={genome_col: 'genome_id', protein_col: 'protein_id'})
+        # partition values of a Parquet dataset may be inferred as integers, e.g. IMG submission IDs
+        df['genome_id'] = df['genome_id'].astype(str)
+        yield df
+
+
+def find_processed_results(result_dir: Path = RESULT_DIR) -> list[Path]:
+    """Find the processed eggNOG result CSV files and Parquet dataset directories under the directory."""
+    result_dir = Path(result_dir)
+    parquet_dirs = sorted(result_dir.rglob(PROCESSED_PARQUET_DIR_NAME))
+    csv_files = sorted({csv_file for pattern in PROCESSED_CSV_PATTERNS for csv_file in result_dir.rglob(pattern)
+                        if not any(parquet_dir in csv_file.parents for parquet_dir in parquet_dirs)})
+    return csv_files + parquet_dirs
+
+
+def _read_manifest(index_dir: Path) -> tuple[list[str], list[str], list[str]]:
+    """
+    Get the segment names, the genome IDs and the incomplete genome IDs of the index, all empty if there is no index
+    yet. Incomplete genomes were partially written to a segment by a run which did not finish.
+    """
+    if not (index_dir / 'index.json').exists():
+        return list(), list(), list()
+    with open(index_dir / 'index.json', 'r') as file:
+        manifest = json.load(file)
+    with open(index_dir / 'genome_ids.txt', 'r') as file:
+        genome_ids = [line.rstrip('\n') for line in file]
+    return manifest['segments'], genome_ids, manifest.get('incomplete', list())
+
+
+def _write_manifest(index_dir: Path, segments: list[str], genome_ids: list[str], incomplete: list[str] = ()):
+    """Replace the manifest of the index. The genome IDs go first, index.json makes the new segments visible."""
+    for name, write in (('genome_ids.txt', lambda file: file.writelines(f'{g}\n' for g in genome_ids)),
+                        ('index.json', lambda file: json.dump({'segments': segments, 'incomplete': list(incomplete)},
+                                                              file))):
+        tmp_file = index_dir / f'{name}.tmp'
+        with open(tmp_file, 'w') as file:
+            write(file)
+        os.replace(tmp_file, index_dir / name)
+
+
+def _write_segment(
+        segment_dir: Path,
+        terms: list[str],
+        term_codes: np.ndarray,
+        proteins: np.ndarray,
+        protein_ids: list[str],
+        protein_genomes: np.ndarray):
+    """
+    Write a segment from its (term, protein) pairs.
+
+    :param segment_dir: directory of the segment
+    :param terms: terms in order of their codes, need not be sorted
+    :param term_codes: term code of each pair
+    :param proteins: protein index of each pair
+    :param protein_ids: protein ID of each protein index
+    :param protein_genomes: genome index of each protein index
+    """
+    order = sorted(range(len(terms)), key=terms.__getitem__)
+    rank = np.empty(len(terms), dtype=np.int64)
+    rank[order] = np.arange(len(terms))
+    term_codes = rank[term_codes]
+
+    arrays = {'protein_genomes': protein_genomes.astype(np.int32)}
+    for name, values in (('protein', proteins), ('genome', protein_genomes[proteins])):
+        pairs = np.unique(np.stack([term_codes, values.astype(np.int64)], axis=1), axis=0)
+        arrays[f'{name}_offsets'], arrays[f'{name}_postings'] = _encode_postings(pairs[:, 0], pairs[:, 1], len(terms))
+
+    tmp_dir = segment_dir.with_name(segment_dir.name + '.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    for name, array in arrays.items():
+        np.save(tmp_dir / f'{name}.npy', array)
+    with open(tmp_dir / 'terms.txt', 'w') as file:
+        file.writelines(f'{terms[i]}\n' for i in order)
+    with open(tmp_dir / 'protein_ids.txt', 'w') as file:
+        file.writelines(f'{protein_id}\n' for protein_id in protein_ids)
+    os.replace(tmp_dir, segment_dir)
+
+
+class _SegmentBuilder:
+    """Accumulates the (term, protein) pairs of the genomes of a new segment."""
+
+    def __init__(self, genome_index: dict[str, int]):
+        self.genome_index = genome_index
+        self.term_index = dict()
+        self.term_codes, self.proteins = list(), list()
+        self.protein_ids, self.protein_genomes = list(), list()
+
+    def add(self, df: pd.DataFrame) -> int:
+        """Add the proteins of a chunk of processed results, return the number of postings added."""
+        base = len(self.protein_ids)
+        self.protein_ids.extend(df['protein_id'].astype(str))
+        codes, uniques = pd.factorize(df['genome_id'])
+        index = np.array([self.genome_index.setdefault(genome_id, len(self.genome_index)) for genome_id in uniques],
+                         dtype=np.int32)
+        self.protein_genomes.append(index[codes])
+
+        num_postings = 0
+        for field in INDEXED_FIELDS:
+            if field not in df.columns:
+                continue
+            terms = _split_terms(df[field], field)
+            codes, uniques = pd.factorize(field + '\t' + terms)
+            index = np.array([self.term_index.setdefault(term, len(self.term_index)) for term in uniques],
+                             dtype=np.int64)
+            self.term_codes.append(index[codes])
+            self.proteins.append(base + terms.index.to_numpy(dtype=np.int64))
+            num_postings += len(terms)
+        return num_postings
+
+    def write(self, segment_dir: Path):
+        _write_segment(segment_dir,
+                       list(self.term_index),
+                       np.concatenate(self.term_codes) if self.term_codes else np.empty(0, dtype=np.int64),
+                       np.concatenate(self.proteins) if self.proteins else np.empty(0, dtype=np.int64),
+                       self.protein_ids,
+                       np.concatenate(self.protein_genomes) if self.protein_genomes else np.empty(0, dtype=np.int32))
+
+
+def add_to_annotation_index(
+        processed_results: list[Path] | None = None,
+        index_dir: Path = INDEX_DIR,
+        metrics: Metrics | None = None) -> int:
+    """
+    Add the genomes of the processed eggNOG results to the annotation index, creating the index if needed.
+
+    The new genomes are written to new segments, the existing segments are left untouched. Genomes already in the
+    index, or found in an earlier input of the same run (e.g. both in a processed_*.csv file and in the
+    *.emapper.annotations.processed.csv file of the same genome), are skipped, so the same results may be passed again
+    after new genomes were processed. Genomes partially written by an interrupted run are dropped from the index by
+    compacting it, and added again in full.
+
+    :param processed_results: processed eggNOG result CSV files and Parquet dataset directories, by default all found
+        in RESULT_DIR
+    :param index_dir: directory of the index
+    :param metrics: metrics of the run, counts the rows read, postings and genomes added
+
+    :return: number of genomes added
+    """
+    metrics = metrics or NULL_METRICS
+    if processed_results is None:
+        processed_results = find_processed_results()
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    if _read_manifest(index_dir)[2]:
+        compact_annotation_index(index_dir)
+    segments, genome_ids, _ = _read_manifest(index_dir)
+    indexed_genomes = set(genome_ids)
+    genome_index = {genome_id: i for i, genome_id in enumerate(genome_ids)}
+    next_segment = max((int(name.removeprefix(_SEGMENT_PREFIX)) + 1 for name in segments), default=0)
+    # genomes of the input being read, complete only once the whole input has been read
+    input_genomes, written_incomplete = set(), set()
+
+    def _flush(builder: _SegmentBuilder, incomplete: set[str]):
+        nonlocal next_segment, written_incomplete
+        if builder.protein_ids:
+            name = f'{_SEGMENT_PREFIX}{next_segment:05d}'
+            with metrics.stage('write segment'):
+                builder.write(index_dir / name)
+            segments.append(name)
+            next_segment += 1
+            print(f'Wrote {name} with {len(builder.protein_ids)} proteins')
+        elif incomplete == written_incomplete:
+            return
+        _write_manifest(index_dir, segments, list(genome_index), sorted(incomplete))
+        written_incomplete = set(incomplete)
+
+    builder = _SegmentBuilder(genome_index)
+    for processed_result in processed_results:
+        with metrics.stage('read results'):
+            for df in _read_processed_chunks(Path(processed_result)):
+                metrics.count('rows_read', len(df))
+                df = df[~df['genome_id'].isin(indexed_genomes)]
+                if not df.empty:
+                    input_genomes.update(df['genome_id'].unique())
+                    metrics.count('postings_added', builder.add(df))
+                if len(builder.protein_ids) >= SEGMENT_PROTEINS:
+                    _flush(builder, input_genomes)
+                    builder = _SegmentBuilder(genome_index)
+        indexed_genomes.update(input_genomes)
+        input_genomes = set()
+    _flush(builder, input_genomes)
+
+    num_added = len(genome_index) - len(genome_ids)
+    metrics.count('genomes_added', num_added)
+    print(f'Added {num_added} genomes to the annotation index in {index_dir}, '
+          f'{len(genome_index)} genomes in {len(segments)} segments')
+    return num_added
+
+
+def compact_annotation_index(index_dir: Path = INDEX_DIR):
+    """
+    Merge the segments of the annotation index into a single segment, dropping the genomes left incomplete by an
+    interrupted run of add_to_annotation_index.
+    """
+    index_dir = Path(index_dir)
+    segments, genome_ids, incomplete = _read_manifest(index_dir)
+    if len(segments) < 2 and not incomplete:
+        return
+
+    # the merged segment renumbers the genomes without the incomplete ones
+    drop = set(incomplete)
+    kept_genome_ids = [genome_id for genome_id in genome_ids if genome_id not in drop]
+    genome_map = np.full(len(genome_ids), -1, dtype=np.int64)
+    genome_map[[i for i, genome_id in enumerate(genome_ids) if genome_id not in drop]] = np.arange(len(kept_genome_ids))
+
+    term_index = dict()
+    term_codes, proteins, protein_ids, protein_genomes = list(), list(), list(), list()
+    for name in segments:
+        segment = _Segment(index_dir / name)
+        values, value_offsets = _decode_postings(segment.protein_postings, segment.protein_offsets,
+                                                 0, len(segment.terms))
+        index = np.array([term_index.setdefault(term, len(term_index)) for term in segment.terms], dtype=np.int64)
+        segment_genomes = genome_map[np.asarray(segment.protein_genomes)]
+        keep = segment_genomes >= 0
+        positions = np.cumsum(keep) - 1
+        kept_values = keep[values]
+        term_codes.append(np.repeat(index, np.diff(value_offsets))[kept_values])
+        proteins.append(positions[values[kept_values]] + len(protein_ids))
+        protein_ids.extend(protein_id for protein_id, kept in zip(segment.protein_ids(), keep.tolist()) if kept)
+        protein_genomes.append(segment_genomes[keep])
+
+    # terms only carried by the dropped genomes are left out
+    terms = list(term_index)
+    used_terms, term_codes = np.unique(np.concatenate(term_codes), return_inverse=True)
+    name = f'{_SEGMENT_PREFIX}{int(segments[-1].removeprefix(_SEGMENT_PREFIX)) + 1:05d}'
+    _write_segment(index_dir / name, [terms[i] for i in used_terms], term_codes.reshape(-1),
+                   np.concatenate(proteins), protein_ids, np.concatenate(protein_genomes))
+    _write_manifest(index_dir, [name], kept_genome_ids)
+    for old_name in segments:
+        shutil.rmtree(index_dir / old_name)
+    print(f'Compacted {len(segments)} segments of the annotation index into {name}'
+          + (f', dropped {len(drop)} incomplete genomes' if drop else ''))
+
+
+class _Segment:
+    """A memory-mapped segment of the annotation index."""
+
+    def __init__(self, segment_dir: Path):
+        self.segment_dir = segment_dir
+        with open(segment_dir / 'terms.txt', 'r') as file:
+            self.terms = [line.rstrip('\n') for line in file]
+        self.term_index = {term: i for i, term in enumerate(self.terms)}
+        for name in ('genome_offsets', 'genome_postings', 'protein_offsets', 'protein_postings', 'protein_genomes'):
+            setattr(self, name, np.load(segment_dir / f'{name}.npy', mmap_mode='r'))
+        self._protein_ids = None
+
+    def protein_ids(self) -> list[str]:
+        """Protein IDs of the segment, read on first use."""
+        if self._protein_ids is None:
+            with open(self.segment_dir / 'protein_ids.txt', 'r') as file:
+                self._protein_ids = [line.rstrip('\n') for line in file]
+        return self._protein_ids
+
+    def field_range(self, field: str) -> tuple[int, int]:
+        """Term indices start to end - 1 of the terms of the field."""
+        # terms are sorted and tab (\t) sorts right before newline (\n)
+        return bisect.bisect_left(self.terms, f'{field}\t'), bisect.bisect_left(self.terms, f'{field}\n')
+
+
+class AnnotationIndex:
+    """
+    Read-only access to an annotation index built by add_to_annotation_index. The posting lists are memory-mapped,
+    so opening an index is cheap and queries only read the posting lists of the terms they look up.
+    """
+
+    def __init__(self, index_dir: Path = INDEX_DIR):
+        """
+        :param index_dir: directory of the index
+        """
+        index_dir = Path(index_dir)
+        segments, self.genome_ids, _ = _read_manifest(index_dir)
+        if not segments:
+            raise ValueError(f'No annotation index found in {index_dir}')
+        self._index = {genome_id: i for i, genome_id in enumerate(self.genome_ids)}
+        self._segments = [_Segment(index_dir / name) for name in segments]
+
+    @staticmethod
+    def _check_field(field: str):
+        if field not in INDEXED_FIELDS:
+            raise ValueError(f'Invalid field {field}, must be one of {INDEXED_FIELDS}')
+
+    def terms(self, field: str) -> list[str]:
+        """Get the sorted distinct terms of the field, e.g. all KEGG KOs in the index."""
+        self._check_field(field)
+        terms = set()
+        for segment in self._segments:
+            start, end = segment.field_range(field)
+            terms.update(term.split('\t', 1)[1] for term in segment.terms[start:end])
+        return sorted(terms)
+
+    def genomes_with(self, field: str, term: str) -> list[str]:
+        """
+        Get the genomes carrying an annotation term.
+
+        :param field: annotation field, one of INDEXED_FIELDS
+        :param term: term, e.g. K00001 for the KEGG_ko field
+
+        :return: sorted genome IDs
+        """
+        self._check_field(field)
+        genomes = list()
+        for segment in self._segments:
+            i = segment.term_index.get(f'{field}\t{term}')
+            if i is not None:
+                genomes.append(_decode_postings(segment.genome_postings, segment.genome_offsets, i, i + 1)[0])
+        if not genomes:
+            return list()
+        return sorted(self.genome_ids[g] for g in np.unique(np.concatenate(genomes)))
+
+    def proteins_with(self, field: str, term: str) -> list[tuple[str, str]]:
+        """
+        Get the proteins carrying an annotation term.
+
+        :return: list of (genome ID, protein ID)
+        """
+        self._check_field(field)
+        proteins = list()
+        for segment in self._segments:
+            i = segment.term_index.get(f'{field}\t{term}')
+            if i is None:
+                continue
+            values, _ = _decode_postings(segment.protein_postings, segment.protein_offsets, i, i + 1)
+            protein_ids = segment.protein_ids()
+            proteins.extend((self.genome_ids[segment.protein_genomes[p]], protein_ids[p]) for p in values)
+        return proteins
+
+    def presence_matrix(
+            self,
+            genome_ids: list[str],
+            field: str = 'KEGG_ko',
+            terms: list[str] | None = None) -> pd.DataFrame:
+        """
+        Get the presence/absence matrix of the terms of a field in a set of genomes, e.g. the KO presence/absence
+        matrix of a clade.
+
+        :param genome_ids: genome IDs, e.g. the members of a clade from AniStore.neighbours or
+            utils.get_genome_ids_with_lineage
+        :param field: annotation field, one of INDEXED_FIELDS
+        :param terms: terms of the matrix columns, by default all terms of the field carried by any of the genomes
+
+        :return: boolean DataFrame indexed by genome ID with a column per term
+        """
+        self._check_field(field)
+        missing = [genome_id for genome_id in genome_ids if genome_id not in self._index]
+        if missing:
+            raise ValueError(f'{len(missing)} genomes not found in the annotation index: {missing[:10]}')
+        rows = np.full(len(self.genome_ids), -1, dtype=np.int64)
+        rows[[self._index[genome_id] for genome_id in genome_ids]] = np.arange(len(genome_ids))
+
+        present = set()
+        for segment in self._segments:
+            start, end = segment.field_range(field)
+            values, value_offsets = _decode_postings(segment.genome_postings, segment.genome_offsets, start, end)
+            term_of_value = np.repeat(np.arange(start, end), np.diff(value_offsets))
+            keep = rows[values] >= 0
+            present.update(zip(rows[values[keep]].tolist(),
+                               (segment.terms[t].split('\t', 1)[1] for t in term_of_value[keep].tolist())))
+
+        if terms is None:
+            terms = sorted({term for _, term in present})
+        columns = {term: j for j, term in enumerate(terms)}
+        matrix = np.zeros((len(genome_ids), len(terms)), dtype=bool)
+        for row, term in present:
+            if term in columns:
+                matrix[row, columns[term]] = True
+        return pd.DataFrame(matrix, index=pd.Index(genome_ids, name='genome_id'), columns=terms)
+
+
+def main():
+    with Metrics('annotation_index') as metrics:
+        with metrics.stage('add genomes'):
+            add_to_annotation_index(metrics=metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+"""
+This script benchmarks the normalization, parsing and upload planning scripts on synthetic data.
+
+Realistic inputs (GTDB taxonomy TSVs, emapper annotation tsv/xlsx files, FastANI .txt outputs and an NCBI style
+genome directory tree) are generated by synthetic_data.py into a temporary directory, sized by the constants below.
+Each benchmark then runs in a fresh process, so the peak RSS recorded for it is its own and not that of the data
+generation or of earlier benchmarks. Benchmarks talking to S3 run against moto's in-process S3 stand-in
+(`pip install moto`), and are skipped if moto is not installed.
+
+One JSON line per benchmark (elapsed seconds, throughput, peak RSS of the benchmark process and of its worker
+processes, the git commit and the dataset sizes) is appended to RESULTS_FILE and compared with the previous run of
+the same benchmark, so regressions show up across commits.
+
+Run from the repository root with `PYTHONPATH=. python scripts/benchmark.py`.
+"""
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from scripts import synthetic_data
+
+RESULTS_FILE = Path('benchmark_results.jsonl')
+# run only the benchmarks with these names, None for all
+BENCHMARKS = None
+# print the output of the benchmarked scripts
+VERBOSE = False
+
+TAXONOMY_GENOMES = 300_000
+ANNOTATION_GENOMES = 200
+ANNOTATION_XLSX_GENOMES = 20
+PROTEINS_PER_GENOME = 3_000
+FASTANI_CLADES = 20
+FASTANI_GENOMES_PER_CLADE = 60
+SOURCE_GENOMES = 1_000
+NUM_PROCESSES = os.cpu_count()
+NUM_UPLOAD_THREADS = 16
+
+S3_BUCKET = 'cdm-benchmark'
+
+
+def _params() -> dict[str, int]:
+    return {'taxonomy_genomes': TAXONOMY_GENOMES,
+            'annotation_genomes': ANNOTATION_GENOMES,
+            'annotation_xlsx_genomes': ANNOTATION_XLSX_GENOMES,
+            'proteins_per_genome': PROTEINS_PER_GENOME,
+            'fastani_clades': FASTANI_CLADES,
+            'fastani_genomes_per_clade': FASTANI_GENOMES_PER_CLADE,
+            'source_genomes': SOURCE_GENOMES,
+            'num_processes': NUM_PROCESSES}
+
+
+def _generate_data(work_dir: Path) -> dict:
+    """Generate the synthetic inputs of all benchmarks and return their paths and the dataset sizes."""
+    data = {'work_dir': work_dir, 'params': _params()}
+
+    data['taxonomy_file'] = work_dir / 'GTDB_meta' / 'bac120_taxonomy_r214.tsv'
+    data['lineages'] = synthetic_data.write_gtdb_taxonomy(data['taxonomy_file'], TAXONOMY_GENOMES)[:3]
+
+    data['coll_root'] = work_dir / 'collections'
+    synthetic_data.write_eggnog_collection_results(data['coll_root'], 'synthetic', ANNOTATION_GENOMES,
+                                                   PROTEINS_PER_GENOME)
+    data['img_result_dir'] = synthetic_data.write_eggnog_collection_results(
+        data['coll_root'], 'IMG', ANNOTATION_XLSX_GENOMES, PROTEINS_PER_GENOME, batch_prefix='job', xlsx=True)
+
+    data['fastani_dir'] = work_dir / 'FastANI'
+    data['clade_id_file'] = work_dir / 'clade_ids.txt'
+    synthetic_data.write_fastani_results(data['fastani_dir'], data['clade_id_file'], FASTANI_CLADES,
+                                         FASTANI_GENOMES_PER_CLADE)
+
+    data['source_dir'] = work_dir / 'sourcedata' / 'NCBI' / 'NONE'
+    synthetic_data.write_ncbi_genome_tree(data['source_dir'], SOURCE_GENOMES)
+
+    return data
+
+
+def _dir_bytes(directory: Path, suffix: str = '') -> int:
+    return sum(path.stat().st_size for path in Path(directory).rglob(f'*{suffix}') if path.is_file())
+
+
+@contextlib.contextmanager
+def _mock_s3():
+    """Start moto's S3 stand-in with an empty benchmark bucket and yield a client for it."""
+    from moto import mock_aws
+
+    from scripts.utils import create_s3_client
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        s3 = create_s3_client(None, 'testing', 'testing', max_pool_connections=NUM_UPLOAD_THREADS)
+        s3.create_bucket(Bucket=S3_BUCKET)
+        yield s3
+
+
+def _seed_bucket(s3, target_files: list[tuple[Path, str]]):
+    """Upload every other target file so the planners see a half synced destination."""
+    for upload_file, s3_key in target_files[::2]:
+        s3.upload_file(str(upload_file), S3_BUCKET, s3_key)
+
+
+def _upload_all(s3, upload_files: list[tuple[Path, str]]):
+    from scripts.utils import upload_to_s3
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_UPLOAD_THREADS) as executor:
+        futures = [executor.submit(upload_to_s3, upload_file, s3_key, s3, S3_BUCKET, force=True)
+                   for upload_file, s3_key in upload_files]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+
+def bench_lineage_cold(data: dict) -> tuple[float, int, str, int]:
+    """get_genome_ids_with_lineage with the lineage index built from the taxonomy file."""
+    from scripts.utils import LINEAGE_INDEX_SUFFIX, get_genome_ids_with_lineage
+
+    taxonomy_file = data['taxonomy_file']
+    taxonomy_file.with_name(taxonomy_file.name + LINEAGE_INDEX_SUFFIX).unlink(missing_ok=True)
+    start_time = time.perf_counter()
+    get_genome_ids_with_lineage([taxonomy_file], data['lineages'])
+    elapsed = time.perf_counter() - start_time
+    return elapsed, data['params']['taxonomy_genomes'], 'genomes', taxonomy_file.stat().st_size
+
+
+def bench_lineage_cached(data: dict) -> tuple[float, int, str, int]:
+    """get_genome_ids_with_lineage served from the cached lineage index."""
+    from scripts.utils import get_genome_ids_with_lineage
+
+    taxonomy_file = data['taxonomy_file']
+    get_genome_ids_with_lineage([taxonomy_file], data['lineages'])
+    start_time = time.perf_counter()
+    get_genome_ids_with_lineage([taxonomy_file], data['lineages'])
+    elapsed = time.perf_counter() - start_time
+    return elapsed, data['params']['taxonomy_genomes'], 'genomes', taxonomy_file.stat().st_size
+
+
+def _bench_normalize_eggnog(data: dict, output_format: str) -> tuple[float, int, str, int]:
+    from scripts.norm_results import ANNOTATION_TSV_SUFFIX, normalize_eggnog_results
+
+    params = data['params']
+    result_dir = data['coll_root'] / 'collectionsdata' / 'NONE' / 'CDM' / 'synthetic' / 'eggnog'
+    input_bytes = _dir_bytes(result_dir, f'.faa.{ANNOTATION_TSV_SUFFIX}')
+    start_time = time.perf_counter()
+    normalize_eggnog_results(data['coll_root'], 'synthetic', params['num_processes'], output_format)
+    num_rows = params['annotation_genomes'] * params['proteins_per_genome']
+    return time.perf_counter() - start_time, num_rows, 'rows', input_bytes
+
+
+def bench_normalize_eggnog_csv(data: dict) -> tuple[float, int, str, int]:
+    """normalize_eggnog_results of the tab-separated annotations to CSV."""
+    return _bench_normalize_eggnog(data, 'csv')
+
+
+def bench_normalize_eggnog_parquet(data: dict) -> tuple[float, int, str, int]:
+    """normalize_eggnog_results of the tab-separated annotations to Parquet."""
+    return _bench_normalize_eggnog(data, 'parquet')
+
+
+def _bench_normalize_fastani(data: dict, output_format: str) -> tuple[float, int, str, int]:
+    from scripts.norm_results import normalize_fastani_results
+
+    output_dir = data['work_dir'] / f'fastani_{output_format}'
+    output_dir.mkdir(exist_ok=True)
+    os.chdir(output_dir)
+    start_time = time.perf_counter()
+    normalize_fastani_results(data['fastani_dir'], data['clade_id_file'], output_format)
+    num_pairs = data['params']['fastani_clades'] * data['params']['fastani_genomes_per_clade'] ** 2
+    return time.perf_counter() - start_time, num_pairs, 'pairs', _dir_bytes(data['fastani_dir'], '.txt')
+
+
+def bench_normalize_fastani_csv(data: dict) -> tuple[float, int, str, int]:
+    """normalize_fastani_results to CSV."""
+    return _bench_normalize_fastani(data, 'csv')
+
+
+def bench_normalize_fastani_parquet(data: dict) -> tuple[float, int, str, int]:
+    """normalize_fastani_results to Parquet."""
+    return _bench_normalize_fastani(data, 'parquet')
+
+
+def bench_parse_eggnog_result(data: dict) -> tuple[float, int, str, int]:
+    """parse_eggnog_result of the xlsx annotations, uploading to the S3 stand-in."""
+    from scripts import parse_eggnog_result
+
+    result_dir = data['img_result_dir']
+    parse_eggnog_result.RESULT_DIR = result_dir
+    parse_eggnog_result.PARQUET_DIR = result_dir / 'processed_parquet'
+    parse_eggnog_result.MANIFEST_FILE = result_dir / 'eggnog_upload_manifest_benchmark.sqlite'
+    parse_eggnog_result.ENDPOINT_URL = None
+    parse_eggnog_result.ACCESS_KEY = parse_eggnog_result.SECRET_KEY = 'testing'
+    parse_eggnog_result.BUCKET = S3_BUCKET
+    parse_eggnog_result.NUM_PARSE_PROCESSES = data['params']['num_processes']
+    parse_eggnog_result.MANIFEST_FILE.unlink(missing_ok=True)
+
+    input_bytes = _dir_bytes(result_dir, '.xlsx')
+    with _mock_s3():
+        start_time = time.perf_counter()
+        parse_eggnog_result.main()
+        elapsed = time.perf_counter() - start_time
+    return elapsed, data['params']['annotation_xlsx_genomes'], 'genomes', input_bytes
+
+
+def bench_genome_upload_plan(data: dict) -> tuple[float, int, str, int]:
+    """
+    Upload planning and upload of the genome import, minIO_genome_files_import: catalog lookup of the source files,
+    one listing of the destination and upload of the missing files.
+    """
+    from scripts.file_catalog import FileCatalog
+    from scripts.minIO_genome_files_import import SUFFIX
+    from scripts.utils import find_files_with_suffix, list_s3_objects, plan_s3_sync
+
+    source_dir = data['source_dir']
+    genome_ids = synthetic_data.genome_ids(data['params']['source_genomes'])
+    with _mock_s3() as s3:
+        start_time = time.perf_counter()
+        catalog = FileCatalog(source_dir, (SUFFIX,))
+        catalog.refresh(top_dirs=genome_ids)
+        target_files = [(Path(path), f'NCBI/{Path(path).name}') for genome_id in genome_ids
+                        for path in find_files_with_suffix(source_dir / genome_id, SUFFIX, catalog)]
+        plan_time = time.perf_counter() - start_time
+
+        _seed_bucket(s3, target_files)
+        start_time = time.perf_counter()
+        remote_objects = list_s3_objects(s3, S3_BUCKET, 'NCBI/')
+        new_files, changed_files, _ = plan_s3_sync(target_files, remote_objects)
+        _upload_all(s3, new_files + changed_files)
+        elapsed = plan_time + time.perf_counter() - start_time
+    return elapsed, len(target_files), 'files', sum(path.stat().st_size for path, _ in target_files)
+
+
+def bench_fastani_upload_plan(data: dict) -> tuple[float, int, str, int]:
+    """
+    Upload planning and upload of the FastANI result import, minIO_fastani_result_import: result file lookup, one
+    listing of the destination and upload of the missing files.
+    """
+    from scripts.minIO_fastani_result_import import _generate_target_files_fastani_results
+    from scripts.utils import list_s3_objects, plan_s3_sync
+
+    with _mock_s3() as s3:
+        start_time = time.perf_counter()
+        target_files = list(_generate_target_files_fastani_results(data['fastani_dir'], data['clade_id_file']))
+        plan_time = time.perf_counter() - start_time
+
+        _seed_bucket(s3, target_files)
+        start_time = time.perf_counter()
+        remote_objects = list_s3_objects(s3, S3_BUCKET, 'FastANI/Rhodanobacteraceae/')
+        new_files, changed_files, _ = plan_s3_sync(target_files, remote_objects)
+        _upload_all(s3, new_files + changed_files)
+        elapsed = plan_time + time.perf_counter() - start_time
+    return elapsed, len(target_files), 'files', sum(path.stat().st_size for path, _ in target_files)
+
+
+ALL_BENCHMARKS = {
+    'lineage_cold': bench_lineage_cold,
+    'lineage_cached': bench_lineage_cached,
+    'normalize_eggnog_csv': bench_normalize_eggnog_csv,
+    'normalize_eggnog_parquet': bench_normalize_eggnog_parquet,
+    'normalize_fastani_csv': bench_normalize_fastani_csv,
+    'normalize_fastani_parquet': bench_normalize_fastani_parquet,
+    'parse_eggnog_result': bench_parse_eggnog_result,
+    'genome_upload_plan': bench_genome_upload_plan,
+    'fastani_upload_plan': bench_fastani_upload_plan,
+}
+S3_BENCHMARKS = ('parse_eggnog_result', 'genome_upload_plan', 'fastani_upload_plan')
+
+
+def _measure(name: str, data: dict, verbose: bool) -> dict:
+    """Run a benchmark and measure it. Runs in a fresh process of its own."""
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with output:
+        elapsed, items, unit, input_bytes = ALL_BENCHMARKS[name](data)
+    # ru_maxrss is in KB on Linux, the children are the worker processes of the benchmark
+    return {'seconds': round(elapsed, 4),
+            'items': items,
+            'unit': unit,
+            'throughput': round(items / elapsed, 2),
+            'mb_per_second': round(input_bytes / elapsed / 1024 ** 2, 2),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'peak_worker_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _previous_results(results_file: Path) -> dict[str, dict]:
+    """Get the latest recorded result of every benchmark."""
+    previous = dict()
+    if results_file.exists():
+        with open(results_file, 'r') as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    previous[record['name']] = record
+    return previous
+
+
+def main():
+    try:
+        import moto  # noqa: F401
+        moto_available = True
+    except ImportError:
+        moto_available = False
+        print('moto is not installed, skipping the S3 benchmarks')
+
+    names = [name for name in (BENCHMARKS or ALL_BENCHMARKS)
+             if moto_available or name not in S3_BENCHMARKS]
+    results_file = RESULTS_FILE.resolve()
+    previous = _previous_results(results_file)
+    params = _params()
+    commit = _git_commit()
+
+    with tempfile.TemporaryDirectory(prefix='cdm_benchmark_') as work_dir:
+        start_time = time.perf_counter()
+        data = _generate_data(Path(work_dir))
+        print(f'Generated synthetic data in {time.perf_counter() - start_time:.2f}s')
+
+        print(f'{"benchmark":<26} {"seconds":>9} {"throughput":>18} {"MB/s":>8} {"RSS MB":>8} '
+              f'{"workers MB":>10} {"vs last":>8}')
+        for name in names:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                try:
+                    result = executor.submit(_measure, name, data, VERBOSE).result()
+                except Exception as e:
+                    print(f'{name:<26} failed: {e}')
+                    continue
+
+            last = previous.get(name)
+            change = f'{(result["seconds"] / last["seconds"] - 1) * 100:+.0f}%' if (
+                    last and last.get('params') == params and last['seconds']) else '-'
+            print(f'{name:<26} {result["seconds"]:>9.2f} {result["throughput"]:>12.0f} {result["unit"]:<5} '
+                  f'{result["mb_per_second"]:>8.2f} {result["peak_rss_mb"]:>8.1f} '
+                  f'{result["peak_worker_rss_mb"]:>10.1f} {change:>8}')
+
+            with open(results_file, 'a') as file:
+                file.write(json.dumps({'name': name,
+                                       'commit': commit,
+                                       'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                       **result,
+                                       'params': params}) + '\n')
+
+    print(f'Results appended to {results_file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
-import concurrent.futures
 import os
 from pathlib import Path
 
+from scripts.adaptive_executor import AdaptiveExecutor
+from scripts.metrics import Metrics
 from scripts.utils import get_genome_ids_with_lineage
 
 """
@@ -9,77 +10,174 @@ This script creates a custom collection source version for eggNOG CDM data.
 
 It creates a soft link from the NCBI source data directory to the CDM collection source directory for each genome id 
 with the specified lineage.
+
+The source genome directories and the collection source directory are each listed once with os.scandir, and the
+links to create, repair or skip are computed from those inventories in memory, so that the filesystem is only
+touched again for the actual changes. Set DRY_RUN to report the plan without making changes.
 """
 
 # update the following variables if collection, source version, and target extensions need to be changed
 COLLECTION = 'CDM'
 SOURCE_VER = 'eggNOG'
 TARGET_EXT = ['protein.faa.gz']  # available extensions: 'genomic.fna.gz', 'genomic.gbff.gz', 'protein.faa.gz'
-NUM_THREADS = 128
+# upper bound of the concurrent filesystem operations, the concurrency adapts to the observed latency below it
+MAX_THREADS = 128
+DRY_RUN = False
+# replace existing links that point somewhere other than the NCBI source genome directory
+REPAIR_LINKS = False
+LINK_ACTIONS = ('create', 'repair', 'unchanged', 'conflict', 'skipped')
 
 
-def _create_softlink_between_dirs(
-        new_dir: Path,
-        target_dir: Path,
-        extensions: list[str]
-) -> Path | None:
+def _scan_source_dir(target_dir: Path) -> list[str] | None:
     """
-    Establish a symbolic link from new_dir to target_dir, contingent on the presence of files matching the specified extensions.
-
-    return: None if the link is created successfully, otherwise the target_dir.
+    List the file names of a source genome directory with a single scandir call, None if it does not exist. Other
+    errors, e.g. a PermissionError, are raised and counted as a failure of the genome.
     """
+    try:
+        with os.scandir(target_dir) as entries:
+            return [entry.name for entry in entries]
+    except FileNotFoundError:
+        return None
 
-    files = os.listdir(target_dir)
-    # Check if all extensions have at least one corresponding file in the target directory
-    found_files = all(any(file.endswith(extension) for file in files) for extension in extensions)
-
-    if not found_files:
-        return target_dir
 
-    if os.path.exists(new_dir) and os.path.islink(new_dir) and os.readlink(new_dir) == str(target_dir):
-        return None
+def _scan_dest_dir(dest_dir: Path) -> dict[str, str | None]:
+    """
+    Inventory the collection source directory with a single scandir call.
 
-    try:
+    :return: mapping of entry name to its link target, or None for entries that are not symbolic links
+    """
+    inventory = dict()
+    with os.scandir(dest_dir) as entries:
+        for entry in entries:
+            # is_symlink uses the directory entry type and does not need a stat call
+            inventory[entry.name] = os.readlink(entry.path) if entry.is_symlink() else None
+    return inventory
+
+
+def _plan_links(
+        genome_ids: list[str],
+        source_inventory: dict[str, list[str] | None],
+        dest_inventory: dict[str, str | None],
+        new_root: Path,
+        target_root: Path,
+        extensions: list[str]
+) -> dict[str, list[tuple[Path, Path]]]:
+    """
+    Compute the links to create, repair or skip from the source and destination inventories, without touching the
+    filesystem.
+
+    :return: mapping of action to list of (new_dir, target_dir), actions are
+        create: no entry in the collection source directory
+        repair: a link pointing somewhere else
+        unchanged: a link already pointing to the source genome directory
+        conflict: an entry that is not a link, left for manual inspection
+        skipped: source genome directory missing or lacking a file for one of the extensions
+    """
+    plan = {action: list() for action in LINK_ACTIONS}
+    for genome_id in genome_ids:
+        new_dir, target_dir = new_root / genome_id, target_root / genome_id
+        files = source_inventory.get(genome_id)
+
+        # Check if all extensions have at least one corresponding file in the target directory
+        if not files or not all(any(file.endswith(extension) for file in files) for extension in extensions):
+            action = 'skipped'
+        elif genome_id not in dest_inventory:
+            action = 'create'
+        elif dest_inventory[genome_id] is None:
+            action = 'conflict'
+        elif dest_inventory[genome_id] == str(target_dir):
+            action = 'unchanged'
+        else:
+            action = 'repair'
+        plan[action].append((new_dir, target_dir))
+
+    return plan
+
+
+def _apply_link(new_dir: Path, target_dir: Path, repair: bool):
+    """Create the symbolic link from new_dir to target_dir, atomically replacing the existing link if repairing."""
+    if not repair:
         os.symlink(target_dir, new_dir, target_is_directory=True)
-        return None
-    except FileExistsError:
-        raise ValueError(f"{new_dir} already exists and does not link to {target_dir} as expected")
+        return
 
+    tmp_link = new_dir.with_name(f'.{new_dir.name}.tmp')
+    os.symlink(target_dir, tmp_link, target_is_directory=True)
+    os.replace(tmp_link, new_dir)
 
-def main():
-    meta_dir = Path('/global/homes/t/tgu/GTDB_meta')
-    taxonomy_files = [meta_dir / 'bac120_taxonomy_r214.tsv', meta_dir / 'ar53_taxonomy_r214.tsv']
-    lineages = ['c__Alphaproteobacteria']
-    lineage_genome_ids = get_genome_ids_with_lineage(taxonomy_files, lineages)
+
+def _create_collection(metrics: Metrics):
+    with metrics.stage('lineage lookup'):
+        meta_dir = Path('/global/homes/t/tgu/GTDB_meta')
+        taxonomy_files = [meta_dir / 'bac120_taxonomy_r214.tsv', meta_dir / 'ar53_taxonomy_r214.tsv']
+        lineages = ['c__Alphaproteobacteria']
+        lineage_genome_ids = get_genome_ids_with_lineage(taxonomy_files, lineages)
+    metrics.count('genomes', len(lineage_genome_ids))
 
     root = Path('/global/cfs/cdirs/kbase/collections')
     cdm_coll_src_dir = root / 'collectionssource' / 'NONE' / COLLECTION / SOURCE_VER
     cdm_coll_src_dir.mkdir(parents=True, exist_ok=True)
     ncbi_source_dir = root / 'sourcedata' / 'NCBI' / 'NONE'
 
-    skipped_dirs, failed_results = list(), list()
-    with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
-        futures = [executor.submit(_create_softlink_between_dirs,
-                                   cdm_coll_src_dir / genome_id,
-                                   ncbi_source_dir / genome_id,
-                                   TARGET_EXT) for genome_id in lineage_genome_ids]
-
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                skipped_dir = future.result()
-                skipped_dirs.append(skipped_dir) if skipped_dir else None
-            except Exception as e:
-                failed_results.append((future, f"Error: {e}"))
-                print(f"Error processing {future}: {e}")
-
-    num_successes = len(lineage_genome_ids) - len(skipped_dirs) - len(failed_results)
-    num_skipped = len(skipped_dirs)
-    num_failures = len(failed_results)
-
-    print(f"\nSummary:")
-    print(f"Successfully processed {num_successes} directories.")
-    print(f"Skipped {num_skipped} directories.")
-    print(f"Failed to process {num_failures} directories.")
+    def _timed_scan(target_dir: Path) -> list[str] | None:
+        with metrics.stage('scan source dir'):
+            files = _scan_source_dir(target_dir)
+        metrics.count('source_dirs_scanned')
+        return files
+
+    failed_results = list()
+    with metrics.stage('source inventory'):
+        executor = AdaptiveExecutor(max_workers=MAX_THREADS, metrics=metrics, name='scan')
+        source_inventory = dict()
+        for genome_id, files, error in executor.run(lambda g: _timed_scan(ncbi_source_dir / g), lineage_genome_ids):
+            if error:
+                # one unreadable directory of the shared source tree fails its genome only
+                failed_results.append((ncbi_source_dir / genome_id, f"Error: {error}"))
+                print(f"Error scanning {ncbi_source_dir / genome_id}: {error}")
+                continue
+            source_inventory[genome_id] = files
+
+    with metrics.stage('destination inventory'):
+        dest_inventory = _scan_dest_dir(cdm_coll_src_dir)
+
+    with metrics.stage('plan'):
+        plan = _plan_links([genome_id for genome_id in lineage_genome_ids if genome_id in source_inventory],
+                           source_inventory, dest_inventory, cdm_coll_src_dir, ncbi_source_dir, TARGET_EXT)
+
+    def _timed_apply(new_dir: Path, target_dir: Path, repair: bool):
+        with metrics.stage('apply link'):
+            _apply_link(new_dir, target_dir, repair)
+        metrics.count('links_repaired' if repair else 'links_created')
+
+    if not DRY_RUN:
+        changes = [(new_dir, target_dir, False) for new_dir, target_dir in plan['create']]
+        if REPAIR_LINKS:
+            changes += [(new_dir, target_dir, True) for new_dir, target_dir in plan['repair']]
+        with metrics.stage('apply'):
+            executor = AdaptiveExecutor(max_workers=MAX_THREADS, metrics=metrics, name='apply')
+            for change, _, error in executor.run(lambda c: _timed_apply(*c), changes):
+                if error:
+                    failed_results.append((change, f"Error: {error}"))
+                    print(f"Error processing {change[0]}: {error}")
+
+    print(f"\nSummary{' (dry run, no changes made)' if DRY_RUN else ''}:")
+    print(f"Links to create: {len(plan['create'])}")
+    print(f"Links to repair (pointing elsewhere): {len(plan['repair'])}"
+          f"{'' if REPAIR_LINKS else ' - not repaired, set REPAIR_LINKS to repair them'}")
+    print(f"Links already in place: {len(plan['unchanged'])}")
+    print(f"Skipped {len(plan['skipped'])} directories (missing source directory or files).")
+    print(f"Conflicts (existing entries that are not links): {len(plan['conflict'])}")
+    for action in ('repair', 'conflict'):
+        if plan[action]:
+            print(f"  {action}: {[str(new_dir) for new_dir, _ in plan[action][:10]]}")
+    print(f"Failed to process {len(failed_results)} directories.")
+
+    if plan['conflict'] or (plan['repair'] and not REPAIR_LINKS):
+        raise ValueError("Some collection source entries do not link to the source genome directories as expected")
+
+
+def main():
+    with Metrics('create_custom_collection') as metrics:
+        _create_collection(metrics)
 
 
 if __name__ == '__main__':
@@ -1,12 +1,19 @@
 """
 This script downloads IMG files from the specified S3 bucket to the local directory in NERSC.
+
+Downloads run concurrently in a thread pool sharing one S3 client and start while the bucket is still being listed.
+Files already present locally with the same size and ETag are skipped, and each download is written to a temporary
+file which is renamed into place once complete, so an interrupted run never leaves a truncated file behind.
 """
 
+import concurrent.futures
 import os
+import time
 from collections import defaultdict
 from pathlib import Path
 
-import boto3
+from scripts.metrics import Metrics
+from scripts.utils import create_s3_client, local_etag
 
 SECRET_KEY = os.environ.get('SECRET_KEY')
 ACCESS_KEY = 'cdm-admin'
@@ -19,45 +26,136 @@ SOURCE_DIR = COLL_ROOT / 'collectionssource' / 'NONE' / 'CDM' / 'IMG'
 
 FILE_SUFFIXES = ['.faa']  # ['.fna', '.gff', '.faa'] - fna and gff files are also available in the bucket
 
+NUM_THREADS = 32
+# maximum number of downloads submitted but not yet finished, bounds memory while the listing runs ahead
+MAX_PENDING = 4 * NUM_THREADS
+# compare the MD5 of existing local files against single part ETags, in addition to the size
+VERIFY_ETAG = True
 
-def main():
-    s3_client = boto3.client('s3',
-                             endpoint_url=ENDPOINT_URL,
-                             aws_access_key_id=ACCESS_KEY,
-                             aws_secret_access_key=SECRET_KEY)
+
+def _local_file_matches(local_file_path: Path, size: int, etag: str) -> bool:
+    """Check whether the local file is the same as the object, by size and, for single part objects, ETag."""
+
+    try:
+        if local_file_path.stat().st_size != size:
+            return False
+    except FileNotFoundError:
+        return False
+
+    # Multipart ETags (containing '-') are not the MD5 of the content and can't be compared
+    if VERIFY_ETAG and '-' not in etag:
+        return local_etag(local_file_path) == etag
+
+    return True
+
+
+def _download_file(s3_client, key: str, local_file_path: Path, size: int, etag: str, metrics: Metrics) -> int | None:
+    """
+    Download the object to a temporary file and atomically rename it to the local file path, unless the local file
+    is already the same as the object. The check runs in the download threads, so the local files are compared in
+    parallel and the listing never waits for them.
+
+    :return: size of the downloaded file, None if the download was skipped
+    """
+
+    with metrics.stage('local check'):
+        if _local_file_matches(local_file_path, size, etag):
+            return None
+
+    tmp_file_path = local_file_path.with_name(f'.{local_file_path.name}.part')
+    try:
+        with metrics.stage('download'):
+            s3_client.download_file(BUCKET, key, str(tmp_file_path))
+        os.replace(tmp_file_path, local_file_path)
+    except Exception:
+        tmp_file_path.unlink(missing_ok=True)
+        raise
+
+    size = local_file_path.stat().st_size
+    metrics.count('bytes_downloaded', size)
+    return size
+
+
+def _download_files(metrics: Metrics):
+    s3_client = create_s3_client(ENDPOINT_URL, ACCESS_KEY, SECRET_KEY, max_pool_connections=NUM_THREADS)
+    metrics.watch_s3_client(s3_client)
 
     paginator = s3_client.get_paginator('list_objects_v2')
     page_iterator = paginator.paginate(Bucket=BUCKET)
 
     genome_count = defaultdict(int)
-    total_files_downloaded = 0
+    created_dirs = set()
+    total_files_downloaded, total_files_skipped, total_bytes = 0, 0, 0
+    failed_keys = list()
+    start_time = time.perf_counter()
+
+    def _collect(futures):
+        nonlocal total_files_downloaded, total_files_skipped, total_bytes
+        for future in futures:
+            key, img_submission_id = pending.pop(future)
+            try:
+                size = future.result()
+            except Exception as e:
+                failed_keys.append(key)
+                metrics.count('files_failed')
+                print(f"Error downloading {key}: {e}")
+                continue
+            genome_count[img_submission_id] += 1
+            if size is None:
+                total_files_skipped += 1
+                metrics.count('files_skipped')
+            else:
+                total_bytes += size
+                total_files_downloaded += 1
+                metrics.count('files_downloaded')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+        pending = dict()
+        for page in page_iterator:
+            objs = page.get('Contents', [])
+            metrics.count('objects_listed', len(objs))
+            for obj in objs:
+                key = obj['Key']
 
-    for page in page_iterator:
-        objs = page.get('Contents', [])
-        for obj in objs:
-            key = obj['Key']
+                # Filter to download files with specified suffixes
+                if not any(key.lower().endswith(suffix.lower()) for suffix in FILE_SUFFIXES):
+                    continue
 
-            # Filter to download files with specified suffixes
-            if any(key.lower().endswith(suffix.lower()) for suffix in FILE_SUFFIXES):
                 parts = key.split('/')
                 # Assuming the structure 'bucket_name/uuid/img/submissions/IMG_submission_id/file_name' - IMG_submission_id is an integer number
                 img_submission_id = parts[-2]
                 file_name = parts[-1]
 
                 img_submission_directory = SOURCE_DIR / img_submission_id
-                os.makedirs(img_submission_directory, exist_ok=True)
+                if img_submission_directory not in created_dirs:
+                    os.makedirs(img_submission_directory, exist_ok=True)
+                    created_dirs.add(img_submission_directory)
 
                 local_file_path = img_submission_directory / file_name
+                if len(pending) >= MAX_PENDING:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    _collect(done)
+                pending[executor.submit(_download_file, s3_client, key, local_file_path, obj['Size'], obj['ETag'],
+                                        metrics)] = (key, img_submission_id)
+                metrics.gauge('pending_downloads', len(pending))
 
-                # Download the file
-                s3_client.download_file(BUCKET, key, local_file_path)
-                print(f"Downloaded {file_name} to {local_file_path}")
-
-                genome_count[img_submission_id] += 1
-                total_files_downloaded += 1
+        _collect(list(concurrent.futures.as_completed(pending)))
 
+    elapsed = time.perf_counter() - start_time
     print(f"Total files downloaded: {total_files_downloaded}")
+    print(f"Total files skipped (already downloaded): {total_files_skipped}")
+    print(f"Total files failed: {len(failed_keys)}")
     print(f"Genome count: {len(genome_count)}")
+    print(f"Downloaded {total_bytes / 1024 ** 2:.2f} MB in {elapsed:.2f}s "
+          f"({total_bytes / 1024 ** 2 / elapsed:.2f} MB/s)")
+
+    if failed_keys:
+        raise ValueError(f"Failed to download {len(failed_keys)} files, rerun to retry them: {failed_keys[:10]}")
+
+
+def main():
+    with Metrics('download_IMG_files') as metrics:
+        _download_files(metrics)
 
 
 if __name__ == '__main__':
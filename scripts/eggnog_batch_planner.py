@@ -0,0 +1,296 @@
+"""
+This script plans how to batch the genomes of a collection for eggNOG runs on a single node.
+
+The per-genome cost of eggNOG varies with the number of proteins in the genome, so splitting genomes into equally
+sized batches leaves some batches running long after others have finished (see the fastest vs. slowest batch times in
+miscellaneous/eggnog_performance.md). The planner:
+
+1. reads the protein counts and sizes of the .faa.gz inputs selected by create_custom_collection, from their faidx
+   indexes (see fasta_index.py), which are built on the first run
+2. fits a per-genome runtime model, runtime = intercept + slope * proteins, to the timings of earlier eggNOG runs
+   recorded in their eggnog_run_metadata.json files. Runs which recorded neither a run time nor their start and end
+   times are left out of the fit.
+3. scales the model to other thread counts per instance with Amdahl's law, and slows it down when the instances
+   oversubscribe the cores of the node
+4. bin-packs the genomes into batches with the longest processing time first rule and picks the parallelization x
+   threads per instance split with the smallest predicted makespan that fits in the node memory
+
+Simulation mode replays the recorded timings of an earlier run through the same schedulers, so batching strategies
+and splits can be compared offline.
+"""
+import heapq
+import json
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from scripts.create_custom_collection import COLLECTION, SOURCE_VER, TARGET_EXT
+from scripts.fasta_index import FastaIndex
+from scripts.file_catalog import FileCatalog
+from scripts.metrics import Metrics
+
+COLL_ROOT = Path('/global/cfs/cdirs/kbase/collections')
+# eggNOG results of earlier runs used to fit the runtime model
+HISTORY_LOAD_VERS = ['f__Rhodanobacteraceae']
+PLAN_FILE = Path('eggnog_batch_plan.json')
+
+# Perlmutter CPU node
+NODE_CORES = 128
+NODE_MEMORY_GB = 512
+# resident memory of one emapper instance with the eggNOG database loaded
+MEMORY_PER_INSTANCE_GB = 24
+# threads per instance used by the runs the model is fitted to, see scripts/eggNOG.md
+RECORDED_THREADS = 8
+# fraction of the emapper runtime that scales with the number of threads
+PARALLEL_FRACTION = 0.9
+
+PARALLEL_OPTIONS = (1, 2, 4, 5, 8, 10, 15, 16, 20, 32)
+THREAD_OPTIONS = (1, 2, 4, 8, 16, 32)
+
+# metadata keys which may hold the run time of a genome, in seconds
+DURATION_KEYS = ('runtime', 'run_time', 'elapsed_time', 'duration')
+# metadata keys which may hold the start and end times of the run, as epoch seconds or ISO 8601 strings
+START_TIME_KEYS = ('start_time', 'started_at')
+END_TIME_KEYS = ('end_time', 'finished_at', 'completed_at')
+METADATA_FILE = 'eggnog_run_metadata.json'
+
+SIMULATE = False
+
+
+def genome_protein_stats(faa_file: Path) -> tuple[int, int]:
+    """
+    Get the number of proteins and amino acid residues of a (gzipped) protein FASTA file from its faidx index,
+    indexing the file in one streaming pass if it has no up to date index yet.
+
+    :return: tuple of (number of proteins, number of residues)
+    """
+    return FastaIndex(faa_file).stats()
+
+
+def _timestamp(value) -> float | None:
+    """Convert a recorded time, epoch seconds or an ISO 8601 string, to epoch seconds. None if it is neither."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def _run_duration(metadata: dict) -> float | None:
+    """
+    Get the eggNOG run time of a genome in seconds from its run metadata, either a recorded run time or the difference
+    of the recorded start and end times. None if the run recorded neither: the mtimes of the output files only tell
+    when each file was last written, not when the run started.
+    """
+    for key in DURATION_KEYS:
+        if isinstance(metadata.get(key), (int, float)):
+            return float(metadata[key])
+
+    start = next((_timestamp(metadata[key]) for key in START_TIME_KEYS if key in metadata), None)
+    end = next((_timestamp(metadata[key]) for key in END_TIME_KEYS if key in metadata), None)
+    if start is None or end is None or end <= start:
+        return None
+    return end - start
+
+
+def load_recorded_runs(coll_root: Path, load_vers: list[str]) -> dict[str, tuple[float, Path]]:
+    """
+    Load the run times of earlier eggNOG runs.
+
+    :return: mapping of genome (data) ID to (run time in seconds, source file of the run)
+    """
+    runs = dict()
+    untimed = 0
+    for load_ver in load_vers:
+        result_dir = coll_root / 'collectionsdata' / 'NONE' / 'CDM' / load_ver / 'eggnog'
+        if not result_dir.is_dir():
+            print(f'No eggNOG results found at {result_dir}')
+            continue
+        for batch_dir in result_dir.iterdir():
+            if not batch_dir.is_dir():
+                continue
+            for genome_dir in batch_dir.iterdir():
+                metadata_file = genome_dir / METADATA_FILE
+                if not metadata_file.exists():
+                    continue
+                with open(metadata_file, 'r') as file:
+                    metadata = json.load(file)
+                duration = _run_duration(metadata)
+                if duration is None:
+                    untimed += 1
+                elif metadata.get('source_file'):
+                    runs[genome_dir.name] = (duration, Path(metadata['source_file']))
+    if untimed:
+        print(f'Left {untimed} runs without a recorded run time or start and end times out of the runtime model')
+    return runs
+
+
+class RuntimeModel:
+    """Predicts the eggNOG run time of a genome from its protein count."""
+
+    def __init__(self, intercept: float, slope: float):
+        """
+        :param intercept: fixed cost per genome in seconds at RECORDED_THREADS threads
+        :param slope: cost per protein in seconds at RECORDED_THREADS threads
+        """
+        self.intercept = intercept
+        self.slope = slope
+
+    @classmethod
+    def fit(cls, proteins: list[int], durations: list[float]) -> 'RuntimeModel':
+        """Fit the model to recorded runs by least squares."""
+        if len(proteins) < 2:
+            raise ValueError('At least two recorded runs are needed to fit the runtime model')
+        slope, intercept = np.polyfit(np.asarray(proteins, dtype=float), np.asarray(durations, dtype=float), 1)
+        return cls(max(float(intercept), 0.0), max(float(slope), 0.0))
+
+    def predict(self, num_proteins: int, threads: int = RECORDED_THREADS) -> float:
+        """Predict the run time of a genome in seconds with the given threads per instance, on an idle node."""
+        return (self.intercept + self.slope * num_proteins) * _speedup(RECORDED_THREADS) / _speedup(threads)
+
+
+def _speedup(threads: int) -> float:
+    """Amdahl's law speedup of an instance over a single thread."""
+    return 1 / ((1 - PARALLEL_FRACTION) + PARALLEL_FRACTION / threads)
+
+
+def _contention(parallel: int, threads: int) -> float:
+    """Slowdown factor when the instances on the node use more threads than it has cores."""
+    return max(1.0, parallel * threads / NODE_CORES)
+
+
+def lpt_batches(costs: dict[str, float], num_batches: int) -> list[list[str]]:
+    """
+    Bin-pack genomes into batches with the longest processing time first rule: genomes are assigned in decreasing
+    order of cost to the batch with the smallest total cost so far.
+
+    :param costs: mapping of genome ID to its cost
+    :param num_batches: number of batches
+
+    :return: list of batches, each a list of genome IDs
+    """
+    batches = [list() for _ in range(num_batches)]
+    heap = [(0.0, i) for i in range(num_batches)]
+    for genome_id in sorted(costs, key=costs.get, reverse=True):
+        total, i = heapq.heappop(heap)
+        batches[i].append(genome_id)
+        heapq.heappush(heap, (total + costs[genome_id], i))
+    return batches
+
+
+def sequential_batches(costs: dict[str, float], num_batches: int) -> list[list[str]]:
+    """Split genomes into contiguous batches of equal count, as when batching by genome count alone."""
+    genome_ids = list(costs)
+    if not genome_ids:
+        return list()
+    size = -(-len(genome_ids) // num_batches)
+    return [genome_ids[i:i + size] for i in range(0, len(genome_ids), size)]
+
+
+def makespan(batches: list[list[str]], costs: dict[str, float]) -> float:
+    """Time until the slowest batch finishes."""
+    return max((sum(costs[genome_id] for genome_id in batch) for batch in batches), default=0.0)
+
+
+def plan_splits(
+        proteins: dict[str, int],
+        model: RuntimeModel
+) -> list[tuple[float, int, int, list[list[str]]]]:
+    """
+    Predict the makespan of every parallelization x threads per instance split that fits in the node memory.
+
+    :param proteins: mapping of genome ID to its protein count
+    :param model: runtime model
+
+    :return: list of (predicted makespan in seconds, parallelization, threads, batches), fastest first
+    """
+    max_parallel = NODE_MEMORY_GB // MEMORY_PER_INSTANCE_GB
+    candidates = list()
+    for parallel in PARALLEL_OPTIONS:
+        if parallel > max_parallel:
+            continue
+        for threads in THREAD_OPTIONS:
+            slowdown = _contention(parallel, threads)
+            costs = {genome_id: model.predict(count, threads) * slowdown for genome_id, count in proteins.items()}
+            batches = lpt_batches(costs, parallel)
+            candidates.append((makespan(batches, costs), parallel, threads, batches))
+
+    return sorted(candidates, key=lambda candidate: candidate[0])
+
+
+def simulate(recorded_durations: dict[str, float]):
+    """
+    Replay recorded per-genome run times through the schedulers and print the makespan of each batching strategy
+    for every parallelization, at the thread count of the recorded runs.
+    """
+    if not recorded_durations:
+        raise ValueError(f'No recorded eggNOG runs to replay in the loads {HISTORY_LOAD_VERS}')
+    print(f'Replaying {len(recorded_durations)} recorded runs, {sum(recorded_durations.values()) / 60:.1f} '
+          f'total minutes at {RECORDED_THREADS} threads per instance')
+    print(f'{"parallel":>8} {"sequential (min)":>17} {"lpt (min)":>10}')
+    for parallel in PARALLEL_OPTIONS:
+        slowdown = _contention(parallel, RECORDED_THREADS)
+        costs = {genome_id: duration * slowdown for genome_id, duration in recorded_durations.items()}
+        print(f'{parallel:>8} {makespan(sequential_batches(costs, parallel), costs) / 60:>17.2f} '
+              f'{makespan(lpt_batches(costs, parallel), costs) / 60:>10.2f}')
+
+
+def _plan(metrics: Metrics):
+    with metrics.stage('load recorded runs'):
+        recorded_runs = load_recorded_runs(COLL_ROOT, HISTORY_LOAD_VERS)
+    metrics.count('recorded_runs', len(recorded_runs))
+    if SIMULATE:
+        simulate({genome_id: duration for genome_id, (duration, _) in recorded_runs.items()})
+        return
+
+    coll_src_dir = COLL_ROOT / 'collectionssource' / 'NONE' / COLLECTION / SOURCE_VER
+    with metrics.stage('catalog refresh'):
+        catalog = FileCatalog(coll_src_dir, tuple(TARGET_EXT))
+        catalog.refresh()
+    faa_files = {path.relative_to(coll_src_dir).parts[0]: (path, size)
+                 for path, size, _ in catalog.files(tuple(TARGET_EXT))}
+    proteins = dict()
+    for genome_id, (faa_file, size) in faa_files.items():
+        with metrics.stage('protein stats'):
+            proteins[genome_id] = genome_protein_stats(faa_file)[0]
+        metrics.count('bytes_read', size)
+
+    fit_proteins, fit_durations = list(), list()
+    for genome_id, (duration, source_file) in recorded_runs.items():
+        count = proteins.get(genome_id)
+        if count is None and source_file.exists():
+            count = genome_protein_stats(source_file)[0]
+        if count is not None:
+            fit_proteins.append(count)
+            fit_durations.append(duration)
+    with metrics.stage('fit'):
+        model = RuntimeModel.fit(fit_proteins, fit_durations)
+    print(f'Runtime model from {len(fit_proteins)} recorded runs at {RECORDED_THREADS} threads: '
+          f'{model.intercept:.1f}s + {model.slope * 1000:.2f}s per 1000 proteins')
+
+    with metrics.stage('plan'):
+        candidates = plan_splits(proteins, model)
+    print(f'{"parallel":>8} {"threads":>7} {"makespan (min)":>14}')
+    for predicted, parallel, threads, _ in candidates[:10]:
+        print(f'{parallel:>8} {threads:>7} {predicted / 60:>14.2f}')
+
+    predicted, parallel, threads, batches = candidates[0]
+    with open(PLAN_FILE, 'w') as file:
+        json.dump({'parallel': parallel,
+                   'threads': threads,
+                   'predicted_makespan_minutes': round(predicted / 60, 2),
+                   'batches': batches}, file, indent=2)
+    print(f'Plan for {len(proteins)} genomes with {parallel} x {threads} threads written to {PLAN_FILE}')
+
+
+def main():
+    with Metrics('eggnog_batch_planner') as metrics:
+        _plan(metrics)
+
+
+if __name__ == '__main__':
+    main()
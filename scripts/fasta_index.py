@@ -0,0 +1,299 @@
+"""
+Random access to the records of protein FASTA files (.faa, .faa.gz) through a samtools faidx compatible index.
+
+The index is built in one streaming pass over the file and saved next to it as <file>.fai, one line per record with
+the protein ID, sequence length, offset of the sequence in the uncompressed file, residues per line and bytes per
+line. Later uses load the saved index unless the file is newer than the index, so the protein count and residue count
+of a genome come from the index instead of a decompression of the whole file. When the directory of the file is
+read-only, as for the NCBI source directories, the index is saved to INDEX_CACHE_DIR instead, under a name made from
+the path and modification time of the file, so it is still built only once.
+
+Gzip streams can only be read from the start, so looking up a protein of a plain gzip file decompresses the file up to
+the record. For true random access the file can be recompressed with compress_bgzf to BGZF, the block gzip format of
+samtools and bgzip: a series of gzip members of at most 64 KB each, which is still a valid gzip file for gzip.open and
+zcat. The start of every block is saved to <file>.gzi, so a lookup decompresses a single block.
+"""
+import bisect
+import gzip
+import hashlib
+import os
+import struct
+import zlib
+from pathlib import Path
+
+FAI_SUFFIX = '.fai'
+GZI_SUFFIX = '.gzi'
+# writable directory for the indexes of files in read-only directories
+INDEX_CACHE_DIR = Path(os.environ.get('SCRATCH', '/tmp')) / 'cdm_fasta_index'
+# maximum uncompressed bytes per BGZF block, as written by bgzip
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_COMPRESS_LEVEL = 6
+# the empty block bgzip writes at the end of a BGZF file
+_BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def read_fasta(faa_file: Path):
+    """
+    Read a (gzipped) protein FASTA file in one streaming pass.
+
+    :return: generator of (protein ID, sequence) with the sequence as bytes
+    """
+    opener = gzip.open if str(faa_file).endswith('.gz') else open
+    protein_id, lines = None, list()
+    with opener(faa_file, 'rb') as file:
+        for line in file:
+            if line.startswith(b'>'):
+                if protein_id is not None:
+                    yield protein_id, b''.join(lines)
+                protein_id, lines = line[1:].split(maxsplit=1)[0].decode(), list()
+            else:
+                lines.append(line.strip())
+    if protein_id is not None:
+        yield protein_id, b''.join(lines)
+
+
+def _bgzf_block_size(header: bytes) -> int | None:
+    """Get the total size of a BGZF block from its header, None if the header is not a BGZF block header."""
+    if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04':
+        return None
+    extra_len = struct.unpack('<H', header[10:12])[0]
+    extra = header[12:12 + extra_len]
+    pos = 0
+    while pos + 4 <= len(extra):
+        sub_len = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == b'BC' and sub_len == 2:
+            return struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + sub_len
+    return None
+
+
+def bgzf_blocks(gz_file: Path) -> list[tuple[int, int]] | None:
+    """
+    Get the start of every block of a BGZF file from the block headers, without decompressing the blocks.
+
+    :return: list of (compressed offset, uncompressed offset) of each block, None if the file is not BGZF
+    """
+    blocks = list()
+    compressed, uncompressed = 0, 0
+    size = os.path.getsize(gz_file)
+    with open(gz_file, 'rb') as file:
+        while compressed < size:
+            file.seek(compressed)
+            block_size = _bgzf_block_size(file.read(18 + 6))
+            if block_size is None:
+                return None
+            file.seek(compressed + block_size - 4)
+            blocks.append((compressed, uncompressed))
+            compressed += block_size
+            uncompressed += struct.unpack('<I', file.read(4))[0]
+    return blocks
+
+
+def _write_gzi(gzi_file: Path, blocks: list[tuple[int, int]]):
+    """Write the block offsets in the samtools .gzi format, which leaves out the first block at (0, 0)."""
+    with open(gzi_file, 'wb') as file:
+        file.write(struct.pack('<Q', len(blocks) - 1))
+        for compressed, uncompressed in blocks[1:]:
+            file.write(struct.pack('<QQ', compressed, uncompressed))
+
+
+def _read_gzi(gzi_file: Path) -> list[tuple[int, int]]:
+    with open(gzi_file, 'rb') as file:
+        num_blocks = struct.unpack('<Q', file.read(8))[0]
+        data = file.read(16 * num_blocks)
+    return [(0, 0)] + [struct.unpack('<QQ', data[i:i + 16]) for i in range(0, len(data), 16)]
+
+
+def compress_bgzf(source_file: Path, output_file: Path | None = None) -> Path:
+    """
+    Compress a FASTA file, plain or gzipped, to BGZF and index it.
+
+    :param source_file: FASTA file to compress
+    :param output_file: BGZF file to write, by default <source file>.gz for plain files and the source file itself,
+        replaced once complete, for gzipped files
+
+    :return: the BGZF file
+    """
+    source_file = Path(source_file)
+    if output_file is None:
+        output_file = source_file if source_file.name.endswith('.gz') else Path(f'{source_file}.gz')
+    tmp_file = output_file.with_name(f'{output_file.name}.{os.getpid()}.tmp')
+    opener = gzip.open if source_file.name.endswith('.gz') else open
+
+    blocks, compressed, uncompressed = list(), 0, 0
+    with opener(source_file, 'rb') as source, open(tmp_file, 'wb') as output:
+        while data := source.read(BGZF_BLOCK_SIZE):
+            compressor = zlib.compressobj(BGZF_COMPRESS_LEVEL, zlib.DEFLATED, -15)
+            cdata = compressor.compress(data) + compressor.flush()
+            block = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+                     + struct.pack('<H', len(cdata) + 25) + cdata
+                     + struct.pack('<II', zlib.crc32(data), len(data)))
+            output.write(block)
+            blocks.append((compressed, uncompressed))
+            compressed += len(block)
+            uncompressed += len(data)
+        output.write(_BGZF_EOF)
+    os.replace(tmp_file, output_file)
+
+    _write_gzi(Path(f'{output_file}{GZI_SUFFIX}'), blocks or [(0, 0)])
+    FastaIndex(output_file, rebuild=True)
+    return output_file
+
+
+class FastaIndex:
+    """
+    faidx index of a plain, gzipped or BGZF protein FASTA file, giving the protein count, residue count and the
+    sequence of any protein.
+    """
+
+    def __init__(self, faa_file: Path, rebuild: bool = False):
+        """
+        :param faa_file: the FASTA file
+        :param rebuild: rebuild the index even if a saved index is up to date
+        """
+        self.faa_file = Path(faa_file)
+        self.index_file = Path(f'{self.faa_file}{FAI_SUFFIX}')
+        self.gzi_file = Path(f'{self.faa_file}{GZI_SUFFIX}')
+        self.compressed = self.faa_file.name.endswith('.gz')
+        # protein ID -> (sequence length, offset of the sequence, residues per line, bytes per line)
+        self.records = dict()
+
+        if not rebuild and (index_file := self._find_current(self.index_file)) is not None:
+            self._load(index_file)
+        else:
+            self._build()
+        self._blocks = None
+        if self.compressed:
+            if (gzi_file := self._find_current(self.gzi_file)) is not None:
+                self._blocks = _read_gzi(gzi_file)
+            elif (blocks := bgzf_blocks(self.faa_file)) is not None:
+                self._blocks = blocks
+                self._save(self.gzi_file, lambda path: _write_gzi(path, blocks))
+
+    def _is_current(self, index_file: Path) -> bool:
+        try:
+            return index_file.stat().st_mtime_ns >= self.faa_file.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def _cached_file(self, index_file: Path) -> Path:
+        """Get the path of an index in INDEX_CACHE_DIR, a new path whenever the FASTA file is moved or modified."""
+        source = self.faa_file.resolve()
+        key = hashlib.sha256(f'{source}\0{source.stat().st_mtime_ns}'.encode()).hexdigest()[:16]
+        return INDEX_CACHE_DIR / f'{key}.{index_file.name}'
+
+    def _find_current(self, index_file: Path) -> Path | None:
+        """Find an up to date index next to the FASTA file or in INDEX_CACHE_DIR."""
+        for path in (index_file, self._cached_file(index_file)):
+            if self._is_current(path):
+                return path
+        return None
+
+    def _load(self, index_file: Path):
+        with open(index_file, 'r') as file:
+            for line in file:
+                protein_id, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')
+                self.records[protein_id] = (int(length), int(offset), int(line_bases), int(line_width))
+
+    def _build(self):
+        """Index the file in one streaming pass, recording the offsets in the uncompressed file."""
+        opener = gzip.open if self.compressed else open
+        protein_id, length, offset, line_bases, line_width = None, 0, 0, 0, 0
+        position = 0
+        with opener(self.faa_file, 'rb') as file:
+            for line in file:
+                position += len(line)
+                if line.startswith(b'>'):
+                    if protein_id is not None:
+                        self.records[protein_id] = (length, offset, line_bases, line_width)
+                    protein_id = line[1:].split(maxsplit=1)[0].decode()
+                    length, offset, line_bases, line_width = 0, position, 0, 0
+                elif protein_id is not None:
+                    bases = len(line.rstrip(b'\r\n'))
+                    if not line_width:
+                        line_bases, line_width = bases, len(line)
+                    length += bases
+        if protein_id is not None:
+            self.records[protein_id] = (length, offset, line_bases, line_width)
+        self._save(self.index_file, self._write)
+
+    def _write(self, index_file: Path):
+        with open(index_file, 'w') as file:
+            file.writelines(f'{protein_id}\t{length}\t{offset}\t{line_bases}\t{line_width}\n'
+                            for protein_id, (length, offset, line_bases, line_width) in self.records.items())
+
+    def _save(self, index_file: Path, write):
+        """
+        Save an index next to the FASTA file, or to INDEX_CACHE_DIR if the directory is read-only. The index is kept in
+        memory only if neither can be written.
+
+        :param index_file: the index file next to the FASTA file
+        :param write: function writing the index to the path it is given
+        """
+        try:
+            write(index_file)
+            return
+        except OSError:
+            pass
+        cached_file = self._cached_file(index_file)
+        try:
+            cached_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cached_file.with_name(f'{cached_file.name}.{os.getpid()}.tmp')
+            write(tmp_file)
+            os.replace(tmp_file, cached_file)
+        except OSError as e:
+            print(f'Unable to save the index of {self.faa_file}: {e}')
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, protein_id: str) -> bool:
+        return protein_id in self.records
+
+    @property
+    def num_residues(self) -> int:
+        return sum(length for length, _, _, _ in self.records.values())
+
+    def stats(self) -> tuple[int, int]:
+        """
+        :return: tuple of (number of proteins, number of residues)
+        """
+        return len(self.records), self.num_residues
+
+    def _open_at(self, offset: int):
+        """Open the uncompressed file positioned at the offset, starting from the enclosing block of a BGZF file."""
+        if not self.compressed:
+            file = open(self.faa_file, 'rb')
+            file.seek(offset)
+            return file
+        if self._blocks is None:
+            # plain gzip, decompress up to the offset
+            file = gzip.open(self.faa_file, 'rb')
+            file.seek(offset)
+            return file
+        i = bisect.bisect_right(self._blocks, offset, key=lambda block: block[1]) - 1
+        compressed, uncompressed = self._blocks[i]
+        raw = open(self.faa_file, 'rb')
+        raw.seek(compressed)
+        file = gzip.GzipFile(fileobj=raw, mode='rb')
+        file.seek(offset - uncompressed)
+        # close the underlying file with the gzip reader
+        file.myfileobj = raw
+        return file
+
+    def fetch(self, protein_id: str) -> str:
+        """Get the sequence of a protein."""
+        try:
+            length, offset, _, _ = self.records[protein_id]
+        except KeyError:
+            raise ValueError(f'Protein {protein_id} not found in {self.faa_file}') from None
+        parts, remaining = list(), length
+        with self._open_at(offset) as file:
+            while remaining > 0:
+                line = file.readline()
+                if not line or line.startswith(b'>'):
+                    break
+                line = line.strip()
+                parts.append(line)
+                remaining -= len(line)
+        return b''.join(parts).decode()[:length]
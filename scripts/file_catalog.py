@@ -0,0 +1,174 @@
+"""
+A file catalog of a source directory tree, recording the path, size and mtime of the files with the suffixes of
+interest, so that suffix queries are answered from memory instead of walking the shared filesystem once per genome.
+
+The tree is scanned once, in parallel across the top-level directories (e.g. one per genome), and the catalog is
+saved to an on-disk index. Later runs refresh the index incrementally: a directory whose mtime is unchanged reuses
+its recorded listing, so a refresh costs one stat per directory rather than a listing of every directory and a stat
+of every file. A directory mtime only changes when entries are added, removed or renamed in it, so files rewritten
+in place keep their recorded size and mtime until a full refresh.
+
+Each set of suffixes has an index of its own, named after a hash of the suffixes, so callers cataloging the same tree
+for different suffixes (e.g. the genome import and the collection staging) do not overwrite each other's index.
+"""
+import concurrent.futures
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+CATALOG_SUFFIX = '.file_catalog.pkl'
+CATALOG_VERSION = 1
+NUM_THREADS = 32
+
+
+class FileCatalog:
+    """
+    Catalog of the files with the specified suffixes under a root directory.
+
+    Top-level entries of the root that are symbolic links (e.g. genome directories of a collection source) are
+    followed, deeper symbolic links are not, as with os.walk.
+    """
+
+    def __init__(
+            self,
+            root: Path,
+            suffixes: tuple[str, ...],
+            index_file: Path | None = None,
+            num_threads: int = NUM_THREADS):
+        """
+        :param root: root directory of the tree
+        :param suffixes: suffixes of the files to record
+        :param index_file: path of the on-disk index, defaults to .<root name>.<suffixes hash>.file_catalog.pkl next
+            to the root
+        :param num_threads: number of threads scanning top-level directories in parallel
+        """
+        self.root = Path(root)
+        self.suffixes = tuple(sorted(set(suffixes)))
+        suffixes_hash = hashlib.sha256('\0'.join(self.suffixes).encode()).hexdigest()[:12]
+        self.index_file = Path(index_file) if index_file else (
+                self.root.parent / f'.{self.root.name}.{suffixes_hash}{CATALOG_SUFFIX}')
+        self.num_threads = num_threads
+        # top-level directory name -> {relative directory path -> (mtime_ns, subdirectory names,
+        #                                                           [(file name, size, mtime_ns)])}
+        self._trees = dict()
+        self._load()
+
+    def _signature(self):
+        return CATALOG_VERSION, str(self.root), self.suffixes
+
+    def _load(self):
+        try:
+            with open(self.index_file, 'rb') as file:
+                signature, trees = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return
+        if signature == self._signature():
+            self._trees = trees
+
+    def save(self):
+        """Save the catalog to the on-disk index."""
+        tmp_file = self.index_file.with_name(f'{self.index_file.name}.{os.getpid()}.tmp')
+        try:
+            with open(tmp_file, 'wb') as file:
+                pickle.dump((self._signature(), self._trees), file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            print(f'Unable to write file catalog index {self.index_file}: {e}')
+            tmp_file.unlink(missing_ok=True)
+
+    def _scan_tree(self, rel_top: str, full: bool) -> dict[str, tuple[int, list[str], list[tuple[str, int, int]]]]:
+        """Scan the tree of a top-level directory, reusing the recorded listing of directories with unchanged mtime."""
+        recorded_tree, dirs = self._trees.get(rel_top, {}), dict()
+        stack = [rel_top]
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                dir_mtime_ns = os.stat(self.root / rel_dir).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+            recorded = recorded_tree.get(rel_dir)
+            if not full and recorded and recorded[0] == dir_mtime_ns:
+                subdirs, files = recorded[1], recorded[2]
+            else:
+                subdirs, files = list(), list()
+                try:
+                    with os.scandir(self.root / rel_dir) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.name)
+                            elif entry.name.endswith(self.suffixes) and entry.is_file():
+                                stat = entry.stat()
+                                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+
+            dirs[rel_dir] = (dir_mtime_ns, subdirs, files)
+            stack.extend(os.path.join(rel_dir, subdir) for subdir in subdirs)
+
+        return dirs
+
+    def refresh(self, top_dirs: list[str] | None = None, full: bool = False, save: bool = True):
+        """
+        Bring the catalog up to date with the filesystem.
+
+        :param top_dirs: names of the top-level directories to refresh, e.g. the genome IDs of interest. Defaults to
+            every directory in the root, in which case directories removed from the root are dropped from the catalog.
+        :param full: rescan every directory regardless of its mtime
+        :param save: save the refreshed catalog to the on-disk index
+        """
+        if top_dirs is None:
+            with os.scandir(self.root) as entries:
+                top_dirs = [entry.name for entry in entries if entry.is_dir()]
+            self._trees = {top_dir: self._trees[top_dir] for top_dir in top_dirs if top_dir in self._trees}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            futures = {executor.submit(self._scan_tree, top_dir, full): top_dir for top_dir in top_dirs}
+            for future in concurrent.futures.as_completed(futures):
+                self._trees[futures[future]] = future.result()
+
+        if save:
+            self.save()
+
+    def refresh_dir(self, top_dir: str, full: bool = False):
+        """
+        Bring a single top-level directory up to date, without saving the index. Used to interleave the scan with
+        processing of the files found, e.g. when streaming over genome directories; call save() once done. Different
+        directories may be refreshed concurrently from several threads.
+
+        :param top_dir: name of the top-level directory
+        :param full: rescan every directory regardless of its mtime
+        """
+        self._trees[top_dir] = self._scan_tree(top_dir, full)
+
+    def files(self, suffix: str | tuple[str, ...], under: str | Path | None = None) -> list[tuple[Path, int, int]]:
+        """
+        Get the recorded files with the suffix.
+
+        :param suffix: suffix, or tuple of suffixes, of the files
+        :param under: only return files under this directory, given as a path under the root or relative to it
+
+        :return: list of (file path, size, mtime_ns)
+        """
+        if under is not None:
+            under = Path(under)
+            try:
+                rel_under = str(under.relative_to(self.root))
+            except ValueError:
+                rel_under = str(under)
+        if under is not None and rel_under != '.':
+            tree = self._trees.get(rel_under.split(os.sep, 1)[0], {})
+            prefix = rel_under + os.sep
+            listings = [(rel_dir, listing) for rel_dir, listing in tree.items()
+                        if rel_dir == rel_under or rel_dir.startswith(prefix)]
+        else:
+            listings = [(rel_dir, listing) for tree in self._trees.values() for rel_dir, listing in tree.items()]
+
+        return [(self.root / rel_dir / name, size, mtime_ns)
+                for rel_dir, (_, _, files) in listings
+                for name, size, mtime_ns in files if name.endswith(suffix)]
+
+    def find(self, suffix: str | tuple[str, ...], under: str | Path | None = None) -> list[str]:
+        """Find the paths of the recorded files with the suffix, see files()."""
+        return [str(path) for path, _, _ in self.files(suffix, under)]
@@ -0,0 +1,289 @@
+"""
+Shared instrumentation for the scripts in this directory.
+
+A Metrics instance records, per stage of a run (e.g. listing, HEAD checks, parsing, uploading):
+- the latency of every operation of the stage, with stage() or observe(). The count, total and maximum are exact,
+  the percentiles are computed from a uniform sample of at most LATENCY_SAMPLE_SIZE latencies per stage, so long runs
+  keep a bounded memory
+- counters, e.g. files scanned, bytes read or uploaded, rows parsed, retries, with count()
+- gauges, e.g. queue depths, with gauge()
+
+When the run ends a summary with the p50/p90/p99 latency per stage is printed. If a metrics directory is set, every
+observation is also appended to a JSON-lines metrics log, <METRICS_DIR>/<run>_<timestamp>_<pid>.metrics.jsonl, with a
+snapshot of all counters and gauges every PROGRESS_INTERVAL seconds, so a stalled run can be diagnosed while it is
+still going, e.g. with `tail -f`, and the summary is written to the log.
+
+The log directory and an optional profiler are switched per run with environment variables:
+    CDM_METRICS_DIR  directory of the metrics logs, no log is written unless it is set
+    CDM_PROFILE      'cprofile' to write a cProfile profile next to the log, or 'tracemalloc' to print the top memory
+                     allocation sites and the peak traced memory at the end of the run
+
+Recording is thread safe. Worker processes return their own timings to the main process, which records them with
+observe(). Functions called without the metrics of a run record to NULL_METRICS, which discards everything.
+"""
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+METRICS_DIR = os.environ.get('CDM_METRICS_DIR') or None
+PROFILE = os.environ.get('CDM_PROFILE') or None
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+# seconds between the counter and gauge snapshots written to the log
+PROGRESS_INTERVAL = 10
+# minimum seconds between log records of the same gauge
+GAUGE_LOG_INTERVAL = 1
+PERCENTILES = (50, 90, 99)
+# latencies kept per stage for the percentiles, a uniform sample is kept once a stage has more
+LATENCY_SAMPLE_SIZE = 10000
+TRACEMALLOC_TOP = 20
+
+
+def _percentile(sorted_values: list[float], percent: int) -> float:
+    """Nearest rank percentile of sorted values."""
+    rank = -(-len(sorted_values) * percent // 100)
+    return sorted_values[max(rank, 1) - 1]
+
+
+class _LatencyStats:
+    """Exact count, total and maximum of the latencies of a stage, with a reservoir sample of them."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.sample = list()
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.sample) < LATENCY_SAMPLE_SIZE:
+            self.sample.append(seconds)
+        else:
+            # reservoir sampling, each latency seen so far is kept with the same probability
+            index = random.randrange(self.count)
+            if index < LATENCY_SAMPLE_SIZE:
+                self.sample[index] = seconds
+
+
+class Metrics:
+    """Stage timers, counters and gauges of a run, logged as JSON lines. Use as a context manager around the run."""
+
+    def __init__(self, run_name: str, metrics_dir: str | Path | None = METRICS_DIR, profile: str | None = PROFILE):
+        """
+        :param run_name: name of the run, e.g. the script name
+        :param metrics_dir: directory of the metrics log, None or empty to keep the metrics in memory only
+        :param profile: None, 'cprofile' or 'tracemalloc'
+        """
+        if profile is not None and profile not in PROFILE_MODES:
+            raise ValueError(f'Invalid profile mode {profile}, must be one of {PROFILE_MODES}')
+        self.run_name = run_name
+        self.profile = profile
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(_LatencyStats)
+        self._counters = defaultdict(int)
+        # gauge name -> [last value, max value]
+        self._gauges = dict()
+        self._gauge_logged = dict()
+        self._start_time = time.perf_counter()
+        self._last_progress = self._start_time
+        self._profiler = None
+
+        self.log_file, self._log = None, None
+        if metrics_dir:
+            stamp = time.strftime('%Y%m%dT%H%M%S')
+            self.log_file = Path(metrics_dir) / f'{run_name}_{stamp}_{os.getpid()}.metrics.jsonl'
+            try:
+                self.log_file.parent.mkdir(parents=True, exist_ok=True)
+                self._log = open(self.log_file, 'a', buffering=1)
+            except OSError as e:
+                # metrics are diagnostics only, e.g. the working directory may be read-only
+                print(f'Unable to write metrics log {self.log_file}: {e}')
+                self.log_file = None
+
+    def _emit(self, event: str, **fields):
+        """Append a record to the log. Called with the lock held."""
+        if self._log is None:
+            return
+        record = {'ts': round(time.time(), 3),
+                  'elapsed': round(time.perf_counter() - self._start_time, 3),
+                  'run': self.run_name,
+                  'event': event,
+                  **fields}
+        self._log.write(json.dumps(record) + '\n')
+
+    def _maybe_emit_progress(self):
+        """Write a snapshot of the counters and gauges if PROGRESS_INTERVAL has passed. Called with the lock held."""
+        now = time.perf_counter()
+        if now - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = now
+            self._emit('progress', counters=dict(self._counters),
+                       gauges={name: last for name, (last, _) in self._gauges.items()})
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the enclosed block as one operation of the stage. Failed operations are counted as <name>.errors."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.count(f'{name}.errors')
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start_time)
+
+    def observe(self, name: str, seconds: float):
+        """Record the latency of one operation of the stage."""
+        with self._lock:
+            self._latencies[name].add(seconds)
+            self._emit('stage', stage=name, seconds=round(seconds, 6))
+            self._maybe_emit_progress()
+
+    def count(self, name: str, value: int = 1):
+        """Add to a counter."""
+        with self._lock:
+            self._counters[name] += value
+            self._maybe_emit_progress()
+
+    def gauge(self, name: str, value: float):
+        """Set a gauge, e.g. the current depth of a queue. The maximum value is kept for the summary."""
+        with self._lock:
+            if name in self._gauges:
+                self._gauges[name] = [value, max(value, self._gauges[name][1])]
+            else:
+                self._gauges[name] = [value, value]
+            now = time.perf_counter()
+            if now - self._gauge_logged.get(name, 0) >= GAUGE_LOG_INTERVAL:
+                self._gauge_logged[name] = now
+                self._emit('gauge', gauge=name, value=value)
+            self._maybe_emit_progress()
+
+    def counter(self, name: str) -> int:
+        """Get the value of a counter."""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def watch_s3_client(self, s3_client):
+        """
+        Record the latency of every request of the boto3 S3 client as the stage s3.<operation>, e.g. s3.HeadObject,
+        and count the requests and the retries made by botocore, including those of managed transfers.
+        """
+        def _before_call(context, **kwargs):
+            context['metrics_start_time'] = time.perf_counter()
+
+        def _after_call(context, parsed, model, **kwargs):
+            if 'metrics_start_time' in context:
+                self.observe(f's3.{model.name}', time.perf_counter() - context['metrics_start_time'])
+            self.count('s3_requests')
+            retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            if retries:
+                self.count('s3_retries', retries)
+
+        s3_client.meta.events.register('before-call.s3', _before_call)
+        s3_client.meta.events.register('after-call.s3', _after_call)
+
+    def summary(self) -> dict:
+        """
+        Summarize the run.
+
+        :return: dict of elapsed seconds, per stage latency statistics (count, total, percentiles and max in seconds),
+            counters and gauges (last and max value)
+        """
+        with self._lock:
+            stages = dict()
+            for name, latencies in self._latencies.items():
+                values = sorted(latencies.sample)
+                stages[name] = {'count': latencies.count, 'total': round(latencies.total, 6)}
+                stages[name].update({f'p{percent}': round(_percentile(values, percent), 6)
+                                     for percent in PERCENTILES})
+                stages[name]['max'] = round(latencies.max, 6)
+            return {'elapsed': round(time.perf_counter() - self._start_time, 3),
+                    'stages': stages,
+                    'counters': dict(self._counters),
+                    'gauges': {name: {'last': last, 'max': maximum} for name, (last, maximum) in self._gauges.items()}}
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f'\nMetrics of {self.run_name} ({summary["elapsed"]:.2f}s):')
+        if summary['stages']:
+            print(f'  {"stage":<28} {"count":>8} {"total s":>10}'
+                  + ''.join(f' {f"p{percent} ms":>10}' for percent in PERCENTILES) + f' {"max ms":>10}')
+            for name, stats in summary['stages'].items():
+                print(f'  {name:<28} {stats["count"]:>8} {stats["total"]:>10.2f}'
+                      + ''.join(f' {stats[f"p{percent}"] * 1000:>10.1f}' for percent in PERCENTILES)
+                      + f' {stats["max"] * 1000:>10.1f}')
+        for name, value in summary['counters'].items():
+            print(f'  {name}: {value}')
+        for name, values in summary['gauges'].items():
+            print(f'  {name}: last {values["last"]}, max {values["max"]}')
+        if self.log_file:
+            print(f'  metrics log: {self.log_file}')
+
+    def close(self):
+        """Stop the profiler, write the summary to the log and print it."""
+        self._stop_profiler()
+        summary = self.summary()
+        with self._lock:
+            self._emit('summary', **summary)
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+        self.print_summary()
+
+    def _start_profiler(self):
+        if self.profile == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.profile == 'tracemalloc':
+            tracemalloc.start()
+
+    def _stop_profiler(self):
+        if self.profile == 'cprofile' and self._profiler is not None:
+            self._profiler.disable()
+            profile_file = (self.log_file.with_name(self.log_file.name.removesuffix('.metrics.jsonl') + '.prof')
+                            if self.log_file else Path(f'{self.run_name}.prof'))
+            self._profiler.dump_stats(profile_file)
+            self._profiler = None
+            print(f'cProfile profile written to {profile_file}, view with `python -m pstats {profile_file}`')
+        elif self.profile == 'tracemalloc' and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'Peak traced memory: {peak / 1024 ** 2:.2f} MB, top allocation sites:')
+            for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                print(f'  {stat}')
+            with self._lock:
+                self._emit('tracemalloc', peak_bytes=peak)
+
+    def __enter__(self):
+        self._start_profiler()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _NullMetrics(Metrics):
+    """Metrics which record nothing, the default of functions called without the metrics of a run."""
+
+    def __init__(self):
+        super().__init__('null', metrics_dir=None, profile=None)
+
+    def observe(self, name: str, seconds: float):
+        pass
+
+    def count(self, name: str, value: int = 1):
+        pass
+
+    def gauge(self, name: str, value: float):
+        pass
+
+
+NULL_METRICS = _NullMetrics()
@@ -1,12 +1,13 @@
-import concurrent.futures
 import os
-from collections import defaultdict
 from pathlib import Path
+from typing import Iterator
 
-import boto3
 from tqdm import tqdm
 
-from scripts.utils import upload_to_s3
+from scripts.adaptive_executor import AdaptiveExecutor
+from scripts.metrics import Metrics
+from scripts.upload_engine import UploadEngine
+from scripts.utils import create_s3_client, filter_s3_sync, get_fastani_result_files, list_s3_objects
 
 """
 This script uploads FastAPI result files from collections NCBI source directory to the specified S3 bucket.
@@ -17,7 +18,8 @@ ACCESS_KEY = 'cdm-admin'
 ENDPOINT_URL = 'http://localhost:9002'
 BUCKET = 'cdm'
 
-NUM_THREADS = 128
+# upper bound of the concurrent uploads, the concurrency adapts to the observed latency and throttling below it
+MAX_THREADS = 128
 
 FASTANI_RESULTS_DIR = Path(
     '/global/cfs/cdirs/kbase/ke_prototype/mcashman/analysis/pairwise_ANI/species_level_runs/RESULTS/MERGED_OUT')
@@ -30,52 +32,64 @@ CLADE_ID_FILE = Path(
 def _generate_target_files_fastani_results(
         fastani_result_dir: Path = FASTANI_RESULTS_DIR,
         clade_id_file: Path = CLADE_ID_FILE
-):
+) -> Iterator[tuple[Path, str]]:
+    """Generate the (upload_file_path, s3_key) of the FastANI result files of the clades lazily, clade by clade."""
     with open(clade_id_file, 'r') as file:
         clade_ids = [line.strip() for line in file]
 
-    fast_ani_results = os.listdir(fastani_result_dir)
+    clade_target_files = get_fastani_result_files(fastani_result_dir, clade_ids, ('.txt', '.txt.matrix'))
 
-    clade_target_files = defaultdict(list)
-    for clade_id in clade_ids:
-        for result in fast_ani_results:
-            if clade_id in result and result.endswith(('.txt', '.txt.matrix')):
-                clade_target_files[clade_id].append(fastani_result_dir / result)
-
-    target_files = []
     for sublist in clade_target_files.values():
         for file in sublist:
-            target_files.append((file, f'FastANI/Rhodanobacteraceae/{file.name}'))
-
-    return target_files
+            yield file, f'FastANI/Rhodanobacteraceae/{file.name}'
+
+
+def _import_fastani_results(metrics: Metrics):
+    # List the destination once instead of issuing a HEAD request per file
+    s3 = create_s3_client(ENDPOINT_URL, ACCESS_KEY, SECRET_KEY)
+    metrics.watch_s3_client(s3)
+    with metrics.stage('list destination'):
+        remote_objects = list_s3_objects(s3, BUCKET, 'FastANI/Rhodanobacteraceae/')
+
+    # The uploads are retried by the executor only, so that it sees the throttling and lowers its concurrency
+    upload_s3 = create_s3_client(ENDPOINT_URL, ACCESS_KEY, SECRET_KEY, max_pool_connections=MAX_THREADS, max_attempts=1)
+    metrics.watch_s3_client(upload_s3)
+
+    counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'uploaded': 0, 'copied': 0, 'skipped': 0}
+    failed_files = list()
+    upload_files = filter_s3_sync(_generate_target_files_fastani_results(), remote_objects, counts)
+
+    # Large files whose content is already in the bucket, e.g. under another prefix, are copied server side
+    with UploadEngine(upload_s3, BUCKET, metrics) as engine:
+        # Targets are pulled from the generator only as upload slots free up, bounding the in-flight uploads. The
+        # planned files are all uploaded, a changed file may have the size of the object it replaces
+        executor = AdaptiveExecutor(max_workers=MAX_THREADS, metrics=metrics, name='upload')
+        progress_bar = tqdm(unit='file')
+        for (upload_file, _), action, error in executor.run(
+                lambda target: engine.upload(*target, force=True), upload_files):
+            if error:
+                failed_files.append(upload_file)
+                print(f"Error uploading {upload_file}: {error}")
+            else:
+                counts[action] += 1
+            progress_bar.update(1)
+        progress_bar.close()
+    metrics.count('files_found', counts['new'] + counts['changed'] + counts['unchanged'])
 
+    print("Summary:")
+    print(f"Successfully uploaded: {counts['uploaded'] + counts['copied']}")
+    print(f"Copied server side (same content already in bucket): {counts['copied']}")
+    print(f"Re-uploaded (size mismatch with existing object): {counts['changed']}")
+    print(f"Skipped (already in bucket): {counts['unchanged']}")
+    print(f"Failed: {len(failed_files)}")
 
-def main():
-    target_files = _generate_target_files_fastani_results()
-
-    s3 = boto3.client('s3',
-                      endpoint_url=ENDPOINT_URL,
-                      aws_access_key_id=ACCESS_KEY,
-                      aws_secret_access_key=SECRET_KEY)
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
-        progress_bar = tqdm(total=len(target_files))
-        futures = []
-        for upload_file, s3_key in target_files:
-            futures.append(executor.submit(upload_to_s3,
-                                           upload_file,
-                                           s3_key,
-                                           s3,
-                                           BUCKET))
-
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
-            progress_bar.update(1)
+    if failed_files:
+        raise ValueError(f"Failed to upload {len(failed_files)} files, rerun to retry them: {failed_files[:10]}")
 
-    progress_bar.close()
 
-    print("Summary:")
-    print(f"Successfully uploaded: {len(target_files)}")
+def main():
+    with Metrics('minIO_fastani_result_import') as metrics:
+        _import_fastani_results(metrics)
 
 
 if __name__ == '__main__':
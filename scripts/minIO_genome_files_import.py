@@ -1,11 +1,15 @@
-import concurrent.futures
 import os
 from pathlib import Path
+from typing import Iterator
 
-import boto3
 from tqdm import tqdm
 
-from scripts.utils import get_genome_ids_with_lineage, upload_to_s3, find_files_with_suffix
+from scripts.adaptive_executor import AdaptiveExecutor
+from scripts.file_catalog import FileCatalog
+from scripts.metrics import NULL_METRICS, Metrics
+from scripts.upload_engine import UploadEngine
+from scripts.utils import (create_s3_client, get_genome_ids_with_lineage, list_s3_objects,
+                           filter_s3_sync, find_files_with_suffix)
 
 """
 This script uploads genome files from collections NCBI source directory to the specified S3 bucket.
@@ -28,72 +32,128 @@ ENDPOINT_URL = 'http://localhost:9002'
 SOURCE_DIR = Path('/global/cfs/cdirs/kbase/collections') / 'sourcedata' / 'NCBI' / 'NONE'
 SUFFIX = 'protein.faa.gz'
 BUCKET = 'cdm'
-NUM_THREADS = 128
+# upper bound of the concurrent uploads, the concurrency adapts to the observed latency and throttling below it
+MAX_THREADS = 128
 
 
 def _generate_target_files_genome_source(
         source_dir: Path = SOURCE_DIR,
-        suffix: str = 'protein.faa.gz'):
+        suffix: str = 'protein.faa.gz',
+        metrics: Metrics | None = None,
+        unmatched: dict[str, list[str]] | None = None
+) -> Iterator[tuple[Path, str]]:
     """
     Generate target files for upload based on lineage genome IDs, source directory, and file suffix.
 
-    :return
-    target_files: list of tuples (upload_file_path, s3_key)
-    no_match_genome_ids: list of genome IDs with no matching files
-    multi_match_genome_ids: list of genome IDs with multiple matching files
+    Targets are generated lazily, as the genome directories scanned in parallel complete, so the scan overlaps with
+    the upload of the targets already found and no list of all targets is built.
+
+    :param unmatched: updated with the genome IDs with no matching files under 'no_match', with multiple matching
+        files under 'multi_match' and whose directory could not be scanned, e.g. for lack of permissions, under
+        'scan_failed'
+
+    :return: iterator of tuples (upload_file_path, s3_key)
     """
     meta_dir = Path('/global/homes/t/tgu/GTDB_meta')
     taxonomy_files = [meta_dir / 'bac120_taxonomy_r214.tsv', meta_dir / 'ar53_taxonomy_r214.tsv']
     lineages = ['c__Alphaproteobacteria']
-    lineage_genome_ids = get_genome_ids_with_lineage(taxonomy_files, lineages)
-
-    no_match_genome_ids = []
-    multi_match_genome_ids = []
-    target_files = []
-
-    for genome_id in lineage_genome_ids:
-        genome_dir = source_dir / genome_id
-        matching_files = find_files_with_suffix(genome_dir, suffix)
-
-        if len(matching_files) == 1:
-            upload_file = genome_dir / matching_files[0]
-            target_files.append((upload_file, f'NCBI/{upload_file.name}'))
-        else:
-            multi_match_genome_ids.append(genome_id) if matching_files else no_match_genome_ids.append(genome_id)
-
-    return target_files, no_match_genome_ids, multi_match_genome_ids
-
-
-def main():
-    target_files, no_match_genome_ids, multi_match_genome_ids = _generate_target_files_genome_source(SOURCE_DIR)
-
-    s3 = boto3.client('s3',
-                      endpoint_url=ENDPOINT_URL,
-                      aws_access_key_id=ACCESS_KEY,
-                      aws_secret_access_key=SECRET_KEY)
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
-        progress_bar = tqdm(total=len(target_files))
-        futures = []
-        for upload_file, s3_key in target_files:
-            futures.append(executor.submit(upload_to_s3,
-                                           upload_file,
-                                           s3_key,
-                                           s3,
-                                           BUCKET))
-
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
+    metrics = metrics or NULL_METRICS
+    unmatched = unmatched if unmatched is not None else dict()
+    unmatched.setdefault('no_match', list())
+    unmatched.setdefault('multi_match', list())
+    unmatched.setdefault('scan_failed', list())
+    with metrics.stage('lineage lookup'):
+        lineage_genome_ids = get_genome_ids_with_lineage(taxonomy_files, lineages)
+    metrics.count('genomes', len(lineage_genome_ids))
+
+    def scan(genome_id: str) -> list[str]:
+        with metrics.stage('scan genome dir'):
+            catalog.refresh_dir(genome_id)
+            return find_files_with_suffix(source_dir / genome_id, suffix, catalog)
+
+    # Later runs only re-list the genome directories whose mtime changed since the catalog was saved. The directories
+    # are scanned in parallel, at most the concurrency limit ahead of the uploads pulling the targets.
+    catalog = FileCatalog(source_dir, (suffix,))
+    executor = AdaptiveExecutor(max_workers=catalog.num_threads, metrics=metrics, name='scan')
+    results = executor.run(scan, lineage_genome_ids)
+    try:
+        for genome_id, matching_files, error in results:
+            if error:
+                # one unreadable genome directory fails that genome only
+                unmatched['scan_failed'].append(genome_id)
+                print(f"Error scanning {source_dir / genome_id}: {error}")
+                continue
+            metrics.count('genome_dirs_scanned')
+
+            if len(matching_files) == 1:
+                upload_file = source_dir / genome_id / matching_files[0]
+                metrics.count('files_found')
+                yield upload_file, f'NCBI/{upload_file.name}'
+            else:
+                unmatched['multi_match' if matching_files else 'no_match'].append(genome_id)
+    finally:
+        # Wait for the scans in flight, then keep the directories scanned so far even if the run is interrupted
+        results.close()
+        catalog.save()
+
+
+def _import_genome_files(metrics: Metrics):
+    # List the destination once instead of issuing a HEAD request per file
+    s3 = create_s3_client(ENDPOINT_URL, ACCESS_KEY, SECRET_KEY)
+    metrics.watch_s3_client(s3)
+    with metrics.stage('list destination'):
+        remote_objects = list_s3_objects(s3, BUCKET, 'NCBI/')
+
+    # The uploads are retried by the executor only, so that it sees the throttling and lowers its concurrency
+    upload_s3 = create_s3_client(ENDPOINT_URL, ACCESS_KEY, SECRET_KEY, max_pool_connections=MAX_THREADS, max_attempts=1)
+    metrics.watch_s3_client(upload_s3)
+
+    counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'uploaded': 0, 'copied': 0, 'skipped': 0}
+    unmatched, failed_files = dict(), list()
+    target_files = _generate_target_files_genome_source(SOURCE_DIR, SUFFIX, metrics, unmatched)
+    upload_files = filter_s3_sync(target_files, remote_objects, counts)
+
+    # Large files whose content is already in the bucket, e.g. under another prefix, are copied server side
+    with UploadEngine(upload_s3, BUCKET, metrics) as engine:
+        # Targets are pulled from the generator only as upload slots free up, bounding the in-flight uploads. The
+        # planned files are all uploaded, a changed file may have the size of the object it replaces
+        executor = AdaptiveExecutor(max_workers=MAX_THREADS, metrics=metrics, name='upload')
+        progress_bar = tqdm(unit='file')
+        for (upload_file, _), action, error in executor.run(
+                lambda target: engine.upload(*target, force=True), upload_files):
+            if error:
+                failed_files.append(upload_file)
+                print(f"Error uploading {upload_file}: {error}")
+            else:
+                counts[action] += 1
             progress_bar.update(1)
+        progress_bar.close()
 
-    progress_bar.close()
-
+    no_match_genome_ids, multi_match_genome_ids = unmatched['no_match'], unmatched['multi_match']
+    scan_failed_genome_ids = unmatched['scan_failed']
     print("Summary:")
-    print(f"Successfully uploaded: {len(target_files)}")
+    print(f"Successfully uploaded: {counts['uploaded'] + counts['copied']}")
+    print(f"Copied server side (same content already in bucket): {counts['copied']}")
+    print(f"Re-uploaded (size mismatch with existing object): {counts['changed']}")
+    print(f"Skipped (already in bucket): {counts['unchanged']}")
+    print(f"Failed: {len(failed_files)}")
     print(f"Num of no matching files Genome: {len(no_match_genome_ids)}")
     print(f"{no_match_genome_ids[:10]}") if no_match_genome_ids else None
     print(f"Num of multiple matching files Genome: {len(multi_match_genome_ids)}")
     print(f"{multi_match_genome_ids[:10]}") if multi_match_genome_ids else None
+    print(f"Num of genome directories that could not be scanned: {len(scan_failed_genome_ids)}")
+    print(f"{scan_failed_genome_ids[:10]}") if scan_failed_genome_ids else None
+
+    if failed_files:
+        raise ValueError(f"Failed to upload {len(failed_files)} files, rerun to retry them: {failed_files[:10]}")
+    if scan_failed_genome_ids:
+        raise ValueError(f"Failed to scan {len(scan_failed_genome_ids)} genome directories: "
+                         f"{scan_failed_genome_ids[:10]}")
+
+
+def main():
+    with Metrics('minIO_genome_files_import') as metrics:
+        _import_genome_files(metrics)
 
 
 if __name__ == '__main__':
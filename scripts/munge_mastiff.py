@@ -0,0 +1,159 @@
+"""
+This script munges branchwater mastiff containment search results and uploads them to the MinIO server.
+
+It replaces the ID munging loop in data_records/branchwater.md. Each mastiff output (e.g.
+GCF_000979555.1_ASM97955v1_genomic.fna.mastiff) is read in chunks with the C parser, the query genome path in the
+third column is reduced to its genome ID, duplicate rows are dropped and the result is written to compressed Parquet
+(<name>.ids.parquet) with the genome ID column dictionary encoded. Files are munged in parallel in a process pool.
+All the rows of an output share one query genome, so duplicates are dropped on the match columns, within each chunk
+as it is read and then once over the whole output.
+
+Before running this script, make sure the SSH tunnel to the MinIO server is running and SECRET_KEY is set, see
+minIO_genome_files_import.py.
+"""
+import concurrent.futures
+import os
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pandas as pd
+import pyarrow as pa
+
+from scripts.metrics import Metrics
+from scripts.norm_results import _genome_id_from_path
+from scripts.upload_engine import UploadEngine
+from scripts.utils import ParquetPartitionWriter, create_s3_client, list_s3_objects, plan_s3_sync
+
+SECRET_KEY = os.environ.get('SECRET_KEY')
+ACCESS_KEY = 'cdm-admin'
+ENDPOINT_URL = 'http://localhost:9002'
+BUCKET = 'cdm'
+S3_PREFIX = 'branchwater/Rhodanobacteraceae/'
+
+MASTIFF_DIR = Path.home() / 'mash' / 'branchwater_mastiff' / 'CDM_tests'
+MASTIFF_SUFFIX = '.mastiff'
+OUTPUT_DIR = MASTIFF_DIR / 'ids_parquet'
+
+CHUNK_SIZE = 2_000_000  # number of mastiff rows parsed at once per process
+NUM_PROCESSES = os.cpu_count()
+NUM_UPLOAD_THREADS = 8
+# each upload sends up to 8 parts of a ~500 MB output at once, see utils.transfer_config_for
+MAX_POOL_CONNECTIONS = NUM_UPLOAD_THREADS * 8
+UPLOAD = True
+
+
+def _read_mastiff_chunks(mastiff_file: Path, columns: list[str], counts: dict[str, int]) -> Iterator[pd.DataFrame]:
+    """
+    Read a mastiff output file in chunks of CHUNK_SIZE rows, with the query genome path replaced by its genome ID and
+    the rows duplicating the match columns of another row of the chunk dropped. The columns have fixed types whatever
+    the values of a chunk.
+
+    :param counts: count of the rows read, updated as the chunks are read
+    """
+    genome_id_cache = dict()
+    for df in pd.read_csv(mastiff_file, usecols=[0, 1, 2], header=0, names=columns, dtype=str,
+                          engine='c', chunksize=CHUNK_SIZE):
+        counts['rows_read'] += len(df)
+        path_col = columns[2]
+        for genome_path in df[path_col].unique():
+            if genome_path not in genome_id_cache:
+                genome_id_cache[genome_path] = _genome_id_from_path(genome_path)
+
+        yield pd.DataFrame({
+            columns[0]: df[columns[0]].astype('string'),
+            columns[1]: pd.to_numeric(df[columns[1]], errors='coerce').astype('float64'),
+            'genome_id': df[path_col].map(genome_id_cache).astype('string'),
+        }).drop_duplicates(subset=columns[:2])
+
+
+def munge_mastiff_file(mastiff_file: Path, output_dir: Path = OUTPUT_DIR) -> tuple[Path, int, int, float]:
+    """
+    Munge a mastiff output file to Parquet, replacing the query genome path with its genome ID and dropping the
+    duplicate matches.
+
+    :param mastiff_file: mastiff output file
+    :param output_dir: directory of the Parquet outputs
+
+    :return: tuple of (Parquet file, rows read, rows written, seconds elapsed)
+    """
+    start_time = time.perf_counter()
+    with open(mastiff_file, 'r') as file:
+        columns = file.readline().strip().split(',')[:3]
+    schema = pa.schema([(columns[0], pa.string()),
+                        (columns[1], pa.float64()),
+                        ('genome_id', pa.dictionary(pa.int32(), pa.string()))])
+
+    counts = {'rows_read': 0}
+    output_name = mastiff_file.name.removesuffix(MASTIFF_SUFFIX) + '.ids.parquet'
+    with ParquetPartitionWriter(output_dir, {}, output_name, schema=schema) as writer:
+        dfs = list(_read_mastiff_chunks(mastiff_file, columns, counts))
+        if dfs:
+            writer.write(pd.concat(dfs, ignore_index=True).drop_duplicates(subset=columns[:2]))
+
+    return writer.path, counts['rows_read'], writer.num_rows, time.perf_counter() - start_time
+
+
+def _munge_and_upload(metrics: Metrics):
+    mastiff_files = sorted(MASTIFF_DIR.glob(f'*{MASTIFF_SUFFIX}'))
+
+    start_time = time.perf_counter()
+    output_files, failed_files = list(), list()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=NUM_PROCESSES) as executor:
+        futures = {executor.submit(munge_mastiff_file, mastiff_file): mastiff_file for mastiff_file in mastiff_files}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                output_file, rows_read, rows_written, elapsed = future.result()
+            except Exception as e:
+                failed_files.append(futures[future])
+                metrics.count('files_failed')
+                print(f'Error munging {futures[future]}: {e}')
+                continue
+            metrics.observe('munge file', elapsed)
+            metrics.count('rows_read', rows_read)
+            metrics.count('rows_written', rows_written)
+            metrics.count('bytes_read', futures[future].stat().st_size)
+            if output_file.exists():
+                output_files.append(output_file)
+            print(f'{futures[future].name}: {rows_read} rows, {rows_written} unique, {elapsed:.2f}s')
+
+    print(f'Munged {len(output_files)} mastiff files in {time.perf_counter() - start_time:.2f}s')
+
+    upload_failed_files = list()
+    if UPLOAD and output_files:
+        s3 = create_s3_client(ENDPOINT_URL, ACCESS_KEY, SECRET_KEY, max_pool_connections=MAX_POOL_CONNECTIONS)
+        metrics.watch_s3_client(s3)
+        target_files = [(output_file, f'{S3_PREFIX}{output_file.name}') for output_file in output_files]
+        with metrics.stage('list destination'):
+            remote_objects = list_s3_objects(s3, BUCKET, S3_PREFIX)
+        new_files, changed_files, unchanged_files = plan_s3_sync(target_files, remote_objects)
+        # the outputs are large, they are sent as parallel multipart uploads, or copied server side when the same
+        # content is already in the bucket
+        actions = list()
+        with UploadEngine(s3, BUCKET, metrics) as engine, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=NUM_UPLOAD_THREADS) as executor:
+            futures = {executor.submit(engine.upload, upload_file, s3_key, force=True): upload_file
+                       for upload_file, s3_key in new_files + changed_files}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    actions.append(future.result())
+                except Exception as e:
+                    upload_failed_files.append(futures[future])
+                    metrics.count('uploads_failed')
+                    print(f'Error uploading {futures[future]}: {e}')
+        print(f'Uploaded {len(actions)} files to s3://{BUCKET}/{S3_PREFIX} '
+              f'({actions.count("copied")} copied server side), {len(unchanged_files)} already present, '
+              f'{len(upload_failed_files)} failed')
+
+    if failed_files or upload_failed_files:
+        raise ValueError(f'Failed to munge {len(failed_files)} mastiff files: {failed_files[:10]}, '
+                         f'failed to upload {len(upload_failed_files)} files: {upload_failed_files[:10]}')
+
+
+def main():
+    with Metrics('munge_mastiff') as metrics:
+        _munge_and_upload(metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,17 @@
 This script is used to normalize the results of different tools used for the CDM project.
 
 """
+import concurrent.futures
 import os
-from collections import defaultdict
+import time
 from pathlib import Path
 
 import pandas as pd
 
-from scripts.utils import find_files_with_suffix
+from scripts.file_catalog import FileCatalog
+from scripts.metrics import NULL_METRICS, Metrics
+from scripts.utils import (ParquetPartitionWriter, cast_eggnog_annotation_types, find_files_with_suffix,
+                           get_fastani_result_files)
 
 COLL_ROOT = Path('/global/cfs/cdirs/kbase/collections')
 FASTANI_RESULTS_DIR = Path(
@@ -16,98 +20,329 @@ FASTANI_RESULTS_DIR = Path(
 CLADE_ID_FILE = Path(
     '/global/cfs/cdirs/kbase/ke_prototype/mcashman/CDM/sample_clades/species_clade_list_filtered_f__Rhodanobacteraceae.txt')
 
+ANNOTATION_TSV_SUFFIX = 'emapper.annotations'
+ANNOTATION_XLSX_SUFFIX = 'emapper.annotations.xlsx'
+PROCESSED_PREFIX = 'processed_'
+CHUNK_SIZE = 50_000  # number of annotation rows held in memory per genome
+NUM_PROCESSES = os.cpu_count()
+
+OUTPUT_FORMATS = ('csv', 'parquet')
+FASTANI_READ_DTYPES = {'G1_path': str, 'G2_path': str, 'ANI': 'float32', 'Overlap': 'int32', 'Total': 'int32'}
+FASTANI_CHUNK_SIZE = 1_000_000  # number of genome pairs held in memory
+
+
+def _find_annotation_file(genome_dir: Path, catalog: FileCatalog | None = None) -> Path:
+    """
+    Find the eggNOG annotation file of a genome, looking it up in the file catalog if provided.
+
+    The tab-separated emapper.annotations file is preferred over emapper.annotations.xlsx when both exist, since it
+    can be streamed and is an order of magnitude faster to parse than the Excel workbook.
+    """
+    anno_files = [Path(file_path) for file_path in
+                  find_files_with_suffix(genome_dir, (ANNOTATION_TSV_SUFFIX, ANNOTATION_XLSX_SUFFIX), catalog)
+                  if not Path(file_path).name.startswith(PROCESSED_PREFIX)]
+
+    tsv_files = [file_path for file_path in anno_files if file_path.name.endswith(ANNOTATION_TSV_SUFFIX)]
+    xlsx_files = [file_path for file_path in anno_files if file_path.name.endswith(ANNOTATION_XLSX_SUFFIX)]
+
+    if tsv_files:
+        return tsv_files[0]
+    if xlsx_files:
+        return xlsx_files[0]
+
+    raise FileNotFoundError(f'No eggNOG annotation file found in {genome_dir}')
+
+
+def _read_xlsx_chunks(anno_file: Path, chunk_size: int):
+    """
+    Read the Excel workbook, which cannot be streamed by pandas, whole and yield it in chunks. The rows are read without
+    a header since the header row starts with # (e.g. #query), which read_excel(comment='#') would drop entirely.
+    """
+    df = pd.read_excel(anno_file, header=None, dtype=str)
+    df = df[~df.iloc[:, 0].str.startswith('##', na=False)]
+    df = df.dropna(how='all')  # drops rows with all NaN values
+    if df.empty:
+        return
+    df = df.iloc[1:].set_axis(df.iloc[0], axis=1).reset_index(drop=True)
+    df.columns.name = None
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+
+def _read_tsv_chunks(anno_file: Path, chunk_size: int):
+    # The leading ## lines are skipped; the header line itself starts with a single # (e.g. #query)
+    skip_rows = 0
+    with open(anno_file, 'r') as file:
+        for line in file:
+            if not line.startswith('##'):
+                break
+            skip_rows += 1
+
+    for df in pd.read_csv(anno_file, sep='\t', skiprows=skip_rows, chunksize=chunk_size, dtype=str):
+        # Drop the trailing ## lines emapper writes after the annotations
+        df = df[~df.iloc[:, 0].str.startswith('##', na=False)]
+        df = df.dropna(how='all')
+        if not df.empty:
+            yield df
+
+
+def _read_annotation_chunks(anno_file: Path, chunk_size: int = CHUNK_SIZE):
+    """
+    Read the eggNOG annotation file in chunks of rows, dropping the metadata lines (starting with ##) added by emapper.
+
+    The tab-separated file is streamed so memory use is bounded by the chunk size. The Excel workbook cannot be
+    streamed by pandas and is read whole, then yielded in chunks.
+
+    The leading # of the header (e.g. #query) is stripped here for both formats, so every genome is written with the
+    same column names and the Parquet partitions share one schema.
+    """
+    if anno_file.name.endswith(ANNOTATION_XLSX_SUFFIX):
+        chunks = _read_xlsx_chunks(anno_file, chunk_size)
+    else:
+        chunks = _read_tsv_chunks(anno_file, chunk_size)
+    for df in chunks:
+        yield df.rename(columns=lambda column: str(column).lstrip('#'))
+
+
+def _normalize_genome_annotation(
+        genome_dir: Path,
+        ori_anno: Path,
+        output_format: str = 'csv',
+        parquet_dir: Path | None = None
+) -> tuple[Path, int, int, float]:
+    """
+    Process the eggNOG annotation file of a single genome and prepend the genome_id to the first column.
+
+    In csv mode the processed file is saved to the same directory as the annotation file with the prefix "processed_".
+    In parquet mode the rows are written to the genome_id partition of the Parquet dataset at parquet_dir instead.
+
+    :param genome_dir: genome directory of the eggNOG results
+    :param ori_anno: eggNOG annotation file of the genome
+    :param output_format: 'csv' or 'parquet'
+    :param parquet_dir: root directory of the Parquet dataset, required in parquet mode
+
+    :return: tuple of (processed file path, number of rows, size in bytes of the annotation file, seconds elapsed)
+    """
+    start_time = time.perf_counter()
+    output_name = ori_anno.name.removesuffix('.xlsx')
+
+    num_rows = 0
+    if output_format == 'parquet':
+        with ParquetPartitionWriter(parquet_dir,
+                                    {'genome_id': genome_dir.name},
+                                    f'{PROCESSED_PREFIX}{output_name}.parquet') as writer:
+            for df in _read_annotation_chunks(ori_anno):
+                writer.write(cast_eggnog_annotation_types(df))
+                num_rows += len(df)
+        output_file_path = writer.path
+    else:
+        output_file_path = ori_anno.parent / f'{PROCESSED_PREFIX}{output_name}.csv'
+        tmp_file_path = output_file_path.with_name(output_file_path.name + '.tmp')
+        with open(tmp_file_path, 'w', newline='') as output_file:
+            for df in _read_annotation_chunks(ori_anno):
+                df.insert(0, 'genome_id', genome_dir.name)
+                df.to_csv(output_file, index=False, header=num_rows == 0)
+                num_rows += len(df)
+        os.replace(tmp_file_path, output_file_path)
+
+    return output_file_path, num_rows, ori_anno.stat().st_size, time.perf_counter() - start_time
+
 
 def normalize_eggnog_results(
         coll_root: Path = COLL_ROOT,
-        load_ver: str = 'f__Rhodanobacteraceae'
+        load_ver: str = 'f__Rhodanobacteraceae',
+        num_processes: int = NUM_PROCESSES,
+        output_format: str = 'csv',
+        metrics: Metrics | None = None
 ):
     """
     eggNOG is executed with the collections framework, so the results are in the collections directory.
 
-    This function process the emapper.annotations.xlsx file from eggNOG and prepends the genome_id to the first column.
+    This function process the emapper annotation file (emapper.annotations, or emapper.annotations.xlsx when the
+    text file is absent) from eggNOG and prepends the genome_id to the first column.
     And save the processed file to the same directory with the prefix "processed_".
 
+    Genomes are processed in parallel in a process pool and per-genome timing and overall throughput are reported.
+
+    With output_format 'parquet' the processed rows are instead written as typed, compressed Parquet to a single
+    dataset partitioned by genome_id, at <eggnog results dir>/processed_parquet.
+
     :param coll_root: root directory of the collections project
     :param load_ver: load version of the eggNOG results
+    :param num_processes: number of worker processes
+    :param output_format: 'csv' or 'parquet'
+    :param metrics: metrics of the run, records the per-genome normalization latency and the rows and bytes read
 
     :return: list of processed eggNOG result files
     """
+    metrics = metrics or NULL_METRICS
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Invalid output format {output_format}, must be one of {OUTPUT_FORMATS}')
 
     data_dir = coll_root / 'collectionsdata' / 'NONE' / 'CDM' / load_ver / 'eggnog'
-    batch_dirs = [x for x in data_dir.iterdir() if x.is_dir()]
-
-    processed_files = list()
-    for batch_dir in batch_dirs:
-        genome_dirs = [x for x in batch_dir.iterdir() if x.is_dir()]
-        for genome_dir in genome_dirs:
-            anno_files = find_files_with_suffix(genome_dir, 'emapper.annotations.xlsx')
-
-            ori_anno = Path([file_path for file_path in anno_files if
-                             (Path(file_path).name.endswith('emapper.annotations.xlsx')
-                              and not Path(file_path).name.startswith('processed_'))][0])
-
-            # Read the file into a DataFrame, skipping initial rows starting with ##
-            df = pd.read_excel(ori_anno, comment='#')
-            df = df.dropna(how='all')  # drops rows with all NaN values
-            df.insert(0, 'genome_id', genome_dir.name)
-
-            # Save the processed DataFrame as CSV to the same directory with the prefix "processed_"
-            output_file_name = "processed_" + ori_anno.name.replace(".xlsx", ".csv")
-            output_file_path = ori_anno.parent / output_file_name
-            df.to_csv(output_file_path, index=False)
+    parquet_dir = data_dir / 'processed_parquet'
+    batch_dirs = [batch_dir for batch_dir in data_dir.iterdir() if batch_dir.is_dir() and batch_dir != parquet_dir]
+    genome_dirs = [genome_dir for batch_dir in batch_dirs for genome_dir in batch_dir.iterdir() if genome_dir.is_dir()]
+
+    start_time = time.perf_counter()
+    processed_files, failed_genomes = list(), list()
+    total_rows, total_bytes = 0, 0
+
+    # Locate the annotation files of all genomes from one catalog refresh rather than a directory walk per genome
+    with metrics.stage('catalog refresh'):
+        catalog = FileCatalog(data_dir, (ANNOTATION_TSV_SUFFIX, ANNOTATION_XLSX_SUFFIX))
+        catalog.refresh(top_dirs=[batch_dir.name for batch_dir in batch_dirs])
+    metrics.count('genome_dirs_scanned', len(genome_dirs))
+    anno_files = dict()
+    for genome_dir in genome_dirs:
+        try:
+            anno_files[genome_dir] = _find_annotation_file(genome_dir, catalog)
+        except FileNotFoundError as e:
+            failed_genomes.append(genome_dir.name)
+            metrics.count('genomes_failed')
+            print(f'Error processing {genome_dir}: {e}')
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+        futures = {executor.submit(_normalize_genome_annotation, genome_dir, ori_anno, output_format, parquet_dir):
+                       genome_dir for genome_dir, ori_anno in anno_files.items()}
+
+        for future in concurrent.futures.as_completed(futures):
+            genome_dir = futures[future]
+            try:
+                output_file_path, num_rows, num_bytes, elapsed = future.result()
+            except Exception as e:
+                failed_genomes.append(genome_dir.name)
+                metrics.count('genomes_failed')
+                print(f'Error processing {genome_dir}: {e}')
+                continue
             processed_files.append(output_file_path)
-
-    print(f'Processed {len(processed_files)} genome eggNOG results')
+            total_rows += num_rows
+            total_bytes += num_bytes
+            metrics.observe('normalize genome', elapsed)
+            metrics.count('genomes_processed')
+            metrics.count('rows_parsed', num_rows)
+            metrics.count('bytes_read', num_bytes)
+            print(f'{genome_dir.name}: {num_rows} rows in {elapsed:.2f}s')
+
+    elapsed = time.perf_counter() - start_time
+    print(f'Processed {len(processed_files)} genome eggNOG results in {elapsed:.2f}s '
+          f'({len(processed_files) / elapsed:.2f} genomes/s, {total_rows / elapsed:.0f} rows/s, '
+          f'{total_bytes / elapsed / 1024 ** 2:.2f} MB/s)')
+
+    if failed_genomes:
+        raise ValueError(f'Failed to process {len(failed_genomes)} genome eggNOG results: {failed_genomes[:10]}')
 
     return processed_files
 
 
+def _genome_id_from_path(genome_path: str) -> str:
+    """
+    Get the genome ID from the path of a genome file,
+    e.g. /path/GCF_000979555.1_ASM97955v1_genomic.fna -> GCF_000979555.1
+    """
+    return '_'.join(Path(genome_path).name.split('_')[:2])
+
+
+def _read_fastani_chunks(
+        result_file: Path,
+        genome_id_cache: dict[str, str],
+        chunk_size: int = FASTANI_CHUNK_SIZE
+):
+    """
+    Read a FastANI result file in chunks of rows with the C parser and explicit dtypes, and replace the genome paths
+    with genome IDs.
+
+    The pairwise output only refers to the genomes of one clade, so the path of each genome repeats in many rows.
+    The genome ID of each distinct path is computed once and cached, and the columns are mapped through the cache.
+
+    :param result_file: FastANI result file
+    :param genome_id_cache: cache of genome path to genome ID, updated in place
+    :param chunk_size: number of rows per chunk
+    """
+    for df in pd.read_csv(
+            result_file,
+            sep=r'\s+',  # whitespace separated, handled by the C parser
+            engine='c',
+            header=None,  # no header
+            names=['G1_path', 'G2_path', 'ANI', 'Overlap', 'Total'],
+            dtype=FASTANI_READ_DTYPES,
+            chunksize=chunk_size):
+        for path_col, id_col in (('G1_path', 'G1'), ('G2_path', 'G2')):
+            for genome_path in df[path_col].unique():
+                if genome_path not in genome_id_cache:
+                    genome_id_cache[genome_path] = _genome_id_from_path(genome_path)
+            df[id_col] = df[path_col].map(genome_id_cache).astype('string')
+
+        yield df[['G1', 'G2', 'ANI', 'Overlap', 'Total']]
+
+
 def normalize_fastani_results(
         fastani_result_dir: Path = FASTANI_RESULTS_DIR,
-        clade_id_file: Path = CLADE_ID_FILE
+        clade_id_file: Path = CLADE_ID_FILE,
+        output_format: str = 'csv',
+        metrics: Metrics | None = None
 ):
     """
     Normalize the FastANI result file (.txt result) by processing each fastani result and concatenate them into a
-    single DataFrame.
+    single file.
+
+    The processed results are saved to the current working directory as "processed_fastani_results.csv".
+    With output_format 'parquet' they are instead written to a Parquet dataset partitioned by clade_id in the current
+    working directory, "processed_fastani_results".
 
-    The processed DataFrame is saved to the current working directory as "processed_fastani_results.csv".
+    Results are streamed to the output in chunks of FASTANI_CHUNK_SIZE rows, so memory use does not grow with the
+    total number of genome pairs.
 
     :param fastani_result_dir: directory of the FastANI result files
     :param clade_id_file: file that contains clade names for genomes belongs to Rhodanobacteraceae
+    :param output_format: 'csv' or 'parquet'
+    :param metrics: metrics of the run, records the per-file normalization latency and the rows and bytes read
     """
+    metrics = metrics or NULL_METRICS
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Invalid output format {output_format}, must be one of {OUTPUT_FORMATS}')
+
     with open(clade_id_file, 'r') as file:
         clade_ids = [line.strip() for line in file]
 
-    fast_ani_results = os.listdir(fastani_result_dir)
-
-    clade_target_files, dfs = defaultdict(list), list()
-    for clade_id in clade_ids:
-        for result in fast_ani_results:
-            if clade_id in result and result.endswith('.txt'):
-                clade_target_files[clade_id].append(fastani_result_dir / result)
-
-                df = pd.read_csv(
-                    fastani_result_dir / result,
-                    sep="\s+",  # whitespace separated
-                    header=None,  # no header
-                    names=["G1_path", "G2_path", "ANI", "Overlap", "Total"]
-                )
-
-                df["G1"] = df["G1_path"].apply(lambda x: '_'.join(Path(x).name.split("_")[:2]))
-                df["G2"] = df["G2_path"].apply(lambda x: '_'.join(Path(x).name.split("_")[:2]))
-
-                df = df[['G1', 'G2', 'ANI', 'Overlap', 'Total']]
-
-                dfs.append(df)
-
-    master_df = pd.concat(dfs, ignore_index=True)
-
-    master_df.to_csv('processed_fastani_results.csv', index=False)
+    with metrics.stage('find result files'):
+        clade_target_files = get_fastani_result_files(fastani_result_dir, clade_ids, ('.txt',))
+
+    genome_id_cache, num_rows = dict(), 0
+    if output_format == 'parquet':
+        for clade_id, result_files in clade_target_files.items():
+            for result_file in result_files:
+                with metrics.stage('normalize result file'):
+                    with ParquetPartitionWriter(Path('processed_fastani_results'),
+                                                {'clade_id': clade_id},
+                                                f'{result_file.name}.parquet') as writer:
+                        for df in _read_fastani_chunks(result_file, genome_id_cache):
+                            writer.write(df)
+                num_rows += writer.num_rows
+                metrics.count('rows_parsed', writer.num_rows)
+                metrics.count('bytes_read', result_file.stat().st_size)
+    else:
+        output_file_path = Path('processed_fastani_results.csv')
+        tmp_file_path = output_file_path.with_name(output_file_path.name + '.tmp')
+        with open(tmp_file_path, 'w', newline='') as output_file:
+            for result_files in clade_target_files.values():
+                for result_file in result_files:
+                    with metrics.stage('normalize result file'):
+                        for df in _read_fastani_chunks(result_file, genome_id_cache):
+                            df.to_csv(output_file, index=False, header=num_rows == 0)
+                            num_rows += len(df)
+                            metrics.count('rows_parsed', len(df))
+                    metrics.count('bytes_read', result_file.stat().st_size)
+        os.replace(tmp_file_path, output_file_path)
+
+    print(f'Processed {num_rows} FastANI genome pairs from {len(clade_target_files)} clades')
 
 
 def main():
-    normalize_eggnog_results()
-    normalize_fastani_results()
+    with Metrics('norm_results') as metrics:
+        normalize_eggnog_results(metrics=metrics)
+        normalize_fastani_results(metrics=metrics)
 
 
 if __name__ == '__main__':
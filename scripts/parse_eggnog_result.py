@@ -1,12 +1,29 @@
 """
 This script parses the Eggnog result files and uploads the processed files to the MinIO server.
+
+Parsing and uploading run as a pipeline: annotation files are parsed in a process pool while the processed files are
+uploaded by a pool of threads sharing one S3 client. The two stages are connected by a bounded queue, so parsing
+blocks when uploads fall behind rather than piling up processed files.
+
+With PACK_SHARDS the processed files are packed into tar shards of about 256 MB with a member index instead of being
+uploaded as one small object per data ID, and the uploaders upload the sealed shards. A data ID is recorded as done
+once its shard is uploaded. Single genomes are read back with shard_pack.ShardReader.
 """
+import concurrent.futures
 import json
 import os
+import queue
+import threading
+import time
 from pathlib import Path
 
-import boto3
 import pandas as pd
+from boto3.s3.transfer import TransferConfig
+
+from scripts.metrics import Metrics
+from scripts.processing_manifest import ProcessingManifest
+from scripts.shard_pack import ShardWriter, upload_shard
+from scripts.utils import ParquetPartitionWriter, cast_eggnog_annotation_types, create_s3_client, upload_file_etag
 
 SECRET_KEY = os.environ.get('SECRET_KEY')
 ACCESS_KEY = 'cdm-admin'
@@ -19,6 +36,24 @@ kbase_collection = 'CDM'
 load_ver = 'IMG'
 RESULT_DIR = COLL_ROOT / 'collectionsdata' / 'NONE' / kbase_collection / load_ver / 'eggnog'
 COMPUTE_OUTPUT_PREFIX = 'job'
+# 'csv' saves one processed CSV per data ID, 'parquet' writes to a Parquet dataset partitioned by img_submission_id
+OUTPUT_FORMAT = 'csv'
+PARQUET_DIR = RESULT_DIR / 'processed_parquet'
+# pack the processed files into shards, see shard_pack.py, rather than uploading an object per data ID
+PACK_SHARDS = False
+SHARD_DIR = RESULT_DIR / 'processed_shards'
+SHARD_PREFIX = f'IMG-source/eggnog_results_{OUTPUT_FORMAT}_shards/'
+# Records the data IDs already parsed and uploaded so reruns skip unchanged data and only retry failures.
+# Delete the file to force a full rerun.
+MANIFEST_FILE = RESULT_DIR / f'eggnog_upload_manifest_{OUTPUT_FORMAT}{"_packed" if PACK_SHARDS else ""}.sqlite'
+
+NUM_PARSE_PROCESSES = os.cpu_count()
+NUM_UPLOAD_THREADS = 16
+# maximum number of processed files waiting for upload
+UPLOAD_QUEUE_SIZE = 2 * NUM_UPLOAD_THREADS
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=64 * 1024 ** 2,
+                                 multipart_chunksize=16 * 1024 ** 2,
+                                 max_concurrency=4)
 
 
 def _get_batch_dirs(result_dir: Path) -> list[str]:
@@ -31,20 +66,22 @@ def _get_batch_dirs(result_dir: Path) -> list[str]:
     return batch_dirs
 
 
-def _upload_to_minio(processed_file: Path, data_id: str):
-    """Upload file to MinIO."""
+def _upload_to_minio(s3_client, processed_file: Path, data_id: str) -> str:
+    """Upload file to MinIO with the shared S3 client and return the ETag of the uploaded object."""
 
-    s3_path = f'IMG-source/eggnog_results/{data_id}/{processed_file.name}'
-    s3_client = boto3.client('s3',
-                             endpoint_url=ENDPOINT_URL,
-                             aws_access_key_id=ACCESS_KEY,
-                             aws_secret_access_key=SECRET_KEY)
+    if processed_file.suffix == '.parquet':
+        # keep the hive partition layout of the local dataset so the lake can read it as a single dataset
+        s3_path = f'IMG-source/eggnog_results_parquet/img_submission_id={data_id}/{processed_file.name}'
+    else:
+        s3_path = f'IMG-source/eggnog_results/{data_id}/{processed_file.name}'
     try:
-        s3_client.upload_file(str(processed_file), BUCKET, s3_path)
+        etag = upload_file_etag(processed_file, s3_path, s3_client, BUCKET, config=TRANSFER_CONFIG)
         print(f"File has been uploaded to s3://{BUCKET}/{s3_path}")
     except Exception as e:
         raise ValueError(f"Error uploading {processed_file} to MinIO: {e}")
 
+    return etag
+
 
 def _get_source_file(data_dir: Path) -> str:
     """Get the source file name from the metadata file."""
@@ -63,15 +100,20 @@ def _get_source_file(data_dir: Path) -> str:
     return source_file
 
 
-def _read_and_process_data(data_dir: Path, source_file: str) -> pd.DataFrame:
-    """Read and process annotation data."""
+def _get_annotation_file(data_dir: Path, source_file: str) -> Path:
+    """Get the path of the result annotation xlsx file."""
 
-    # read result annotation xlsx file
-    anno_file = f'{Path(source_file).name}.emapper.annotations.xlsx'
-    if not (data_dir / anno_file).exists():
-        raise FileNotFoundError(f'{anno_file} not found in {data_dir}')
+    anno_file = data_dir / f'{Path(source_file).name}.emapper.annotations.xlsx'
+    if not anno_file.exists():
+        raise FileNotFoundError(f'{anno_file.name} not found in {data_dir}')
 
-    df = pd.read_excel(data_dir / anno_file, header=None)
+    return anno_file
+
+
+def _read_and_process_data(anno_file: Path) -> pd.DataFrame:
+    """Read and process annotation data."""
+
+    df = pd.read_excel(anno_file, header=None)
 
     # Skip the first 2 rows and the last 3 rows, they are just metadata added by the eggnog tool and not useful
     df = df.iloc[2:-3].reset_index(drop=True)
@@ -85,55 +127,210 @@ def _read_and_process_data(data_dir: Path, source_file: str) -> pd.DataFrame:
 def _save_processed_data(data_dir: Path,
                          df: pd.DataFrame,
                          data_id: str,
-                         source_file: str) -> Path:
-    """Add metadata (IMG submission ID and source file name) to the dataframe and save the processed data."""
+                         source_file: str,
+                         output_format: str = OUTPUT_FORMAT) -> Path:
+    """
+    Add metadata (IMG submission ID and source file name) to the dataframe and save the processed data.
+
+    In parquet mode the IMG submission ID is stored as the partition of the Parquet dataset at PARQUET_DIR rather
+    than as a column.
+    """
 
     # Add the IMG submission ID and file name to the dataframe for future reference (foreign key)
     # Add more metadata if needed
-    df['img_submission_id'] = data_id
     df['source_file_name'] = Path(source_file).name
 
+    if output_format == 'parquet':
+        with ParquetPartitionWriter(PARQUET_DIR,
+                                    {'img_submission_id': data_id},
+                                    f'{Path(source_file).name}.emapper.annotations.processed.parquet') as writer:
+            writer.write(cast_eggnog_annotation_types(df))
+        return writer.path
+
+    df.insert(len(df.columns) - 1, 'img_submission_id', data_id)
     processed_file = data_dir / f'{Path(source_file).name}.emapper.annotations.processed.csv'
     df.to_csv(processed_file, index=False)
 
     return processed_file
 
 
-def _process_annotation_file(data_dir: Path, data_id: str):
-    """Process the annotation file and upload the processed file to MinIO."""
-
-    try:
-        source_file = _get_source_file(data_dir)
-        df = _read_and_process_data(data_dir, source_file)
-        processed_file = _save_processed_data(data_dir, df, data_id, source_file)
-        _upload_to_minio(processed_file, data_id)
-        return True
-    except (FileNotFoundError, ValueError) as e:
-        print(f"Error processing files in {data_dir}: {e}")
-    except Exception as e:
-        print(f"Unexpected error processing files in {data_dir}: {e}")
-    return False
-
-
-def main():
-    batch_dirs = _get_batch_dirs(RESULT_DIR)
-    total_data_ids, processed_data_ids = 0, 0
-    for batch_dir in batch_dirs:
+def _parse_annotation_file(data_dir: Path, data_id: str, source_file: str, anno_file: Path) -> tuple[Path, int, float]:
+    """
+    Parse the annotation file and save the processed data. Runs in a worker process of the parse stage.
+
+    :return: tuple of (processed file, number of rows, seconds elapsed)
+    """
+    start_time = time.perf_counter()
+    df = _read_and_process_data(anno_file)
+    processed_file = _save_processed_data(data_dir, df, data_id, source_file)
+    return processed_file, len(df), time.perf_counter() - start_time
+
+
+def _upload_worker(s3_client, upload_queue: queue.Queue, result_queue: queue.Queue, metrics: Metrics):
+    """Upload processed files from the upload queue until a None sentinel is received."""
+
+    while (item := upload_queue.get()) is not None:
+        data_id, anno_file, processed_file = item
+        try:
+            with metrics.stage('upload'):
+                etag = _upload_to_minio(s3_client, processed_file, data_id)
+            metrics.count('bytes_uploaded', processed_file.stat().st_size)
+            result_queue.put((data_id, anno_file, etag, None))
+        except Exception as e:
+            result_queue.put((data_id, anno_file, None, str(e)))
+
+
+def _shard_upload_worker(s3_client, upload_queue: queue.Queue, result_queue: queue.Queue, metrics: Metrics):
+    """Upload sealed shards from the upload queue until a None sentinel is received."""
+
+    while (item := upload_queue.get()) is not None:
+        shard_file, index_file, units = item
+        etag, error = None, None
+        try:
+            with metrics.stage('upload shard'):
+                etag = upload_shard(s3_client, BUCKET, SHARD_PREFIX, shard_file, index_file)
+            metrics.count('bytes_uploaded', shard_file.stat().st_size)
+            metrics.count('shards_uploaded')
+            print(f"Shard of {len(units)} data IDs has been uploaded to "
+                  f"s3://{BUCKET}/{SHARD_PREFIX}{shard_file.name}")
+            shard_file.unlink()
+            index_file.unlink()
+        except Exception as e:
+            error = f"Error uploading shard {shard_file} to MinIO: {e}"
+        for data_id, anno_file in units:
+            result_queue.put((data_id, anno_file, etag, error))
+
+
+def _generate_data_units(manifest: ProcessingManifest, stats: dict[str, int]):
+    """
+    Generate (data_dir, data_id, source_file, anno_file) for every data ID in the batch directories which has not
+    already been processed from an unchanged annotation file.
+    """
+    for batch_dir in _get_batch_dirs(RESULT_DIR):
         data_ids = [item for item in os.listdir(os.path.join(RESULT_DIR, batch_dir)) if
                     os.path.isdir(os.path.join(RESULT_DIR, batch_dir, item))]
-        total_data_ids += len(data_ids)
+        stats['total'] += len(data_ids)
         for data_id in data_ids:
             data_dir = RESULT_DIR / batch_dir / data_id
-            if _process_annotation_file(data_dir, data_id):
-                processed_data_ids += 1
+            try:
+                source_file = _get_source_file(data_dir)
+                anno_file = _get_annotation_file(data_dir, source_file)
+            except (FileNotFoundError, ValueError) as e:
+                print(f"Error processing files in {data_dir}: {e}")
+                manifest.mark_failed(data_id, None, str(e))
+                stats['failed'] += 1
+                continue
+            if manifest.is_current(data_id, anno_file):
+                stats['skipped'] += 1
+                continue
+            yield data_dir, data_id, source_file, anno_file
+
+
+def _record_upload_results(result_queue: queue.Queue, manifest: ProcessingManifest, stats: dict[str, int]):
+    """Record the finished uploads in the manifest. The manifest is only written from the main thread."""
+
+    while True:
+        try:
+            data_id, anno_file, etag, error = result_queue.get_nowait()
+        except queue.Empty:
+            return
+        if error:
+            print(f"Error uploading {data_id}: {error}")
+            manifest.mark_failed(data_id, anno_file, error)
+            stats['failed'] += 1
+        else:
+            manifest.mark_done(data_id, anno_file, etag=etag)
+            stats['processed'] += 1
+
+
+def _parse_and_upload(metrics: Metrics):
+    s3_client = create_s3_client(ENDPOINT_URL, ACCESS_KEY, SECRET_KEY,
+                                 max_pool_connections=NUM_UPLOAD_THREADS * TRANSFER_CONFIG.max_concurrency)
+    metrics.watch_s3_client(s3_client)
+    upload_queue, result_queue = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE), queue.Queue()
+    upload_worker = _shard_upload_worker if PACK_SHARDS else _upload_worker
+    uploaders = [threading.Thread(target=upload_worker, args=(s3_client, upload_queue, result_queue, metrics),
+                                  daemon=True)
+                 for _ in range(NUM_UPLOAD_THREADS)]
+    for uploader in uploaders:
+        uploader.start()
+
+    stats = {'total': 0, 'processed': 0, 'skipped': 0, 'failed': 0}
+    writer = ShardWriter(SHARD_DIR) if PACK_SHARDS else None
+    # shard member name -> (data_id, anno_file) of the packed files whose shard is not sealed yet
+    packed_units = dict()
+
+    def _shard_upload_item(shard):
+        shard_file, index_file, members = shard
+        return shard_file, index_file, [packed_units.pop(member) for member in members]
+
+    with ProcessingManifest(MANIFEST_FILE) as manifest:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=NUM_PARSE_PROCESSES) as executor:
+            pending = dict()
+
+            def _hand_over_parsed(futures):
+                for future in futures:
+                    data_dir, data_id, anno_file = pending.pop(future)
+                    try:
+                        processed_file, num_rows, elapsed = future.result()
+                    except Exception as e:
+                        print(f"Error processing files in {data_dir}: {e}")
+                        manifest.mark_failed(data_id, anno_file, str(e))
+                        stats['failed'] += 1
+                        metrics.count('parse.errors')
+                        continue
+                    metrics.observe('parse', elapsed)
+                    metrics.count('rows_parsed', num_rows)
+                    if writer is None:
+                        item = (data_id, anno_file, processed_file)
+                    else:
+                        member = f'{data_id}/{processed_file.name}'
+                        packed_units[member] = (data_id, anno_file)
+                        with metrics.stage('pack'):
+                            shard = writer.add(member, processed_file)
+                        if shard is None:
+                            continue
+                        item = _shard_upload_item(shard)
+                    # blocks while the upload queue is full, holding back further parsing
+                    with metrics.stage('wait for upload queue'):
+                        upload_queue.put(item)
+                    metrics.gauge('upload_queue_depth', upload_queue.qsize())
+
+            for data_dir, data_id, source_file, anno_file in _generate_data_units(manifest, stats):
+                if len(pending) >= 2 * NUM_PARSE_PROCESSES:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    _hand_over_parsed(done)
+                    _record_upload_results(result_queue, manifest, stats)
+                future = executor.submit(_parse_annotation_file, data_dir, data_id, source_file, anno_file)
+                pending[future] = (data_dir, data_id, anno_file)
+                metrics.gauge('parse_in_flight', len(pending))
+
+            _hand_over_parsed(list(concurrent.futures.as_completed(pending)))
+            if writer is not None and (shard := writer.seal()) is not None:
+                upload_queue.put(_shard_upload_item(shard))
+
+        for _ in uploaders:
+            upload_queue.put(None)
+        for uploader in uploaders:
+            uploader.join()
+        _record_upload_results(result_queue, manifest, stats)
+
+    print(f"Total data IDs: {stats['total']}")
+    print(f"Processed data IDs: {stats['processed']}")
+    print(f"Skipped (already processed, unchanged) data IDs: {stats['skipped']}")
+    print(f"Failed data IDs: {stats['failed']}")
+
+    completed_data_ids = stats['processed'] + stats['skipped']
+    if completed_data_ids == 0:
+        raise ValueError("No data has been processed!")
+    elif completed_data_ids < stats['total']:
+        raise ValueError("Some data has not been processed. Please check the logs for more details. "
+                         f"Rerun to retry the failed data IDs only, they are recorded in {MANIFEST_FILE}.")
 
-    print(f"Total data IDs: {total_data_ids}")
-    print(f"Processed data IDs: {processed_data_ids}")
 
-    if processed_data_ids == 0:
-        raise ValueError("No data has been processed!")
-    elif processed_data_ids < total_data_ids:
-        raise ValueError("Some data has not been processed. Please check the logs for more details.")
+def main():
+    with Metrics('parse_eggnog_result') as metrics:
+        _parse_and_upload(metrics)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+"""
+A local SQLite manifest recording which data units have been processed and uploaded, so that reruns of a
+processing script can skip units whose source file is unchanged, resume after an interruption and only retry
+failures.
+
+Each data unit (e.g. an IMG submission ID) is keyed on its ID and records the size, mtime and SHA-256 hash of its
+source file along with the ETag of the uploaded object.
+"""
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    data_id     TEXT PRIMARY KEY,
+    source_path TEXT NOT NULL,
+    size        INTEGER,
+    mtime_ns    INTEGER,
+    sha256      TEXT,
+    etag        TEXT,
+    status      TEXT NOT NULL,
+    error       TEXT,
+    updated_at  REAL NOT NULL
+)
+"""
+
+
+def file_sha256(file_path: Path) -> str:
+    """Compute the SHA-256 hash of a file, reading it in chunks."""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class ProcessingManifest:
+    """
+    Completion manifest of data units backed by a SQLite database.
+
+    The manifest is not safe for concurrent writers; record results from a single thread.
+    """
+
+    def __init__(self, manifest_file: Path):
+        """
+        :param manifest_file: path of the SQLite database, created if it does not exist
+        """
+        self.manifest_file = Path(manifest_file)
+        self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.manifest_file)
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def is_current(self, data_id: str, source_file: Path) -> bool:
+        """
+        Check whether the data unit was completed from the same source file content.
+
+        The size and mtime are compared first; if only the mtime changed the file is re-hashed, and an identical hash
+        refreshes the recorded mtime so the next run does not hash it again.
+
+        :param data_id: ID of the data unit
+        :param source_file: source file of the data unit
+
+        :return: True if the data unit is done and its source file is unchanged
+        """
+        row = self._conn.execute(
+            'SELECT source_path, size, mtime_ns, sha256 FROM units WHERE data_id = ? AND status = ?',
+            (data_id, STATUS_DONE)).fetchone()
+        if row is None:
+            return False
+
+        source_path, size, mtime_ns, sha256 = row
+        try:
+            stat = source_file.stat()
+        except FileNotFoundError:
+            return False
+
+        if source_path != str(source_file) or stat.st_size != size:
+            return False
+        if stat.st_mtime_ns == mtime_ns:
+            return True
+        if file_sha256(source_file) != sha256:
+            return False
+
+        self._conn.execute('UPDATE units SET mtime_ns = ? WHERE data_id = ?', (stat.st_mtime_ns, data_id))
+        self._conn.commit()
+        return True
+
+    def mark_done(self, data_id: str, source_file: Path, etag: str | None = None, sha256: str | None = None):
+        """
+        Record the data unit as completed.
+
+        :param data_id: ID of the data unit
+        :param source_file: source file of the data unit
+        :param etag: ETag of the uploaded object
+        :param sha256: SHA-256 hash of the source file, computed if not provided
+        """
+        stat = source_file.stat()
+        sha256 = sha256 or file_sha256(source_file)
+        self._upsert(data_id, source_file, stat.st_size, stat.st_mtime_ns, sha256, etag, STATUS_DONE, None)
+
+    def mark_failed(self, data_id: str, source_file: Path | None, error: str):
+        """
+        Record the data unit as failed, so that it is retried on the next run.
+
+        :param data_id: ID of the data unit
+        :param source_file: source file of the data unit if known
+        :param error: error message
+        """
+        self._upsert(data_id, source_file or '', None, None, None, None, STATUS_FAILED, error)
+
+    def _upsert(self, data_id, source_file, size, mtime_ns, sha256, etag, status, error):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO units '
+            '(data_id, source_path, size, mtime_ns, sha256, etag, status, error, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (data_id, str(source_file), size, mtime_ns, sha256, etag, status, error, time.time()))
+        self._conn.commit()
+
+    def failed_ids(self) -> list[str]:
+        """Get the IDs of the data units that failed on their last attempt."""
+        return [row[0] for row in
+                self._conn.execute('SELECT data_id FROM units WHERE status = ? ORDER BY data_id', (STATUS_FAILED,))]
+
+    def status_counts(self) -> dict[str, int]:
+        """Get the number of data units per status."""
+        return dict(self._conn.execute('SELECT status, COUNT(*) FROM units GROUP BY status').fetchall())
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
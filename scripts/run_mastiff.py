@@ -0,0 +1,200 @@
+"""
+This script runs the branchwater mastiff containment search for the genome files of a collection.
+
+It replaces the serial mastiff loop and the renaming of the outputs in data_records/branchwater.md. The queries of the
+files listed in INPUT_FILE_LIST (the output of the find command in branchwater.md) run concurrently with at most
+MAX_CONCURRENT_QUERIES in flight, and failed or timed out queries are retried with backoff (see
+adaptive_executor.py). Each output is written straight to its final name, e.g. x_genomic.fna.gz ->
+x_genomic.fna.mastiff, in MASTIFF_DIR, ready for munge_mastiff.py.
+
+Outputs are cached in CACHE_DIR keyed on the SHA-256 of the input file and the mastiff version, so a rerun, or another
+collection sharing genomes, only queries the genomes not searched before with the same mastiff version. mastiff
+writes the query path into its output and munge_mastiff.py takes the genome ID from it, so an output cached for a file
+at another path is rewritten with the path of the current file. A cache entry is a directory holding the output and
+the query path it was made with, written under a temporary name and renamed into place, so concurrent queries of
+files with the same content never pair the output of one with the query path of the other.
+
+The mastiff executable is set with the MASTIFF_EXECUTABLE environment variable, e.g. to a local stub script which
+writes a canned output, for testing without the branchwater service.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+from scripts.adaptive_executor import AdaptiveExecutor
+from scripts.metrics import NULL_METRICS, Metrics
+from scripts.munge_mastiff import MASTIFF_DIR, MASTIFF_SUFFIX
+from scripts.processing_manifest import file_sha256
+
+MASTIFF_EXECUTABLE = Path(os.environ.get('MASTIFF_EXECUTABLE',
+                                         Path.home() / 'mash' / 'branchwater_mastiff' / 'mastiff'))
+INPUT_FILE_LIST = MASTIFF_DIR / 'f__Rhodanobacteraceae_input_files.txt'
+CACHE_DIR = MASTIFF_DIR / '.mastiff_cache'
+
+# queries are answered by the shared branchwater service, keep the load on it moderate
+MAX_CONCURRENT_QUERIES = 8
+MAX_ATTEMPTS = 3
+QUERY_TIMEOUT = 30 * 60  # seconds
+
+
+def mastiff_version(executable: Path = MASTIFF_EXECUTABLE) -> str:
+    """
+    Get the version of the mastiff executable, from --version if it reports one, otherwise the hash of the
+    executable.
+    """
+    try:
+        result = subprocess.run([str(executable), '--version'], capture_output=True, text=True, timeout=60)
+        version = result.stdout.strip()
+        if result.returncode == 0 and version:
+            return version
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    return f'sha256-{file_sha256(executable)}'
+
+
+def output_name(input_file: Path) -> str:
+    """Get the mastiff output name of an input file, e.g. x_genomic.fna.gz -> x_genomic.fna.mastiff."""
+    return f'{Path(input_file).stem}{MASTIFF_SUFFIX}'
+
+
+def _cache_key(version: str) -> str:
+    """Directory name for the cached outputs of a mastiff version."""
+    return hashlib.sha256(version.encode()).hexdigest()[:16]
+
+
+def _write_output(cached_file: Path, cached_query: str, input_file: Path, output_file: Path):
+    """Write the cached output of a query to the output file, replacing the query path if it differs."""
+    tmp_output = output_file.with_name(f'{output_file.name}.{os.getpid()}.{os.urandom(4).hex()}.tmp')
+    if cached_query == str(input_file):
+        try:
+            os.link(cached_file, tmp_output)
+        except OSError:
+            # the cache is on another file system
+            shutil.copyfile(cached_file, tmp_output)
+    else:
+        old, new = cached_query.encode(), str(input_file).encode()
+        with open(cached_file, 'rb') as cached, open(tmp_output, 'wb') as output:
+            output.writelines(line.replace(old, new) for line in cached)
+    os.replace(tmp_output, output_file)
+
+
+def run_query(
+        input_file: Path,
+        output_dir: Path = MASTIFF_DIR,
+        cache_dir: Path = CACHE_DIR,
+        executable: Path = MASTIFF_EXECUTABLE,
+        version: str | None = None,
+        metrics: Metrics | None = None) -> tuple[Path, bool]:
+    """
+    Run the mastiff query of a genome file, unless the cache holds the output of the same input and mastiff version.
+
+    :param input_file: genome file, e.g. a .fna.gz file
+    :param output_dir: directory of the outputs
+    :param cache_dir: directory of the cache
+    :param executable: mastiff executable
+    :param version: mastiff version, see mastiff_version, queried from the executable if not provided
+    :param metrics: metrics of the run, records the query time
+
+    :return: tuple of (output file, whether the output came from the cache)
+    """
+    metrics = metrics or NULL_METRICS
+    version = version or mastiff_version(executable)
+    entry_dir = Path(cache_dir) / _cache_key(version) / f'{file_sha256(input_file)}{MASTIFF_SUFFIX}.d'
+    # the cached output and the query path it was made with
+    cached_file, query_file = entry_dir / f'output{MASTIFF_SUFFIX}', entry_dir / 'query'
+    output_file = Path(output_dir) / output_name(input_file)
+
+    from_cache = entry_dir.exists()
+    if not from_cache:
+        tmp_dir = entry_dir.with_name(f'{entry_dir.name}.{os.getpid()}.{os.urandom(4).hex()}.tmp')
+        tmp_dir.mkdir(parents=True)
+        try:
+            tmp_file = tmp_dir / cached_file.name
+            with metrics.stage('mastiff query'):
+                subprocess.run([str(executable), '-o', str(tmp_file), str(input_file)],
+                               check=True, capture_output=True, timeout=QUERY_TIMEOUT)
+            if not tmp_file.exists():
+                raise ValueError(f'mastiff wrote no output for {input_file}')
+            (tmp_dir / query_file.name).write_text(str(input_file))
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # a concurrent query of a file with the same content was cached first, its entry is used
+                if not entry_dir.exists():
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    _write_output(cached_file, query_file.read_text(), input_file, output_file)
+    return output_file, from_cache
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """Failed and timed out queries may succeed on a retry, e.g. after a transient error of the service."""
+    return isinstance(error, (subprocess.CalledProcessError, subprocess.TimeoutExpired))
+
+
+def run_queries(
+        input_files: list[Path],
+        output_dir: Path = MASTIFF_DIR,
+        cache_dir: Path = CACHE_DIR,
+        executable: Path = MASTIFF_EXECUTABLE,
+        max_concurrent: int = MAX_CONCURRENT_QUERIES,
+        metrics: Metrics | None = None) -> tuple[list[Path], list[Path]]:
+    """
+    Run the mastiff queries of the genome files concurrently.
+
+    :param input_files: genome files
+    :param output_dir: directory of the outputs
+    :param cache_dir: directory of the cache
+    :param executable: mastiff executable
+    :param max_concurrent: maximum number of queries in flight
+    :param metrics: metrics of the run, records the query times, retries, cache hits and failures
+
+    :return: tuple of (output files, input files which failed)
+    """
+    metrics = metrics or NULL_METRICS
+    version = mastiff_version(executable)
+    print(f'mastiff version: {version}')
+
+    executor = AdaptiveExecutor(max_workers=max_concurrent, initial_workers=max_concurrent,
+                                max_attempts=MAX_ATTEMPTS, retryable=_is_retryable, metrics=metrics, name='query')
+    output_files, failed_files = list(), list()
+    for input_file, result, error in executor.run(
+            lambda file: run_query(file, output_dir, cache_dir, executable, version, metrics), input_files):
+        if error:
+            stderr = getattr(error, 'stderr', None)
+            detail = f': {stderr.decode(errors="replace").strip()}' if stderr else ''
+            print(f'Error running mastiff on {input_file}: {error}{detail}')
+            failed_files.append(input_file)
+            metrics.count('queries_failed')
+            continue
+        output_file, from_cache = result
+        output_files.append(output_file)
+        metrics.count('cache_hits' if from_cache else 'queries_run')
+        print(f'{output_file.name}{" (cached)" if from_cache else ""}')
+    return output_files, failed_files
+
+
+def _run_mastiff(metrics: Metrics):
+    with open(INPUT_FILE_LIST, 'r') as file:
+        input_files = [Path(line.strip()) for line in file if line.strip()]
+
+    output_files, failed_files = run_queries(input_files, metrics=metrics)
+    print(f'{len(output_files)} of {len(input_files)} mastiff outputs written to {MASTIFF_DIR}, '
+          f'{metrics.counter("cache_hits")} from the cache')
+
+    if failed_files:
+        raise ValueError(f'mastiff failed for {len(failed_files)} files, rerun to retry them: {failed_files[:10]}')
+
+
+def main():
+    with Metrics('run_mastiff') as metrics:
+        _run_mastiff(metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Packing of small per-genome result files into large tar shards, so that hundreds of thousands of processed files are
+stored as a few hundred objects in MinIO.
+
+Files are appended to an uncompressed tar file until it reaches SHARD_TARGET_BYTES, then the shard is sealed. A
+sidecar index, <shard>.index.json, maps each member name (e.g. <data_id>/<processed file name>) to the offset and
+size of its data in the shard. Since the members are stored uncompressed, a reader fetches the index and pulls one
+member from the shard with a single ranged GET, without reading the rest of the shard. The shard is a regular tar
+file, so it can also be downloaded and extracted as a whole with tar.
+
+Shard names start with the time they were written, so when a member is packed again by a later run (e.g. after its
+source changed) readers use the member of the latest shard.
+"""
+import io
+import json
+import os
+import tarfile
+import time
+from pathlib import Path
+
+import boto3
+import pandas as pd
+
+from scripts.utils import list_s3_objects, upload_file_etag
+
+SHARD_TARGET_BYTES = 256 * 1024 ** 2
+SHARD_SUFFIX = '.tar'
+INDEX_SUFFIX = '.index.json'
+
+
+class ShardWriter:
+    """Packs files into local tar shards of about the target size."""
+
+    def __init__(self, shard_dir: Path, target_bytes: int = SHARD_TARGET_BYTES):
+        """
+        :param shard_dir: directory to write the shards and their indexes to
+        :param target_bytes: size at which a shard is sealed, a shard exceeds it by at most its last member
+        """
+        self.shard_dir = Path(shard_dir)
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.target_bytes = target_bytes
+        self._name_prefix = f'{time.strftime("%Y%m%dT%H%M%S")}_{os.getpid()}_'
+        self._num_shards = 0
+        self._tar, self._shard_file, self._members = None, None, dict()
+
+    def add(self, member: str, file_path: Path) -> tuple[Path, Path, list[str]] | None:
+        """
+        Add a file to the current shard.
+
+        :param member: name of the file in the shard, e.g. <data_id>/<file name>
+        :param file_path: the file to add
+
+        :return: (shard file, index file, member names) of the shard if adding the file sealed it, otherwise None
+        """
+        if self._tar is None:
+            self._shard_file = self.shard_dir / f'{self._name_prefix}{self._num_shards:05d}{SHARD_SUFFIX}'
+            self._tar = tarfile.open(self._shard_file, 'w', format=tarfile.PAX_FORMAT)
+            self._members = dict()
+            self._num_shards += 1
+        tar_info = self._tar.gettarinfo(str(file_path), arcname=member)
+        with open(file_path, 'rb') as file:
+            self._tar.addfile(tar_info, file)
+        # the data of the member ends the archive so far, padded to whole tar blocks
+        padded_size = -(-tar_info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self._members[member] = (self._tar.offset - padded_size, tar_info.size)
+        if self._tar.offset >= self.target_bytes:
+            return self.seal()
+        return None
+
+    def seal(self) -> tuple[Path, Path, list[str]] | None:
+        """
+        Seal the current shard and write its index.
+
+        :return: (shard file, index file, member names) of the shard, None if no file was added since the last seal
+        """
+        if self._tar is None:
+            return None
+        self._tar.close()
+        index_file = Path(f'{self._shard_file}{INDEX_SUFFIX}')
+        with open(index_file, 'w') as file:
+            json.dump({'shard': self._shard_file.name,
+                       'members': {member: list(location) for member, location in self._members.items()}}, file)
+        shard = self._shard_file, index_file, list(self._members)
+        self._tar, self._shard_file, self._members = None, None, dict()
+        return shard
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._tar is not None:
+            self._tar.close()
+
+
+def upload_shard(s3: boto3.client, bucket: str, prefix: str, shard_file: Path, index_file: Path) -> str:
+    """
+    Upload a sealed shard and its index to <prefix><shard name>. The index is uploaded last, so readers only see
+    complete shards.
+
+    :return: ETag of the uploaded shard
+    """
+    etag = upload_file_etag(shard_file, f'{prefix}{shard_file.name}', s3, bucket)
+    s3.upload_file(str(index_file), bucket, f'{prefix}{index_file.name}')
+    return etag
+
+
+class ShardReader:
+    """Reads single members of the shards under a prefix of a bucket with ranged GETs."""
+
+    def __init__(self, s3: boto3.client, bucket: str, prefix: str):
+        """
+        :param s3: boto3 client for S3
+        :param bucket: name of the S3 bucket
+        :param prefix: key prefix of the shards
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        # member name -> (shard key, offset, size), loaded on first use
+        self._locations = None
+
+    def _load_indexes(self) -> dict[str, tuple[str, int, int]]:
+        if self._locations is None:
+            locations = dict()
+            index_keys = sorted(key for key in list_s3_objects(self.s3, self.bucket, self.prefix)
+                                if key.endswith(INDEX_SUFFIX))
+            # later shards override the members of earlier ones
+            for index_key in index_keys:
+                index = json.load(self.s3.get_object(Bucket=self.bucket, Key=index_key)['Body'])
+                shard_key = f'{self.prefix}{index["shard"]}'
+                for member, (offset, size) in index['members'].items():
+                    locations[member] = (shard_key, offset, size)
+            self._locations = locations
+        return self._locations
+
+    def members(self, under: str = '') -> list[str]:
+        """Get the sorted member names, optionally only those starting with a prefix, e.g. '<data_id>/'."""
+        return sorted(member for member in self._load_indexes() if member.startswith(under))
+
+    def read(self, member: str) -> bytes:
+        """Read a member with a ranged GET of its shard."""
+        try:
+            shard_key, offset, size = self._load_indexes()[member]
+        except KeyError:
+            raise ValueError(f'{member} not found in the shards at s3://{self.bucket}/{self.prefix}') from None
+        if size == 0:
+            return b''
+        response = self.s3.get_object(Bucket=self.bucket, Key=shard_key, Range=f'bytes={offset}-{offset + size - 1}')
+        return response['Body'].read()
+
+    def read_dataframe(self, member: str) -> pd.DataFrame:
+        """Read a processed CSV or Parquet member as a DataFrame."""
+        data = io.BytesIO(self.read(member))
+        if member.endswith('.parquet'):
+            return pd.read_parquet(data)
+        return pd.read_csv(data)
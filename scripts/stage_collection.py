@@ -0,0 +1,265 @@
+"""
+This script stages the source files of a collection to a fast local or scratch file system before running a tool
+on them, and syncs the tool results back afterwards.
+
+eggNOG runs were 5-10x faster with inputs on $SCRATCH instead of the project drive (see
+miscellaneous/eggnog_performance.md), and symbolic links into the project drive do not help, so the files have to
+be copied.
+
+Files are copied in parallel and verified against the SHA-256 computed while reading the source. A manifest in the
+staging root records the source size, mtime and hash of every staged file, so files already staged from an unchanged
+source are skipped. When a quota is set, the least recently used staged files not needed by the current run are
+evicted before copying, until the staging area has room for the files to copy within the quota.
+
+The staging and sync functions only take directories as arguments, so two local directories can stand in for the
+project drive and scratch.
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+from scripts.create_custom_collection import COLLECTION, SOURCE_VER, TARGET_EXT
+from scripts.file_catalog import FileCatalog
+from scripts.metrics import Metrics
+from scripts.processing_manifest import HASH_CHUNK_SIZE, file_sha256
+
+MANIFEST_NAME = '.staging_manifest.json'
+NUM_THREADS = 16
+MAX_COPY_ATTEMPTS = 3
+# seconds between saves of the manifest while copying
+MANIFEST_SAVE_INTERVAL = 30
+
+COLL_ROOT = Path('/global/cfs/cdirs/kbase/collections')
+SCRATCH_ROOT = Path(os.environ.get('SCRATCH', '/tmp')) / 'cdm_staging'
+# maximum total size of the staged files in bytes, None for no limit
+QUOTA_BYTES = None
+
+
+def _copy_with_checksum(source_file: Path, dest_file: Path) -> str:
+    """
+    Copy the file to a temporary file next to the destination, hashing the content as it is read, verify the
+    written copy against the hash and rename it into place.
+
+    :return: SHA-256 hash of the content
+    """
+    dest_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = dest_file.with_name(f'.{dest_file.name}.part')
+    for attempt in range(1, MAX_COPY_ATTEMPTS + 1):
+        sha256 = hashlib.sha256()
+        with open(source_file, 'rb') as src, open(tmp_file, 'wb') as dst:
+            while chunk := src.read(HASH_CHUNK_SIZE):
+                sha256.update(chunk)
+                dst.write(chunk)
+        shutil.copystat(source_file, tmp_file)
+
+        if file_sha256(tmp_file) == sha256.hexdigest():
+            os.replace(tmp_file, dest_file)
+            return sha256.hexdigest()
+        print(f'Checksum mismatch copying {source_file} to {dest_file} (attempt {attempt})')
+
+    tmp_file.unlink(missing_ok=True)
+    raise ValueError(f'Failed to copy {source_file} to {dest_file}: '
+                     f'checksum mismatch after {MAX_COPY_ATTEMPTS} attempts')
+
+
+class StagingArea:
+    """A staging root on a fast file system holding copies of source files, tracked by a manifest."""
+
+    def __init__(self, stage_root: Path, quota_bytes: int | None = QUOTA_BYTES, num_threads: int = NUM_THREADS):
+        """
+        :param stage_root: root directory of the staging area
+        :param quota_bytes: maximum total size of the staged files, None for no limit
+        :param num_threads: number of parallel copies
+        """
+        self.stage_root = Path(stage_root)
+        self.stage_root.mkdir(parents=True, exist_ok=True)
+        self.quota_bytes = quota_bytes
+        self.num_threads = num_threads
+        self._manifest_file = self.stage_root / MANIFEST_NAME
+        # staged path relative to the stage root -> {size, mtime_ns, sha256, last_used}, size and mtime of the source
+        self.manifest = dict()
+        if self._manifest_file.exists():
+            with open(self._manifest_file, 'r') as file:
+                self.manifest = json.load(file)
+
+    def _save_manifest(self):
+        tmp_file = self._manifest_file.with_name(f'{self._manifest_file.name}.tmp')
+        with open(tmp_file, 'w') as file:
+            json.dump(self.manifest, file)
+        os.replace(tmp_file, self._manifest_file)
+
+    def _is_staged(self, rel_path: str, source_stat: os.stat_result) -> bool:
+        record = self.manifest.get(rel_path)
+        if not record or record['size'] != source_stat.st_size or record['mtime_ns'] != source_stat.st_mtime_ns:
+            return False
+        try:
+            return (self.stage_root / rel_path).stat().st_size == source_stat.st_size
+        except FileNotFoundError:
+            return False
+
+    def stage(self, source_root: Path, source_files: list[Path]) -> dict[str, int]:
+        """
+        Copy the source files to the staging area, keeping their paths relative to the source root.
+
+        :param source_root: root directory of the source files
+        :param source_files: source files to stage, under source_root
+
+        :return: counts of copied, skipped (already staged and unchanged), failed and evicted files
+        """
+        source_root = Path(source_root)
+        now = time.time()
+        counts = {'copied': 0, 'skipped': 0, 'failed': 0, 'evicted': 0, 'bytes_copied': 0}
+
+        to_copy = dict()
+        for source_file in source_files:
+            rel_path = str(Path(source_file).relative_to(source_root))
+            source_stat = os.stat(source_file)
+            if self._is_staged(rel_path, source_stat):
+                self.manifest[rel_path]['last_used'] = now
+                counts['skipped'] += 1
+            else:
+                to_copy[rel_path] = (Path(source_file), source_stat)
+
+        # make room for the copies before starting them, so the staging area stays within the quota during the run
+        counts['evicted'] = self._evict(keep={str(Path(f).relative_to(source_root)) for f in source_files},
+                                        incoming_bytes=sum(stat.st_size for _, stat in to_copy.values()))
+
+        last_save = time.perf_counter()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                futures = {executor.submit(_copy_with_checksum, source_file, self.stage_root / rel_path): rel_path
+                           for rel_path, (source_file, _) in to_copy.items()}
+                for future in concurrent.futures.as_completed(futures):
+                    rel_path = futures[future]
+                    source_file, source_stat = to_copy[rel_path]
+                    try:
+                        sha256 = future.result()
+                    except Exception as e:
+                        print(f'Error staging {source_file}: {e}')
+                        counts['failed'] += 1
+                        continue
+                    self.manifest[rel_path] = {'size': source_stat.st_size,
+                                               'mtime_ns': source_stat.st_mtime_ns,
+                                               'sha256': sha256,
+                                               'last_used': now}
+                    counts['copied'] += 1
+                    counts['bytes_copied'] += source_stat.st_size
+                    # an interrupted run keeps the files copied so far
+                    if time.perf_counter() - last_save >= MANIFEST_SAVE_INTERVAL:
+                        self._save_manifest()
+                        last_save = time.perf_counter()
+        finally:
+            self._save_manifest()
+
+        return counts
+
+    def _evict(self, keep: set[str], incoming_bytes: int = 0) -> int:
+        """
+        Remove the least recently used staged files, except those in keep, until the quota leaves room for the
+        incoming bytes.
+        """
+        if self.quota_bytes is None:
+            return 0
+
+        total_bytes = sum(record['size'] for record in self.manifest.values()) + incoming_bytes
+        evicted = 0
+        for rel_path in sorted(self.manifest, key=lambda path: self.manifest[path]['last_used']):
+            if total_bytes <= self.quota_bytes:
+                break
+            if rel_path in keep:
+                continue
+            (self.stage_root / rel_path).unlink(missing_ok=True)
+            total_bytes -= self.manifest.pop(rel_path)['size']
+            evicted += 1
+        if evicted:
+            self._save_manifest()
+
+        if total_bytes > self.quota_bytes:
+            print(f'Staging area would be {total_bytes} bytes, over the quota of {self.quota_bytes} bytes, '
+                  f'with only the files of the current run left')
+
+        return evicted
+
+
+def sync_back(results_dir: Path, dest_dir: Path, num_threads: int = NUM_THREADS) -> dict[str, int]:
+    """
+    Copy the tool results from the staging area back to the destination directory, skipping files already present
+    at the destination with the same size and mtime. Every copy is verified against its checksum.
+
+    :param results_dir: results directory in the staging area
+    :param dest_dir: destination directory, e.g. on the project drive
+
+    :return: counts of copied, skipped and failed files
+    """
+    results_dir, dest_dir = Path(results_dir), Path(dest_dir)
+    counts = {'copied': 0, 'skipped': 0, 'failed': 0}
+
+    to_copy = list()
+    for root, _, files in os.walk(results_dir):
+        for name in files:
+            result_file = Path(root) / name
+            dest_file = dest_dir / result_file.relative_to(results_dir)
+            result_stat = result_file.stat()
+            try:
+                dest_stat = dest_file.stat()
+                if dest_stat.st_size == result_stat.st_size and dest_stat.st_mtime_ns == result_stat.st_mtime_ns:
+                    counts['skipped'] += 1
+                    continue
+            except FileNotFoundError:
+                pass
+            to_copy.append((result_file, dest_file))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = {executor.submit(_copy_with_checksum, result_file, dest_file): result_file
+                   for result_file, dest_file in to_copy}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+                counts['copied'] += 1
+            except Exception as e:
+                print(f'Error syncing back {futures[future]}: {e}')
+                counts['failed'] += 1
+
+    return counts
+
+
+def _stage_collection(metrics: Metrics):
+    coll_src_dir = COLL_ROOT / 'collectionssource' / 'NONE' / COLLECTION / SOURCE_VER
+    stage_dir = SCRATCH_ROOT / 'collectionssource' / COLLECTION / SOURCE_VER
+
+    with metrics.stage('catalog refresh'):
+        catalog = FileCatalog(coll_src_dir, tuple(TARGET_EXT))
+        catalog.refresh()
+        source_files = [path for path, _, _ in catalog.files(tuple(TARGET_EXT))]
+    metrics.count('files_scanned', len(source_files))
+
+    start_time = time.perf_counter()
+    with metrics.stage('stage'):
+        counts = StagingArea(stage_dir).stage(coll_src_dir, source_files)
+    elapsed = time.perf_counter() - start_time
+    for name, value in counts.items():
+        metrics.count(f'files_{name}' if name != 'bytes_copied' else name, value)
+
+    print(f"Staged {len(source_files)} files of {COLLECTION}/{SOURCE_VER} to {stage_dir} in {elapsed:.2f}s")
+    print(f"Copied: {counts['copied']} ({counts['bytes_copied'] / 1024 ** 2:.2f} MB)")
+    print(f"Skipped (already staged, unchanged): {counts['skipped']}")
+    print(f"Evicted: {counts['evicted']}")
+    print(f"Failed: {counts['failed']}")
+    print(f"After the tool run, copy the results back with "
+          f"sync_back(<results dir under {SCRATCH_ROOT}>, <collectionsdata dir>)")
+
+    if counts['failed']:
+        raise ValueError(f"Failed to stage {counts['failed']} files, rerun to retry them")
+
+
+def main():
+    with Metrics('stage_collection') as metrics:
+        _stage_collection(metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Generators of realistic synthetic inputs for the scripts in this directory, used by benchmark.py.
+
+All generators are deterministic for a given seed and write into the directory layouts the scripts expect.
+"""
+import gzip
+import json
+import random
+from pathlib import Path
+
+import pandas as pd
+
+RANKS = ('d', 'p', 'c', 'o', 'f', 'g', 's')
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+EMAPPER_COLUMNS = ['#query', 'seed_ortholog', 'evalue', 'score', 'eggNOG_OGs', 'max_annot_lvl', 'COG_category',
+                   'Description', 'Preferred_name', 'GOs', 'EC', 'KEGG_ko', 'KEGG_Pathway', 'KEGG_Module',
+                   'KEGG_Reaction', 'KEGG_rclass', 'BRITE', 'KEGG_TC', 'CAZy', 'BiGG_Reaction', 'PFAMs']
+
+
+def genome_ids(num_genomes: int) -> list[str]:
+    """NCBI style genome accessions."""
+    return [f'GCF_{i:09d}.1' for i in range(num_genomes)]
+
+
+def write_gtdb_taxonomy(taxonomy_file: Path, num_genomes: int, branching: int = 4, seed: int = 0) -> list[str]:
+    """
+    Write a GTDB style taxonomy TSV (e.g. bac120_taxonomy_r214.tsv) with a balanced taxonomy tree.
+
+    :param taxonomy_file: file to write
+    :param num_genomes: number of genomes
+    :param branching: number of child taxa per taxon
+
+    :return: lineages of the class rank, usable as lineage queries
+    """
+    rng = random.Random(seed)
+    classes = set()
+    taxonomy_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(taxonomy_file, 'w') as file:
+        for genome_id in genome_ids(num_genomes):
+            taxa = [f'{rank}__{rank.upper()}{rng.randrange(branching ** (depth + 1))}'
+                    for depth, rank in enumerate(RANKS)]
+            classes.add(taxa[2])
+            prefix = rng.choice(('RS_', 'GB_'))
+            file.write(f'{prefix}{genome_id}\t{";".join(taxa)}\n')
+    return sorted(classes)
+
+
+def _emapper_rows(rng: random.Random, genome_id: str, num_proteins: int) -> list[list]:
+    rows = list()
+    for i in range(num_proteins):
+        kos = ','.join(f'ko:K{rng.randrange(20000):05d}' for _ in range(rng.randrange(3)))
+        pfams = ','.join(f'PF{rng.randrange(20000):05d}' for _ in range(rng.randrange(3)))
+        gos = ','.join(f'GO:{rng.randrange(100000):07d}' for _ in range(rng.randrange(4)))
+        row = [f'{genome_id}_{i}', f'1234.{genome_id}_{i}', f'{rng.random() * 1e-10:.2e}',
+               f'{rng.uniform(30, 900):.1f}', 'COG0001@1|root', '1|root', rng.choice('CEGJKLMOP'),
+               'hypothetical protein', '-', gos or '-', '-', kos or '-', '-', '-', '-', '-', '-', '-', '-', '-',
+               pfams or '-']
+        rows.append(row)
+    return rows
+
+
+def write_emapper_annotations(
+        anno_file: Path,
+        genome_id: str,
+        num_proteins: int,
+        xlsx: bool = False,
+        seed: int = 0):
+    """
+    Write an emapper annotation output, either the tab-separated emapper.annotations file or its xlsx equivalent,
+    with the ## metadata lines emapper writes before and after the annotations.
+    """
+    rng = random.Random(f'{seed}{genome_id}')
+    rows = _emapper_rows(rng, genome_id, num_proteins)
+    header = ['## emapper-2.1.12', '## command: emapper.py -i input.faa --cpu 8']
+    footer = [f'## {num_proteins} queries scanned', '## Total time (seconds): 100.0', '## Rate: 1.00 q/s']
+    anno_file.parent.mkdir(parents=True, exist_ok=True)
+    if xlsx:
+        lines = [[line] + [None] * (len(EMAPPER_COLUMNS) - 1) for line in header]
+        lines += [EMAPPER_COLUMNS] + rows
+        lines += [[line] + [None] * (len(EMAPPER_COLUMNS) - 1) for line in footer]
+        pd.DataFrame(lines).to_excel(anno_file, header=False, index=False)
+    else:
+        with open(anno_file, 'w') as file:
+            file.writelines(f'{line}\n' for line in header)
+            file.write('\t'.join(EMAPPER_COLUMNS) + '\n')
+            file.writelines('\t'.join(row) + '\n' for row in rows)
+            file.writelines(f'{line}\n' for line in footer)
+
+
+def write_eggnog_collection_results(
+        coll_root: Path,
+        load_ver: str,
+        num_genomes: int,
+        num_proteins: int,
+        batch_prefix: str = 'batch_',
+        genomes_per_batch: int = 100,
+        xlsx: bool = False,
+        seed: int = 0) -> Path:
+    """
+    Write eggNOG results in the collections layout read by norm_results.normalize_eggnog_results and
+    parse_eggnog_result: <coll_root>/collectionsdata/NONE/CDM/<load_ver>/eggnog/<batch>/<genome>/, with an
+    eggnog_run_metadata.json per genome.
+
+    :return: eggNOG results directory
+    """
+    result_dir = coll_root / 'collectionsdata' / 'NONE' / 'CDM' / load_ver / 'eggnog'
+    for i, genome_id in enumerate(genome_ids(num_genomes)):
+        genome_dir = result_dir / f'{batch_prefix}{i // genomes_per_batch}' / genome_id
+        source_file = f'{genome_id}.faa'
+        suffix = 'emapper.annotations.xlsx' if xlsx else 'emapper.annotations'
+        write_emapper_annotations(genome_dir / f'{source_file}.{suffix}', genome_id, num_proteins, xlsx, seed)
+        with open(genome_dir / 'eggnog_run_metadata.json', 'w') as file:
+            json.dump({'source_file': f'/source/{genome_id}/{source_file}'}, file)
+    return result_dir
+
+
+def write_fastani_results(
+        result_dir: Path,
+        clade_id_file: Path,
+        num_clades: int,
+        genomes_per_clade: int,
+        seed: int = 0) -> list[str]:
+    """
+    Write all-vs-all FastANI results, one <clade_id>.txt per clade, and the clade ID file listing the clades.
+
+    :return: clade IDs
+    """
+    rng = random.Random(seed)
+    result_dir.mkdir(parents=True, exist_ok=True)
+    clade_ids = [f's__Clade_{i}' for i in range(num_clades)]
+    ids = genome_ids(num_clades * genomes_per_clade)
+    for c, clade_id in enumerate(clade_ids):
+        paths = [f'/genomes/{genome_id}/{genome_id}_ASM{c}v1_genomic.fna.gz'
+                 for genome_id in ids[c * genomes_per_clade:(c + 1) * genomes_per_clade]]
+        with open(result_dir / f'{clade_id}.txt', 'w') as file:
+            for query in paths:
+                for reference in paths:
+                    total = rng.randrange(800, 2000)
+                    file.write(f'{query}\t{reference}\t{rng.uniform(95, 100):.4f}\t'
+                               f'{rng.randrange(total // 2, total)}\t{total}\n')
+    with open(clade_id_file, 'w') as file:
+        file.writelines(f'{clade_id}\n' for clade_id in clade_ids)
+    return clade_ids
+
+
+def write_protein_fasta(faa_file: Path, num_proteins: int, mean_length: int = 300, seed: int = 0):
+    """Write a (gzipped if the name ends with .gz) protein FASTA file."""
+    rng = random.Random(f'{seed}{faa_file.name}')
+    opener = gzip.open if faa_file.name.endswith('.gz') else open
+    faa_file.parent.mkdir(parents=True, exist_ok=True)
+    with opener(faa_file, 'wt') as file:
+        for i in range(num_proteins):
+            sequence = ''.join(rng.choices(AMINO_ACIDS, k=max(10, int(rng.gauss(mean_length, mean_length / 3)))))
+            file.write(f'>WP_{i:09d}.1 hypothetical protein\n')
+            file.writelines(f'{sequence[j:j + 80]}\n' for j in range(0, len(sequence), 80))
+
+
+def write_ncbi_genome_tree(source_dir: Path, num_genomes: int, num_proteins: int = 100, seed: int = 0) -> list[str]:
+    """
+    Write an NCBI style source tree, <source_dir>/<genome_id>/<genome_id>_ASM<n>v1_<suffix>, with a protein FASTA
+    and small genomic files per genome.
+
+    :return: genome IDs
+    """
+    ids = genome_ids(num_genomes)
+    for i, genome_id in enumerate(ids):
+        genome_dir = source_dir / genome_id
+        prefix = f'{genome_id}_ASM{i}v1'
+        write_protein_fasta(genome_dir / f'{prefix}_protein.faa.gz', num_proteins, seed=seed)
+        for suffix in ('genomic.fna.gz', 'genomic.gbff.gz'):
+            with gzip.open(genome_dir / f'{prefix}_{suffix}', 'wt') as file:
+                file.write(f'>{genome_id}\nACGT\n')
+    return ids
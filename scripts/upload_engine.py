@@ -0,0 +1,247 @@
+"""
+An S3 upload engine which deduplicates uploads of large files by content.
+
+Re-loads of the same files under a new prefix (e.g. NCBI/ and collection specific keys) would otherwise send
+identical bytes through the SSH tunnel again. The engine keeps a content index in a local SQLite database, outside
+the bucket: for every content uploaded it records the key, size and ETag of an object in the bucket with that
+content, keyed on the endpoint URL and bucket so that servers with buckets of the same name do not share entries.
+
+For each file the engine:
+1. skips it if an object of the same size already exists at the key, as upload_to_s3 does, unless forced
+2. uploads files smaller than MIN_DEDUP_BYTES right away. Hashing and indexing them would cost more than the rare
+   re-send of a small file saves.
+3. computes the SHA-256 of larger files in a streaming pass. Files are hashed in the upload threads, so the checksums
+   of different files are computed in parallel.
+4. if the content index knows the hash and the indexed object is still in place with the recorded size and ETag,
+   copies that object to the key server side, without sending the bytes
+5. otherwise uploads the file with the transfer settings tuned to its size (utils.transfer_config_for) and adds the
+   content to the index, with the ETag returned by the upload (see utils.upload_file_etag)
+
+Objects the engine hashed carry their SHA-256 in the sha256 user metadata, so a lost index can be rebuilt from the
+bucket with index_from_metadata. Objects uploaded by other means, e.g. with mc or before the engine existed, carry no
+hash; index_existing indexes them from the local files they were uploaded from.
+"""
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import boto3
+from botocore.exceptions import ClientError
+
+from scripts.metrics import NULL_METRICS, Metrics
+from scripts.processing_manifest import file_sha256
+from scripts.utils import list_s3_objects, transfer_config_for, upload_file_etag
+
+CONTENT_INDEX_FILE = Path.home() / '.cdm_upload_content_index.sqlite'
+# files below the size are uploaded without deduplication
+MIN_DEDUP_BYTES = 16 * 1024 ** 2
+SHA256_METADATA_KEY = 'sha256'
+
+# indexes of an older schema version are dropped, they can be rebuilt with index_from_metadata
+SCHEMA_VERSION = 2
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS contents (
+    endpoint  TEXT NOT NULL,
+    bucket    TEXT NOT NULL,
+    sha256    TEXT NOT NULL,
+    s3_key    TEXT NOT NULL,
+    size      INTEGER NOT NULL,
+    etag      TEXT NOT NULL,
+    PRIMARY KEY (endpoint, bucket, sha256)
+)
+"""
+MISSING_OBJECT_ERROR_CODES = {'404', 'NoSuchKey', 'NotFound'}
+
+
+def _is_missing_object(error: ClientError) -> bool:
+    """Check whether the error of a request says the object does not exist, rather than e.g. throttling."""
+    return str(error.response.get('Error', {}).get('Code')) in MISSING_OBJECT_ERROR_CODES
+
+
+class UploadEngine:
+    """Uploads files to a bucket, server side copying content already in the bucket instead of re-sending it."""
+
+    def __init__(
+            self,
+            s3: boto3.client,
+            bucket: str,
+            metrics: Metrics | None = None,
+            index_file: Path = CONTENT_INDEX_FILE,
+            min_dedup_bytes: int = MIN_DEDUP_BYTES):
+        """
+        :param s3: boto3 client for S3
+        :param bucket: name of the S3 bucket
+        :param metrics: metrics of the run, records the hash, copy and upload stages and counts files and bytes
+        :param index_file: path of the SQLite content index, created if it does not exist
+        :param min_dedup_bytes: size from which files are deduplicated
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.endpoint = s3.meta.endpoint_url
+        self.min_dedup_bytes = min_dedup_bytes
+        self._metrics = metrics or NULL_METRICS
+        self.index_file = Path(index_file)
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        # the engine is shared by the upload threads, the connection is guarded by the lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.index_file, check_same_thread=False)
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self._conn.execute('DROP TABLE IF EXISTS contents')
+            self._conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def _record(self, sha256: str, s3_key: str, size: int, etag: str):
+        """Record an object of the bucket holding the content."""
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO contents VALUES (?, ?, ?, ?, ?, ?)',
+                               (self.endpoint, self.bucket, sha256, s3_key, size, etag))
+            self._conn.commit()
+
+    def _forget(self, sha256: str):
+        with self._lock:
+            self._conn.execute('DELETE FROM contents WHERE endpoint = ? AND bucket = ? AND sha256 = ?',
+                               (self.endpoint, self.bucket, sha256))
+            self._conn.commit()
+
+    def _indexed_key(self, sha256: str, size: int) -> str | None:
+        """Get the key of an object in the bucket with the content, None if there is none."""
+        with self._lock:
+            row = self._conn.execute('SELECT s3_key, size, etag FROM contents '
+                                     'WHERE endpoint = ? AND bucket = ? AND sha256 = ?',
+                                     (self.endpoint, self.bucket, sha256)).fetchone()
+        if row is None:
+            return None
+        source_key, indexed_size, etag = row
+        try:
+            head = self.s3.head_object(Bucket=self.bucket, Key=source_key)
+        except ClientError as e:
+            # throttling and server errors say nothing about the object, they are raised and the entry is kept
+            if not _is_missing_object(e):
+                raise
+            head = None
+        # the indexed object may have been overwritten or deleted since it was indexed
+        if head is None or indexed_size != size or head['ContentLength'] != size or head['ETag'] != etag:
+            self._forget(sha256)
+            return None
+        return source_key
+
+    def upload(
+            self,
+            upload_file: Path,
+            s3_key: str,
+            remote_objects: dict[str, tuple[int, str]] | None = None,
+            force: bool = False) -> str:
+        """
+        Upload the file to the key, unless an object of the same size is already there and force is not set.
+
+        :param upload_file: path of the file to upload
+        :param s3_key: key of the file in the bucket
+        :param remote_objects: index of the existing objects as returned by utils.list_s3_objects. When provided it
+            is used instead of a HEAD request to check the key.
+        :param force: upload even if an object of the same size is at the key, e.g. for the changed files of
+            utils.plan_s3_sync, whose object may differ in ETag only
+
+        :return: 'skipped', 'copied' (server side, from an object with the same content) or 'uploaded'
+        """
+        size = Path(upload_file).stat().st_size
+        if force:
+            remote_size = None
+        elif remote_objects is not None:
+            remote_size = remote_objects.get(s3_key, (None, None))[0]
+        else:
+            try:
+                remote_size = self.s3.head_object(Bucket=self.bucket, Key=s3_key)['ContentLength']
+            except ClientError as e:
+                if not _is_missing_object(e):
+                    raise
+                remote_size = None
+        if remote_size == size:
+            self._metrics.count('files_skipped')
+            return 'skipped'
+
+        config = transfer_config_for(size)
+        if size < self.min_dedup_bytes:
+            with self._metrics.stage('upload'):
+                self.s3.upload_file(str(upload_file), self.bucket, s3_key, Config=config)
+            self._metrics.count('files_uploaded')
+            self._metrics.count('bytes_uploaded', size)
+            return 'uploaded'
+
+        start_time = time.perf_counter()
+        sha256 = file_sha256(upload_file)
+        self._metrics.observe('hash', time.perf_counter() - start_time)
+        self._metrics.count('bytes_hashed', size)
+
+        extra_args = {'Metadata': {SHA256_METADATA_KEY: sha256}}
+        source_key = self._indexed_key(sha256, size)
+        if source_key is not None and source_key != s3_key:
+            with self._metrics.stage('copy'):
+                self.s3.copy({'Bucket': self.bucket, 'Key': source_key}, self.bucket, s3_key,
+                             ExtraArgs={**extra_args, 'MetadataDirective': 'REPLACE'}, Config=config)
+            self._metrics.count('files_copied')
+            self._metrics.count('bytes_copied', size)
+            return 'copied'
+
+        with self._metrics.stage('upload'):
+            etag = upload_file_etag(upload_file, s3_key, self.s3, self.bucket, extra_args, config)
+        self._record(sha256, s3_key, size, etag)
+        self._metrics.count('files_uploaded')
+        self._metrics.count('bytes_uploaded', size)
+        return 'uploaded'
+
+    def index_existing(
+            self,
+            target_files: list[tuple[Path, str]],
+            remote_objects: dict[str, tuple[int, str]]) -> int:
+        """
+        Index objects already in the bucket from the local files they were uploaded from, e.g. the NCBI/ tree loaded
+        before the engine existed, so that loads of the same files under another prefix are copied server side.
+        Each local file of at least min_dedup_bytes whose key holds an object of the same size is hashed once.
+
+        :param target_files: list of tuples (local file path, s3_key) of the uploaded files
+        :param remote_objects: index of the existing objects as returned by utils.list_s3_objects
+
+        :return: number of objects indexed
+        """
+        indexed = 0
+        for local_file, s3_key in target_files:
+            size = Path(local_file).stat().st_size
+            remote_size, etag = remote_objects.get(s3_key, (None, None))
+            if size < self.min_dedup_bytes or remote_size != size:
+                continue
+            with self._metrics.stage('hash'):
+                sha256 = file_sha256(local_file)
+            self._record(sha256, s3_key, size, etag)
+            indexed += 1
+        return indexed
+
+    def index_from_metadata(self, prefix: str) -> int:
+        """
+        Rebuild the index of the objects under the prefix from their sha256 metadata, e.g. after the local index
+        was lost. Only objects of at least min_dedup_bytes are checked, with a HEAD request each.
+
+        :param prefix: key prefix of the objects
+        :return: number of objects indexed
+        """
+        indexed = 0
+        for s3_key, (size, etag) in list_s3_objects(self.s3, self.bucket, prefix).items():
+            if size < self.min_dedup_bytes:
+                continue
+            head = self.s3.head_object(Bucket=self.bucket, Key=s3_key)
+            sha256 = head.get('Metadata', {}).get(SHA256_METADATA_KEY)
+            if sha256:
+                self._record(sha256, s3_key, size, etag)
+                indexed += 1
+        return indexed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
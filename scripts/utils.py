@@ -1,7 +1,106 @@
+import hashlib
+import itertools
+import json
 import os
+import pickle
+import time
+from array import array
+from collections import defaultdict
 from pathlib import Path
+from typing import Iterable, Iterator
 
 import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from scripts.file_catalog import FileCatalog
+from scripts.metrics import NULL_METRICS, Metrics
+
+PARQUET_COMPRESSION = 'zstd'
+S3_MAX_POOL_CONNECTIONS = 64
+S3_MAX_ATTEMPTS = 5
+# files up to the threshold are sent in a single request, larger files as parts uploaded in parallel
+S3_MULTIPART_THRESHOLD = 64 * 1024 ** 2
+# (largest file size, part size, parts in flight per file), the last tier applies to all larger files
+S3_TRANSFER_TIERS = ((1024 ** 3, 16 * 1024 ** 2, 8),
+                     (None, 64 * 1024 ** 2, 16))
+S3_MAX_PARTS = 10_000
+# target files planned at once by filter_s3_sync
+SYNC_BATCH_SIZE = 256
+# numeric columns of the eggNOG emapper annotation output, all other columns are strings
+EGGNOG_NUMERIC_COLUMNS = ('evalue', 'score')
+
+FASTANI_FILE_INDEX_SUFFIX = '.fastani_file_index.json'
+
+LINEAGE_INDEX_SUFFIX = '.lineage_index.pkl'
+LINEAGE_INDEX_VERSION = 1
+
+
+def _build_lineage_index(taxonomy_file: Path) -> tuple[list[str], dict[str, array]]:
+    """
+    Build a per-rank inverted index from a GTDB taxonomy file.
+
+    Each rank token of the lineage column (e.g. 'c__Alphaproteobacteria') maps to the row positions of the genomes
+    carrying it, so a lineage query is a hashed lookup instead of a scan over every row.
+
+    :param taxonomy_file: path of the taxonomy file
+
+    :return: tuple of (genome ids in file order, mapping of rank token to genome id positions)
+    """
+    genome_ids = list()
+    postings = defaultdict(lambda: array('I'))
+
+    with open(taxonomy_file, 'r') as file:
+        for line in file:
+            columns = line.strip().split('\t')
+            if len(columns) < 2:
+                continue
+            pos = len(genome_ids)
+            # Trim the prefix of the genome id as it is not part of the id in NCBI
+            # e.g. RS_GCF_000979555.1 -> GCF_000979555.1
+            genome_ids.append(columns[0][3:])
+            for token in columns[1].split(';'):
+                postings[token.strip()].append(pos)
+
+    return genome_ids, dict(postings)
+
+
+def _load_lineage_index(taxonomy_file: Path) -> tuple[list[str], dict[str, array]]:
+    """
+    Load the lineage index of the taxonomy file from the on-disk cache, rebuilding it if the cache is missing or the
+    taxonomy file has changed since the cache was written.
+
+    The cache is stored next to the taxonomy file with the suffix LINEAGE_INDEX_SUFFIX.
+    """
+    stat = os.stat(taxonomy_file)
+    signature = (LINEAGE_INDEX_VERSION, stat.st_size, stat.st_mtime_ns)
+    cache_file = taxonomy_file.with_name(taxonomy_file.name + LINEAGE_INDEX_SUFFIX)
+
+    try:
+        with open(cache_file, 'rb') as file:
+            cached_signature, genome_ids, postings = pickle.load(file)
+        if cached_signature == signature:
+            return genome_ids, postings
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+
+    genome_ids, postings = _build_lineage_index(taxonomy_file)
+
+    # Write to a temporary file first so a concurrent reader never sees a partial cache
+    tmp_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_file, 'wb') as file:
+            pickle.dump((signature, genome_ids, postings), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        # Caching is an optimization only, e.g. the taxonomy directory may be read-only
+        print(f'Unable to write lineage index cache {cache_file}: {e}')
+        tmp_file.unlink(missing_ok=True)
+
+    return genome_ids, postings
 
 
 def get_genome_ids_with_lineage(
@@ -11,54 +110,241 @@ def get_genome_ids_with_lineage(
     """
     Get genome ids with the specified lineage from GTDB taxonomy files (e.g. bac120_taxonomy_r214.tsv).
 
+    Lineages are matched on whole rank tokens, e.g. 'c__Alphaproteobacteria', or on several ranks separated by ';'
+    (e.g. 'p__Pseudomonadota;c__Alphaproteobacteria') in which case a genome must carry all of them.
+    The lookup is served from a lineage index cached next to each taxonomy file.
+
     :param taxonomy_files: list of path of taxonomy files
     :param lineages: list of target lineages
 
-    :return: list of genome ids with the specified lineage
+    :return: list of genome ids with the specified lineage, in taxonomy file order and without duplicates
     """
     genome_ids = list()
 
     for file_path in taxonomy_files:
-        with open(file_path, 'r') as file:
-            for line in file:
-                columns = line.strip().split('\t')
+        file_genome_ids, postings = _load_lineage_index(Path(file_path))
 
-                for lineage in lineages:
-                    if lineage in columns[1]:
-                        # Trim the prefix of the genome id as it is not part of the id in NCBI
-                        # e.g. RS_GCF_000979555.1 -> GCF_000979555.1
-                        genome_ids.append(columns[0][3:])
+        positions = set()
+        for lineage in lineages:
+            tokens = [token.strip() for token in lineage.split(';') if token.strip()]
+            if not tokens:
+                continue
+            matched = set(postings.get(tokens[0], ()))
+            for token in tokens[1:]:
+                matched.intersection_update(postings.get(token, ()))
+            positions.update(matched)
+
+        genome_ids.extend(file_genome_ids[pos] for pos in sorted(positions))
 
     return genome_ids
 
 
+def transfer_config_for(size: int) -> TransferConfig:
+    """
+    Get the transfer settings for a file of the size: a single request for small files, and for larger files a part
+    size and number of parts in flight growing with the size, keeping within the S3 limit of S3_MAX_PARTS parts.
+    """
+    for max_size, part_size, concurrency in S3_TRANSFER_TIERS:
+        if max_size is None or size <= max_size:
+            break
+    part_size = max(part_size, -(-size // S3_MAX_PARTS))
+    return TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                          multipart_chunksize=part_size,
+                          max_concurrency=concurrency)
+
+
 def upload_to_s3(
         upload_file: Path,
         s3_key: str,
         s3: boto3.client,
-        bucket: str):
+        bucket: str,
+        remote_objects: dict[str, tuple[int, str]] | None = None,
+        metrics: Metrics | None = None,
+        force: bool = False):
     """
     Upload the specified file to the specified S3 bucket.
 
+    The upload is skipped if an object of the same size already exists at the key, unless force is set. An object
+    of a different size, e.g. left by a truncated earlier upload, is overwritten. Transfer settings are tuned to the
+    file size, see transfer_config_for.
+
     :param upload_file: path of the file to upload
     :param s3_key: key of the file in the S3 bucket
     :param s3: boto3 client for S3
     :param bucket: name of the S3 bucket
+    :param remote_objects: index of the existing objects as returned by list_s3_objects. When provided it is used
+        instead of a HEAD request per file.
+    :param metrics: metrics of the run, records the latency of the head and upload stages and counts the files and
+        bytes uploaded
+    :param force: upload even if an object of the same size exists at the key, e.g. for the changed files of
+        plan_s3_sync, whose object may differ in ETag only
     """
-    try:
-        # Skip uploading if the file already exists in the bucket
-        s3.head_object(Bucket=bucket, Key=s3_key)
-    except s3.exceptions.ClientError:
-        s3.upload_file(str(upload_file), bucket, s3_key)
+    metrics = metrics or NULL_METRICS
+    local_size = os.path.getsize(upload_file)
+    if force:
+        remote_size = None
+    elif remote_objects is not None:
+        remote_size = remote_objects.get(s3_key, (None, None))[0]
+    else:
+        start_time = time.perf_counter()
+        try:
+            remote_size = s3.head_object(Bucket=bucket, Key=s3_key)['ContentLength']
+        except s3.exceptions.ClientError:
+            # a missing object is expected, so it is not counted as a failed head request
+            remote_size = None
+        metrics.observe('head', time.perf_counter() - start_time)
+
+    # Skip uploading if the file already exists in the bucket
+    if remote_size != local_size:
+        with metrics.stage('upload'):
+            s3.upload_file(str(upload_file), bucket, s3_key, Config=transfer_config_for(local_size))
+        metrics.count('files_uploaded')
+        metrics.count('bytes_uploaded', local_size)
+    else:
+        metrics.count('files_skipped')
+
+
+def upload_file_etag(
+        upload_file: Path,
+        s3_key: str,
+        s3: boto3.client,
+        bucket: str,
+        extra_args: dict | None = None,
+        config: TransferConfig | None = None) -> str:
+    """
+    Upload a file and get the ETag of the object, without a HEAD request for files sent in a single request.
+
+    Files below the multipart threshold of the transfer settings are sent with put_object, whose response carries the
+    ETag. Larger files are sent as a managed multipart upload and their ETag is read with a HEAD request, one extra
+    request per multipart upload.
+
+    :param upload_file: path of the file to upload
+    :param s3_key: key of the file in the S3 bucket
+    :param s3: boto3 client for S3
+    :param bucket: name of the S3 bucket
+    :param extra_args: extra arguments of the upload, e.g. Metadata
+    :param config: transfer settings, tuned to the file size with transfer_config_for by default
+
+    :return: ETag of the uploaded object
+    """
+    size = os.path.getsize(upload_file)
+    config = config or transfer_config_for(size)
+    extra_args = extra_args or dict()
+    if size < config.multipart_threshold:
+        with open(upload_file, 'rb') as file:
+            return s3.put_object(Bucket=bucket, Key=s3_key, Body=file, **extra_args)['ETag']
+    s3.upload_file(str(upload_file), bucket, s3_key, ExtraArgs=extra_args, Config=config)
+    return s3.head_object(Bucket=bucket, Key=s3_key)['ETag']
+
+
+def list_s3_objects(
+        s3: boto3.client,
+        bucket: str,
+        prefix: str
+) -> dict[str, tuple[int, str]]:
+    """
+    List the objects under the prefix with one paginated listing.
+
+    :param s3: boto3 client for S3
+    :param bucket: name of the S3 bucket
+    :param prefix: key prefix to list
+
+    :return: mapping of object key to (size, ETag)
+    """
+    remote_objects = dict()
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            remote_objects[obj['Key']] = (obj['Size'], obj['ETag'])
+
+    return remote_objects
+
+
+def local_etag(file_path: Path) -> str:
+    """Compute the ETag S3 assigns to a single part upload of the file, i.e. its quoted MD5 hex digest."""
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(8 * 1024 * 1024):
+            md5.update(chunk)
+    return f'"{md5.hexdigest()}"'
+
+
+def plan_s3_sync(
+        target_files: list[tuple[Path, str]],
+        remote_objects: dict[str, tuple[int, str]],
+        compare_etag: bool = False
+) -> tuple[list[tuple[Path, str]], list[tuple[Path, str]], list[tuple[Path, str]]]:
+    """
+    Diff the local files against the index of the existing objects to decide which files need uploading.
+
+    :param target_files: list of tuples (upload_file_path, s3_key)
+    :param remote_objects: index of the existing objects as returned by list_s3_objects
+    :param compare_etag: also compare the MD5 of local files against the ETag of objects of the same size.
+        Multipart ETags (containing '-') are not MD5 digests and are not compared.
+
+    :return: tuple of
+        new_files: files with no object at their key
+        changed_files: files whose object differs in size (e.g. a truncated upload) or ETag
+        unchanged_files: files already in the bucket
+    """
+    new_files, changed_files, unchanged_files = list(), list(), list()
+    for upload_file, s3_key in target_files:
+        if s3_key not in remote_objects:
+            new_files.append((upload_file, s3_key))
+            continue
+        remote_size, remote_etag = remote_objects[s3_key]
+        if os.path.getsize(upload_file) != remote_size:
+            changed_files.append((upload_file, s3_key))
+        elif compare_etag and '-' not in remote_etag and local_etag(upload_file) != remote_etag:
+            changed_files.append((upload_file, s3_key))
+        else:
+            unchanged_files.append((upload_file, s3_key))
+
+    return new_files, changed_files, unchanged_files
+
+
+def filter_s3_sync(
+        target_files: Iterable[tuple[Path, str]],
+        remote_objects: dict[str, tuple[int, str]],
+        counts: dict[str, int],
+        compare_etag: bool = False
+) -> Iterator[tuple[Path, str]]:
+    """
+    Lazy counterpart of plan_s3_sync: generate the target files which need uploading as they are produced, so that
+    discovery of the files can overlap with their upload. The target files are planned in batches of
+    SYNC_BATCH_SIZE.
+
+    :param target_files: iterable of tuples (upload_file_path, s3_key), e.g. a generator scanning the filesystem
+    :param remote_objects: index of the existing objects as returned by list_s3_objects
+    :param counts: counts of the new, changed and unchanged files, updated as the files are generated
+    :param compare_etag: see plan_s3_sync
+
+    :return: iterator of the new and changed target files, to be uploaded with force set since a changed file may
+        have the size of its object
+    """
+    target_files = iter(target_files)
+    while batch := list(itertools.islice(target_files, SYNC_BATCH_SIZE)):
+        new_files, changed_files, unchanged_files = plan_s3_sync(batch, remote_objects, compare_etag)
+        for action, files in (('new', new_files), ('changed', changed_files), ('unchanged', unchanged_files)):
+            counts[action] = counts.get(action, 0) + len(files)
+        yield from new_files
+        yield from changed_files
 
 
 def find_files_with_suffix(
         directory: Path,
-        suffix: str
+        suffix: str | tuple[str, ...],
+        catalog: FileCatalog | None = None
 ) -> list[str]:
     """
-    Find files with the specified suffix in the directory and its subdirectories.
+    Find files with the specified suffix (or any of a tuple of suffixes) in the directory and its subdirectories.
+
+    If a file catalog covering the directory is provided, the files are looked up in the catalog instead of walking
+    the directory.
     """
+    if catalog is not None:
+        return catalog.find(suffix, under=directory)
+
     matching_files = []
 
     for root, dirs, files in os.walk(directory):
@@ -67,3 +353,198 @@ def find_files_with_suffix(
                 matching_files.append(os.path.join(root, file))
 
     return matching_files
+
+
+class ParquetPartitionWriter:
+    """
+    Incrementally write DataFrames to a single Parquet file within a hive-partitioned dataset
+    (e.g. <dataset_dir>/genome_id=GCF_000979555.1/<file_name>).
+
+    Each call to write() appends a row group, so only one chunk of rows is held in memory at a time. The partition
+    values are encoded in the directory names and are not stored as columns in the file.
+    The file is written under a temporary name and moved into place on close(), so readers of the dataset never
+    see a partially written file.
+    """
+
+    def __init__(
+            self,
+            dataset_dir: Path,
+            partition: dict[str, str],
+            file_name: str,
+            compression: str = PARQUET_COMPRESSION,
+            schema: pa.Schema | None = None):
+        """
+        :param dataset_dir: root directory of the Parquet dataset
+        :param partition: ordered mapping of partition column to value
+        :param file_name: name of the Parquet file within the partition directory
+        :param compression: Parquet compression codec
+        :param schema: schema of the file, by default the schema of the first DataFrame written
+        """
+        partition_dir = Path(dataset_dir).joinpath(*[f'{key}={value}' for key, value in partition.items()])
+        partition_dir.mkdir(parents=True, exist_ok=True)
+        self.path = partition_dir / file_name
+        self._tmp_path = partition_dir / f'.{file_name}.{os.getpid()}.tmp'
+        self._compression = compression
+        self._schema = schema
+        self._writer = None
+        self.num_rows = 0
+
+    def write(self, df: pd.DataFrame):
+        """
+        Append the DataFrame as a row group. All DataFrames must share the schema given to the writer, or else the
+        schema of the first one.
+        """
+        if self._writer is None:
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+            self._writer = pq.ParquetWriter(self._tmp_path, table.schema, compression=self._compression)
+        else:
+            table = pa.Table.from_pandas(df, schema=self._writer.schema, preserve_index=False)
+        self._writer.write_table(table)
+        self.num_rows += len(df)
+
+    def close(self) -> Path | None:
+        """Finish the file and move it into place. Returns None if no rows were written."""
+        if self._writer is None:
+            return None
+        self._writer.close()
+        os.replace(self._tmp_path, self.path)
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self._writer is not None:
+            self._writer.close()
+            self._tmp_path.unlink(missing_ok=True)
+
+
+def cast_eggnog_annotation_types(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Cast eggNOG annotation columns to stable types for columnar output: the e-value and bit score columns to float
+    and every other column to string, so that all chunks and genomes share one Parquet schema.
+    """
+    df = df.copy()
+    for column in df.columns:
+        if column in EGGNOG_NUMERIC_COLUMNS:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('float64')
+        else:
+            df[column] = df[column].astype('string')
+    return df
+
+
+def create_s3_client(
+        endpoint_url: str,
+        access_key: str,
+        secret_key: str,
+        max_pool_connections: int = S3_MAX_POOL_CONNECTIONS,
+        max_attempts: int = S3_MAX_ATTEMPTS
+) -> boto3.client:
+    """
+    Create a boto3 S3 client meant to be shared across threads.
+
+    The connection pool is sized for the number of threads using the client, and retries use the adaptive mode
+    which backs off when the server throttles requests.
+
+    Clients whose requests are made by an AdaptiveExecutor should be created with max_attempts=1: the executor
+    retries throttled requests itself and needs to see the throttling to lower its concurrency, which botocore
+    retries would hide.
+
+    :param endpoint_url: S3 endpoint URL
+    :param access_key: S3 access key
+    :param secret_key: S3 secret key
+    :param max_pool_connections: maximum number of connections kept in the pool
+    :param max_attempts: maximum number of attempts of a request, 1 disables the botocore retries
+
+    :return: boto3 client for S3
+    """
+    # the adaptive mode also rate limits the client after throttling, only wanted when botocore does the retries
+    retries = {'total_max_attempts': max_attempts, 'mode': 'adaptive' if max_attempts > 1 else 'standard'}
+    return boto3.client('s3',
+                        endpoint_url=endpoint_url,
+                        aws_access_key_id=access_key,
+                        aws_secret_access_key=secret_key,
+                        config=Config(max_pool_connections=max_pool_connections, retries=retries))
+
+
+def _list_fastani_result_dir(result_dir: Path) -> list[str]:
+    """
+    List the file names of the FastANI results directory, from the cache file next to the directory
+    (.<dir name>.fastani_file_index.json) if it is still current, otherwise by listing the directory. The cache is kept
+    outside the directory so that writing it does not change the directory mtime it is keyed on. It holds every file
+    name, so callers selecting different suffixes share it.
+    """
+    cache_file = result_dir.parent / f'.{result_dir.name}{FASTANI_FILE_INDEX_SUFFIX}'
+    dir_mtime_ns = os.stat(result_dir).st_mtime_ns
+
+    try:
+        with open(cache_file, 'r') as file:
+            cache = json.load(file)
+        if cache['mtime_ns'] == dir_mtime_ns:
+            return cache['file_names']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with os.scandir(result_dir) as entries:
+        file_names = sorted(entry.name for entry in entries)
+
+    tmp_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_file, 'w') as file:
+            json.dump({'mtime_ns': dir_mtime_ns, 'file_names': file_names}, file)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        # The parent directory may be read-only for us, the directory is then listed on every run
+        print(f'Unable to write FastANI file index cache {cache_file}: {e}')
+        tmp_file.unlink(missing_ok=True)
+
+    return file_names
+
+
+def _load_fastani_file_index(result_dir: Path, suffixes: tuple[str, ...]) -> dict[str, list[str]]:
+    """
+    Build the clade -> result file names index of the FastANI results directory for the suffixes.
+
+    The clade ID of a result file is its name with the result suffix removed, e.g. s__Foo_bar.txt.matrix -> s__Foo_bar.
+    Suffixes are matched longest first so '.txt.matrix' is not mistaken for '.txt'.
+    """
+    suffixes = tuple(sorted(suffixes, key=len, reverse=True))
+    clade_files = defaultdict(list)
+    for name in _list_fastani_result_dir(result_dir):
+        for suffix in suffixes:
+            if name.endswith(suffix):
+                clade_files[name[:-len(suffix)]].append(name)
+                break
+
+    return dict(clade_files)
+
+
+def get_fastani_result_files(
+        result_dir: Path,
+        clade_ids: list[str],
+        suffixes: tuple[str, ...] = ('.txt',)
+) -> dict[str, list[Path]]:
+    """
+    Select the FastANI result files of the specified clades.
+
+    Result file names are parsed once into a clade -> files index (cached next to the results directory), so selecting
+    the files of a clade list is a hashed lookup per clade. Only files named exactly <clade_id><suffix> are
+    selected, so a clade never picks up the results of another clade whose name it is a prefix of.
+
+    :param result_dir: directory of the FastANI result files
+    :param clade_ids: list of clade IDs
+    :param suffixes: suffixes of the result files to select, e.g. ('.txt', '.txt.matrix')
+
+    :return: mapping of clade ID to its result files, in clade_ids order. Clades without result files are omitted.
+    """
+    clade_files = _load_fastani_file_index(result_dir, suffixes)
+
+    unmatched = [clade_id for clade_id in clade_ids if clade_id not in clade_files]
+    if unmatched:
+        print(f'{len(unmatched)} of {len(clade_ids)} clades have no result file named <clade_id><suffix> '
+              f'with the suffixes {suffixes} in {result_dir}: {unmatched[:10]}')
+
+    return {clade_id: [result_dir / name for name in clade_files[clade_id]]
+            for clade_id in clade_ids if clade_id in clade_files}
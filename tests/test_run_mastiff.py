@@ -0,0 +1,77 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+import scripts.run_mastiff
+
+# writes a canned output with the query path in its third column, as mastiff does, and logs each query. The sleep
+# keeps concurrent queries in flight together.
+STUB_MASTIFF = '''#!{python}
+import sys, time
+from pathlib import Path
+if sys.argv[1] == '--version':
+    print('mastiff-stub 1.0')
+    sys.exit(0)
+output_file, input_file = sys.argv[2], sys.argv[3]
+with open(Path(output_file).parents[2] / 'queries.log', 'a') as log:
+    log.write(input_file + '\\n')
+time.sleep(0.5)
+with open(output_file, 'w') as output:
+    output.write('SRA accession,containment,query_name\\n')
+    output.write(f'SRR000001,0.5,{{input_file}}\\n')
+'''
+
+
+@pytest.fixture
+def run_mastiff(tmp_path, monkeypatch):
+    executable = tmp_path / 'mastiff'
+    executable.write_text(STUB_MASTIFF.format(python=sys.executable))
+    executable.chmod(0o755)
+    monkeypatch.setenv('MASTIFF_EXECUTABLE', str(executable))
+    yield importlib.reload(scripts.run_mastiff)
+    monkeypatch.delenv('MASTIFF_EXECUTABLE')
+    importlib.reload(scripts.run_mastiff)
+
+
+def _queried(cache_dir: Path) -> list[str]:
+    return (cache_dir / 'queries.log').read_text().splitlines()
+
+
+def test_same_content_at_two_paths(run_mastiff, tmp_path):
+    input_files = list()
+    for number, genome_dir in enumerate(('a', 'b'), 1):
+        input_file = tmp_path / genome_dir / f'GCF_00000000{number}.1_x_genomic.fna.gz'
+        input_file.parent.mkdir()
+        input_file.write_bytes(b'ACGT')
+        input_files.append(input_file)
+    output_dir, cache_dir = tmp_path / 'out', tmp_path / 'cache'
+
+    output_files, failed_files = run_mastiff.run_queries(input_files, output_dir, cache_dir, max_concurrent=2)
+
+    assert failed_files == []
+    assert len(_queried(cache_dir)) == 2
+    for input_file in input_files:
+        output_file = output_dir / run_mastiff.output_name(input_file)
+        assert output_file in output_files
+        assert output_file.read_text().splitlines()[1] == f'SRR000001,0.5,{input_file}'
+    # one entry per content and no temporary entries left behind
+    entries = [path.name for path in cache_dir.glob('*/*')]
+    assert len(entries) == 1 and entries[0].endswith('.mastiff.d')
+
+
+def test_rerun_uses_cache(run_mastiff, tmp_path):
+    input_file = tmp_path / 'GCF_000000001.1_x_genomic.fna.gz'
+    input_file.write_bytes(b'ACGT')
+    output_dir, cache_dir = tmp_path / 'out', tmp_path / 'cache'
+
+    assert run_mastiff.run_query(input_file, output_dir, cache_dir)[1] is False
+    moved_file = tmp_path / 'moved' / input_file.name
+    moved_file.parent.mkdir()
+    input_file.rename(moved_file)
+    output_file, from_cache = run_mastiff.run_query(moved_file, output_dir, cache_dir)
+
+    assert from_cache is True
+    assert len(_queried(cache_dir)) == 1
+    assert output_file.read_text().splitlines()[1] == f'SRR000001,0.5,{moved_file}'
@@ -0,0 +1,103 @@
+import itertools
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+import scripts.stage_collection
+from scripts.stage_collection import MANIFEST_NAME, StagingArea, sync_back
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Make time.time() advance by one second per call, so every staging run has a later last used time."""
+    ticks = itertools.count(1)
+    clock = SimpleNamespace(time=lambda: float(next(ticks)), perf_counter=time.perf_counter)
+    monkeypatch.setattr(scripts.stage_collection, 'time', clock)
+
+
+def _write_sources(source_root: Path, sizes: dict[str, int]) -> dict[str, Path]:
+    source_files = dict()
+    for name, size in sizes.items():
+        source_file = source_root / name / f'{name}_protein.faa.gz'
+        source_file.parent.mkdir(parents=True, exist_ok=True)
+        source_file.write_bytes(name[-1].encode() * size)
+        source_files[name] = source_file
+    return source_files
+
+
+def _staged(stage_root: Path) -> list[str]:
+    return sorted(path.parent.name for path in stage_root.glob('*/*'))
+
+
+def test_stage_skips_unchanged_files_on_resume(tmp_path):
+    source_root, stage_root = tmp_path / 'cfs', tmp_path / 'scratch'
+    source_files = _write_sources(source_root, {'g1': 10, 'g2': 20, 'g3': 30})
+
+    counts = StagingArea(stage_root).stage(source_root, list(source_files.values()))
+
+    assert (counts['copied'], counts['skipped'], counts['failed'], counts['bytes_copied']) == (3, 0, 0, 60)
+    for source_file in source_files.values():
+        assert (stage_root / source_file.relative_to(source_root)).read_bytes() == source_file.read_bytes()
+    assert (stage_root / MANIFEST_NAME).exists()
+
+    # a new staging area reads the manifest, only the changed source is copied again
+    source_files['g2'].write_bytes(b'changed')
+    counts = StagingArea(stage_root).stage(source_root, list(source_files.values()))
+
+    assert (counts['copied'], counts['skipped']) == (1, 2)
+    assert (stage_root / 'g2' / 'g2_protein.faa.gz').read_bytes() == b'changed'
+
+
+def test_stage_evicts_least_recently_used(tmp_path, clock):
+    source_root, stage_root = tmp_path / 'cfs', tmp_path / 'scratch'
+    source_files = _write_sources(source_root, {'g1': 100, 'g2': 100, 'g3': 100, 'g4': 100})
+    for name in ('g1', 'g2', 'g3'):
+        StagingArea(stage_root, quota_bytes=300).stage(source_root, [source_files[name]])
+    # g1 is used again, g2 becomes the least recently used file
+    assert StagingArea(stage_root, quota_bytes=300).stage(source_root, [source_files['g1']])['skipped'] == 1
+
+    counts = StagingArea(stage_root, quota_bytes=300).stage(source_root, [source_files['g4']])
+
+    assert (counts['copied'], counts['evicted']) == (1, 1)
+    assert _staged(stage_root) == ['g1', 'g3', 'g4']
+    assert sorted(Path(path).parent.name for path in StagingArea(stage_root).manifest) == ['g1', 'g3', 'g4']
+
+
+def test_stage_keeps_files_of_the_current_run(tmp_path, clock):
+    source_root, stage_root = tmp_path / 'cfs', tmp_path / 'scratch'
+    source_files = _write_sources(source_root, {'g1': 100, 'g2': 100, 'g3': 100})
+    StagingArea(stage_root, quota_bytes=200).stage(source_root, [source_files['g1'], source_files['g2']])
+
+    counts = StagingArea(stage_root, quota_bytes=200).stage(source_root, list(source_files.values()))
+
+    # every file is needed by the run, none is evicted even though the run goes over the quota
+    assert (counts['copied'], counts['skipped'], counts['evicted']) == (1, 2, 0)
+    assert _staged(stage_root) == ['g1', 'g2', 'g3']
+
+
+def test_stage_counts_checksum_mismatch_as_failed(tmp_path, monkeypatch):
+    source_root, stage_root = tmp_path / 'cfs', tmp_path / 'scratch'
+    source_files = _write_sources(source_root, {'g1': 10})
+    monkeypatch.setattr(scripts.stage_collection, 'file_sha256', lambda path: 'corrupted')
+
+    counts = StagingArea(stage_root).stage(source_root, list(source_files.values()))
+
+    assert (counts['copied'], counts['failed']) == (0, 1)
+    assert _staged(stage_root) == []
+    assert StagingArea(stage_root).manifest == {}
+
+
+def test_sync_back_skips_unchanged_results(tmp_path):
+    results_dir, dest_dir = tmp_path / 'scratch' / 'results', tmp_path / 'cfs' / 'results'
+    (results_dir / 'batch_0').mkdir(parents=True)
+    (results_dir / 'batch_0' / 'g1.emapper.annotations').write_text('annotations')
+    (results_dir / 'g1.log').write_text('log')
+
+    assert sync_back(results_dir, dest_dir) == {'copied': 2, 'skipped': 0, 'failed': 0}
+    assert (dest_dir / 'batch_0' / 'g1.emapper.annotations').read_text() == 'annotations'
+
+    (results_dir / 'g1.log').write_text('log of a rerun')
+    assert sync_back(results_dir, dest_dir) == {'copied': 1, 'skipped': 1, 'failed': 0}
+    assert (dest_dir / 'g1.log').read_text() == 'log of a rerun'